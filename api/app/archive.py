@@ -0,0 +1,137 @@
+import datetime
+import json
+import mmap
+import os
+import threading
+import zlib
+from decimal import Decimal
+
+
+"""
+Reads the archive segments written by the worker archiver (worker/app/archive.py, see the format there):
+the transactions moved out of MySQL, older than every transaction still in the table.
+
+Segments are memory-mapped, and only the gzip member of the requested account is decompressed, in chunks.
+Segments never change once their index exists, the mappings are kept open.
+"""
+
+SEGMENT_PREFIX = "transactions-"
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+DATE_FORMAT = "%Y%m%d"
+CHUNK_SIZE = 64 * 1024
+
+
+def published_segments(directory):
+    """
+    (before, index path, segment path) of the segments with an index, oldest first.
+    Must match worker/app/archive.py, the API and the worker don't share code.
+    """
+    try:
+        names = sorted(name for name in os.listdir(directory) if name.startswith(SEGMENT_PREFIX) and name.endswith(INDEX_SUFFIX))
+    except FileNotFoundError:
+        return []
+    segments = []
+    for name in names:
+        before = datetime.datetime.strptime(name[len(SEGMENT_PREFIX):-len(INDEX_SUFFIX)], DATE_FORMAT)
+        base = os.path.join(directory, name[:-len(INDEX_SUFFIX)])
+        segments.append((before, base + INDEX_SUFFIX, base + SEGMENT_SUFFIX))
+    return segments
+
+
+class Segment:
+    def __init__(self, path: str, index: dict):
+        self.before = datetime.datetime.fromisoformat(index["before"])
+        self.accounts = index["accounts"]  # account_id -> [offset, length, rows]
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+
+    def lines(self, account_id: str):
+        """Yields the NDJSON lines of the account, decompressed CHUNK_SIZE at a time."""
+        entry = self.accounts.get(account_id)
+        if entry is None:
+            return
+        offset, length, _ = entry
+        view = memoryview(self.data)[offset:offset + length]
+        decompressor = zlib.decompressobj(wbits=31)
+        pending = b""
+        try:
+            for start in range(0, length, CHUNK_SIZE):
+                *lines, pending = (pending + decompressor.decompress(view[start:start + CHUNK_SIZE])).split(b"\n")
+                yield from lines
+        finally:
+            view.release()
+        if pending:
+            yield pending
+
+
+def statement_row(account_id: str, line: bytes):
+    """Same columns as the statement query: account_id, transaction_id, timestamp, type, amount, status, details."""
+    row = json.loads(line)
+    return (account_id, row["transaction_id"], datetime.datetime.fromisoformat(row["timestamp"]), row["type"],
+            Decimal(row["amount"]), row["status"], row["details"])
+
+def history_row(line: bytes):
+    """Same columns as the history query: transaction_id, amount, type, status, timestamp."""
+    row = json.loads(line)
+    return row["transaction_id"], Decimal(row["amount"]), row["type"], row["status"], datetime.datetime.fromisoformat(row["timestamp"])
+
+
+class ArchiveReader:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._segments = {}  # index path -> Segment
+        self._lock = threading.Lock()
+
+    def segments(self):
+        """The published segments, oldest first. New ones are picked up on each call."""
+        segments = published_segments(self.directory)
+        with self._lock:
+            for _, index_path, segment_path in segments:
+                if index_path not in self._segments:
+                    with open(index_path) as f:
+                        index = json.load(f)
+                    self._segments[index_path] = Segment(segment_path, index)
+            return [self._segments[index_path] for _, index_path, _ in segments]
+
+    def archived_until(self):
+        """The transactions before this time are in the archive (and no longer in MySQL), None if nothing is archived."""
+        segments = self.segments()
+        return segments[-1].before if segments else None
+
+    def history(self, account_id: str, after=None):
+        """
+        Yields the archived transactions of the account, oldest first, as history rows.
+        `after` is a (timestamp, transaction_id) cursor, only the transactions after it are yielded.
+        """
+        for segment in self.segments():
+            if after is not None and segment.before <= after[0]:
+                continue
+            for line in segment.lines(account_id):
+                row = history_row(line)
+                if after is None or (row[4], row[0]) > after:
+                    yield row
+
+    def statement(self, start, end, account_id=None, after=None):
+        """
+        Yields the archived transactions in [start, end), of one account or all of them, as statement rows ordered by
+        (account_id, timestamp, transaction_id). `after` is a cursor of that key, only the rows after it are yielded.
+        """
+        segments, previous = [], None
+        for segment in self.segments():
+            if segment.before > start and (previous is None or previous < end):
+                segments.append(segment)
+            previous = segment.before
+        if account_id is not None:
+            accounts = [account_id]
+        else:
+            accounts = sorted(set().union(*(segment.accounts for segment in segments)))
+        if after is not None:
+            accounts = [account for account in accounts if account >= after[0]]
+
+        for account in accounts:
+            for segment in segments:
+                for line in segment.lines(account):
+                    row = statement_row(account, line)
+                    if start <= row[2] < end and (after is None or (row[0], row[2], row[1]) > after):
+                        yield row
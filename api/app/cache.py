@@ -0,0 +1,102 @@
+import collections
+import threading
+import time
+
+
+class BalanceCache:
+    """
+    In-process LRU cache of account balances, bounded in size, with a TTL.
+
+    Entries are versioned with the account transaction_count: an older balance (a slow DB read, a late
+    event) never replaces a newer one. An invalidated entry is kept as a tombstone, with the last known version and
+    the time of the invalidation, until its TTL: a read started before the invalidation can't store its balance.
+    Thread safe, events update it from the subscriber thread.
+    """
+    def __init__(self, max_size=10000, ttl=30.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # account_id -> (balance, version, expires, invalidated_at), balance None if invalidated
+        self._lock = threading.Lock()
+
+    def get(self, account_id):
+        with self._lock:
+            entry = self._entries.get(account_id)
+            if entry is None:
+                return None
+            if entry[2] < time.monotonic():
+                del self._entries[account_id]
+                return None
+            self._entries.move_to_end(account_id)
+            return entry[0]
+
+    def put(self, account_id, balance, version, read_at=None):
+        """`read_at` is the time.monotonic() at which the balance was read from the DB, None for an event."""
+        with self._lock:
+            entry = self._entries.get(account_id)
+            if entry is not None and entry[2] >= time.monotonic():
+                if entry[1] > version:
+                    return
+                if entry[0] is None and (entry[1] == version or (read_at is not None and read_at < entry[3])):
+                    return
+            self._store(account_id, (balance, version, time.monotonic() + self.ttl, None))
+
+    def invalidate(self, account_id):
+        with self._lock:
+            entry = self._entries.get(account_id)
+            now = time.monotonic()
+            self._store(account_id, (None, entry[1] if entry is not None else -1, now + self.ttl, now))
+
+    def _store(self, account_id, entry):
+        self._entries[account_id] = entry
+        self._entries.move_to_end(account_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+class KnownAccounts:
+    """
+    Ids of the existing accounts, so the transactions of unknown accounts are refused before they are published.
+
+    Loaded from the DB at startup, then kept up to date by create_account and the account_created events of the
+    other API processes. Accounts are never deleted, a known id stays known. An id missing from the set (not loaded
+    yet, or its event was missed) must be looked up in the DB, the ids not found are remembered for `negative_ttl`
+    seconds (at most `negative_size` of them), so repeated junk traffic doesn't reach the DB either.
+    Thread safe, events update it from the subscriber thread.
+    """
+    def __init__(self, negative_size=10000, negative_ttl=5.0):
+        self.negative_size = negative_size
+        self.negative_ttl = negative_ttl
+        self._accounts = set()
+        self._unknown = collections.OrderedDict()  # account_id -> expires
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._accounts)
+
+    def lookup(self, account_id):
+        """True if the account exists, False if it was not found recently, None if it must be looked up."""
+        with self._lock:
+            if account_id in self._accounts:
+                return True
+            expires = self._unknown.get(account_id)
+            if expires is None:
+                return None
+            if expires < time.monotonic():
+                del self._unknown[account_id]
+                return None
+            return False
+
+    def add(self, *account_ids):
+        with self._lock:
+            self._accounts.update(account_ids)
+            for account_id in account_ids:
+                self._unknown.pop(account_id, None)
+
+    def mark_unknown(self, account_id):
+        with self._lock:
+            if account_id in self._accounts:
+                return
+            self._unknown[account_id] = time.monotonic() + self.negative_ttl
+            self._unknown.move_to_end(account_id)
+            while len(self._unknown) > self.negative_size:
+                self._unknown.popitem(last=False)
@@ -1,61 +1,223 @@
-from contextlib import contextmanager
-import mysql.connector
-import mysql.connector.abstracts
-import pika
+from contextlib import asynccontextmanager, contextmanager
+import asyncio
 import json
+import aiomysql
+import pymysql.err
+import pika
 import config
 import logging
 import fastapi
+import partitioning
+import metrics
+import time
+import wire
+from publisher import TransactionPublisher, MemoryPublisher, PublishError, PublisherBusyError
+from events import EventSubscriber
 
 
 """
 This is a simulation module for the "clients" connectors. This was done for simplicity.
 
 The good practice is to have cleints as separate classes, with persistent connections,
-connection management, exceptions handling, etc. 
+connection management, exceptions handling, etc. RabbitMQ publishing does that already,
+see publisher.TransactionPublisher, MySQL uses async connection pools.
 """
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 log = logging.getLogger(__name__)
 
 # RabbbitMQ
-def rmq_publish_transaction(transaction_data: dict):
+PARTITIONED = config.RABBITMQ_ROUTING == "partitioned"
+MEMORY_BROKER = config.RABBITMQ_BROKER == "memory"  # The publisher and subscriber are in-process, nothing reaches the workers
+
+event_subscriber = EventSubscriber(
+    host=config.RABBITMQ_HOST,
+    exchange=config.RABBITMQ_EVENTS_EXCHANGE,
+    credentials=pika.PlainCredentials(config.RABBITMQ_USER, config.RABBITMQ_PASSWORD),
+)
+
+if MEMORY_BROKER:
+    rmq_publisher = MemoryPublisher(
+        queue=config.RABBITMQ_TRASACTIONS_QUEUE,
+        events_exchange=config.RABBITMQ_EVENTS_EXCHANGE,
+        on_event=event_subscriber.dispatch,
+    )
+else:
+    rmq_publisher = TransactionPublisher(
+        host=config.RABBITMQ_HOST,
+        queue=config.RABBITMQ_TRASACTIONS_QUEUE,
+        credentials=pika.PlainCredentials(config.RABBITMQ_USER, config.RABBITMQ_PASSWORD),
+        topology=partitioning.topology(config.RABBITMQ_PARTITION_EXCHANGE, config.RABBITMQ_PARTITIONS) if PARTITIONED else None,
+        pool_size=config.RABBITMQ_PUBLISHER_CHANNELS,
+        max_in_flight=config.RABBITMQ_PUBLISHER_MAX_IN_FLIGHT,
+        publish_timeout=config.RABBITMQ_PUBLISH_TIMEOUT,
+    )
+
+WIRE_BINARY = config.RABBITMQ_WIRE_FORMAT == "binary"
+WIRE_PROPERTIES = {
+    content_type: pika.BasicProperties(content_type=content_type) for content_type in (wire.JSON_V2, wire.BINARY_V2)
+}
+
+def rmq_route(account_id: str):
+    """Returns (exchange, routing_key) for the transactions of an account."""
+    if PARTITIONED:
+        return config.RABBITMQ_PARTITION_EXCHANGE, str(partitioning.partition_for(account_id, config.RABBITMQ_PARTITIONS))
+    return "", config.RABBITMQ_TRASACTIONS_QUEUE
+
+def rmq_publish_nowait(transaction_data: dict):
+    """
+    Queues the transaction on the shared publisher, returns an asyncio future resolved on broker confirm.
+    Raises PublisherBusyError right away if too many messages are waiting for a confirm.
+    """
+    exchange, routing_key = rmq_route(transaction_data["account_id"])
+    body, content_type = wire.encode(transaction_data, binary=WIRE_BINARY)
+    start = time.perf_counter()
     try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=config.RABBITMQ_HOST))
-        channel = connection.channel()
-        channel.queue_declare(queue=config.RABBITMQ_TRASACTIONS_QUEUE)
-        channel.basic_publish(
-            exchange='', routing_key=config.RABBITMQ_TRASACTIONS_QUEUE, body=json.dumps(transaction_data)
+        future = rmq_publisher.publish(
+            body, routing_key=routing_key, exchange=exchange, properties=WIRE_PROPERTIES[content_type], block=False
         )
+    except PublisherBusyError:
+        metrics.PUBLISH_BUSY.inc()
+        raise
+    future.add_done_callback(lambda done: observe_publish(done, start))
+    return asyncio.wrap_future(future)
+
+def observe_publish(future, start):
+    """Runs in the publisher thread, when the message is confirmed or given up (cancelled on timeout)."""
+    outcome = "timeout" if future.cancelled() else "failed" if future.exception() else "confirmed"
+    metrics.PUBLISH_SECONDS.labels(outcome).observe(time.perf_counter() - start)
+
+async def rmq_publish_transaction(transaction_data: dict):
+    """Publishes through the shared publisher, returns once the broker confirmed the message."""
+    try:
+        await asyncio.wait_for(rmq_publish_nowait(transaction_data), timeout=config.RABBITMQ_PUBLISH_TIMEOUT)
         log.info(f"Published transaction: {transaction_data['transaction_id']}")
-    except Exception as e:  # TODO: Specific exceptions
-        log.error(f"Error publishing: {e}")
-    finally:
-        if connection:
-            connection.close()
+    except PublisherBusyError as e:
+        log.warning(f"Publisher busy: {e}")
+        raise fastapi.HTTPException(status_code=503, detail="Too many pending transactions, retry later")
+    except asyncio.TimeoutError:
+        # The message may be on a channel, waiting for its confirm: the broker can still deliver it
+        log.error(f"Timed out waiting for the confirm of transaction {transaction_data['transaction_id']}")
+        raise fastapi.HTTPException(status_code=504, detail={
+            "message": "Timed out waiting for the broker confirm, the transaction may be published: resend it with the same Idempotency-Key",
+            "transaction_id": transaction_data["transaction_id"],
+        })
+    except PublishError as e:
+        log.error(f"Error publishing: {e!r}")
+        raise fastapi.HTTPException(status_code=503, detail="Transaction could not be published")
 
-# Using a ctx manager as client to handle SQL connectivity, just for simplicity.
-@contextmanager
-def mysql_client(query:str, params:tuple = None):
+def rmq_publish_event(event: dict):
+    """
+    Publishes an event on the fanout events exchange, to every API process (this one included).
+    Doesn't wait for the confirm, a lost event only costs the receivers a DB lookup.
+    """
     try:
-        mydb = mysql.connector.connect(
-            host=config.MYSQL_HOST,
+        rmq_publisher.publish(json.dumps(event).encode(), routing_key="", exchange=config.RABBITMQ_EVENTS_EXCHANGE, block=False)
+    except PublishError as e:
+        log.warning(f"Event {event['event']} not published: {e}")
+
+# MySQL, async pools so a slow query doesn't block the event loop. Read-only queries can go to a replica.
+# Connections are opened on demand (minsize=0): the API starts, and answers, even if MySQL is not up yet.
+mysql_pools = {}
+
+async def mysql_connect():
+    mysql_pools["primary"] = await aiomysql.create_pool(
+        host=config.MYSQL_HOST,
+        user=config.MYSQL_USER,
+        password=config.MYSQL_PASSWORD,
+        db=config.MYSQL_DATABASE,
+        minsize=0,
+        maxsize=config.MYSQL_POOL_SIZE,
+        autocommit=True,
+    )
+    mysql_pools["replica"] = mysql_pools["primary"]
+    if config.MYSQL_READ_HOST:
+        mysql_pools["replica"] = await aiomysql.create_pool(
+            host=config.MYSQL_READ_HOST,
             user=config.MYSQL_USER,
             password=config.MYSQL_PASSWORD,
-            database=config.MYSQL_DATABASE
+            db=config.MYSQL_DATABASE,
+            minsize=0,
+            maxsize=config.MYSQL_POOL_SIZE,
+            autocommit=True,
         )
-        mycursor = mydb.cursor()
 
-        mycursor.execute(operation=query, params=params)
-        yield mycursor  # Pass cursor to allow getting results for one or more rows
+async def mysql_close():
+    for pool in set(mysql_pools.values()):
+        pool.close()
+        await pool.wait_closed()
+    mysql_pools.clear()
 
-    except mysql.connector.Error as e:
+@contextmanager
+def mysql_errors():
+    """Translates database errors to HTTP errors."""
+    try:
+        yield
+    except TimeoutError:
+        log.error(f"Database timeout after {config.MYSQL_QUERY_TIMEOUT}s")
+        raise fastapi.HTTPException(status_code=504, detail="Database timeout")
+    except pymysql.err.MySQLError as e:
         log.error(f"Database error: {e}")
         raise fastapi.HTTPException(status_code=500, detail="Database error")
+    except fastapi.HTTPException:
+        raise
     except Exception as e:  # TODO: Specific exceptions
         log.error(f"An unexpected error: {e}")
         raise fastapi.HTTPException(status_code=500, detail="Internal server error")
+
+# Using a ctx manager as client to handle SQL connectivity, just for simplicity.
+@asynccontextmanager
+async def mysql_client(query:str, params:tuple = None, readonly:bool = False):
+    """
+    Runs the query on a pooled connection, and yields the cursor to get the results.
+    The whole block, waiting for a connection included, must complete within MYSQL_QUERY_TIMEOUT.
+    """
+    pool_name = "replica" if readonly else "primary"
+    pool = mysql_pools[pool_name]
+    conn = None
+    failed = True
+    try:
+        with mysql_errors():
+            async with asyncio.timeout(config.MYSQL_QUERY_TIMEOUT):
+                with metrics.DB_CONNECTION_WAIT.labels(pool_name).time():
+                    conn = await pool.acquire()
+                async with conn.cursor() as mycursor:
+                    await mycursor.execute(query, params)
+                    yield mycursor  # Pass cursor to allow getting results for one or more rows
+            failed = False
+    finally:
+        if conn is not None:
+            if failed:
+                conn.close()  # Might be in the middle of a query, don't give it back as is
+            pool.release(conn)
+
+async def mysql_stream(query:str, params:tuple = None, readonly:bool = True, chunk_size:int = 500):
+    """
+    Yields the rows of the query from an unbuffered server-side cursor, `chunk_size` rows in memory at a time.
+    Each fetch (not the whole stream) must complete within MYSQL_QUERY_TIMEOUT.
+    """
+    pool_name = "replica" if readonly else "primary"
+    pool = mysql_pools[pool_name]
+    conn = None
+    failed = True
+    try:
+        with mysql_errors():
+            async with asyncio.timeout(config.MYSQL_QUERY_TIMEOUT):
+                with metrics.DB_CONNECTION_WAIT.labels(pool_name).time():
+                    conn = await pool.acquire()
+                mycursor = await conn.cursor(aiomysql.SSCursor)
+                await mycursor.execute(query, params)
+            while True:
+                async with asyncio.timeout(config.MYSQL_QUERY_TIMEOUT):
+                    rows = await mycursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+            await mycursor.close()
+            failed = False
     finally:
-        if mycursor: 
-            mycursor.close()
-        mydb.close()
+        if conn is not None:
+            if failed:
+                conn.close()  # Unread rows left if the client went away, the connection can't be reused
+            pool.release(conn)
@@ -1,13 +1,47 @@
 import os
 
 # RabbitMQ Configuration
+RABBITMQ_BROKER = os.environ.get("RABBITMQ_BROKER", "rabbitmq")  # "rabbitmq", or "memory" (in-process, no RabbitMQ needed)
 RABBITMQ_HOST = os.environ.get("RABBITMQ_HOST", "localhost")
 RABBITMQ_USER = os.environ.get("RABBITMQ_USER", "guest")
 RABBITMQ_PASSWORD = os.environ.get("RABBITMQ_PASSWORD", "guest")
 RABBITMQ_TRASACTIONS_QUEUE = os.environ.get("RABBITMQ_TRASACTIONS_QUEUE", "transactions")
+RABBITMQ_EVENTS_EXCHANGE = os.environ.get("RABBITMQ_EVENTS_EXCHANGE", "transaction_events")  # Published by the workers (and the API, account_created)
+RABBITMQ_ROUTING = os.environ.get("RABBITMQ_ROUTING", "queue")  # "queue" or "partitioned" (account affinity)
+RABBITMQ_PARTITION_EXCHANGE = os.environ.get("RABBITMQ_PARTITION_EXCHANGE", "transaction_partitions")
+RABBITMQ_PARTITIONS = int(os.environ.get("RABBITMQ_PARTITIONS", "16"))
+RABBITMQ_PUBLISHER_CHANNELS = int(os.environ.get("RABBITMQ_PUBLISHER_CHANNELS", "4"))  # Channel pool size
+RABBITMQ_PUBLISHER_MAX_IN_FLIGHT = int(os.environ.get("RABBITMQ_PUBLISHER_MAX_IN_FLIGHT", "1000"))  # Unconfirmed messages before backpressure
+RABBITMQ_PUBLISH_TIMEOUT = float(os.environ.get("RABBITMQ_PUBLISH_TIMEOUT", "5"))  # seconds to wait for broker confirm
+RABBITMQ_WIRE_FORMAT = os.environ.get("RABBITMQ_WIRE_FORMAT", "json")  # Encoding of the queued transactions: "json" or "binary"
+
+# Bulk ingestion
+TRANSACTION_BATCH_MAX_ITEMS = int(os.environ.get("TRANSACTION_BATCH_MAX_ITEMS", "10000"))  # per POST /transactions/batch
+TRANSACTION_BATCH_MAX_LINE = int(os.environ.get("TRANSACTION_BATCH_MAX_LINE", "65536"))  # bytes per NDJSON line, longer ones are invalid items
+
+# Balance cache, kept up to date by the worker events
+BALANCE_CACHE_SIZE = int(os.environ.get("BALANCE_CACHE_SIZE", "10000"))  # accounts
+BALANCE_CACHE_TTL = float(os.environ.get("BALANCE_CACHE_TTL", "30"))  # seconds, bounds staleness if events are lost
+
+# Transaction statuses, set by the worker events
+TRANSACTION_STATUS_CACHE_SIZE = int(os.environ.get("TRANSACTION_STATUS_CACHE_SIZE", "100000"))  # transactions
+TRANSACTION_STATUS_TTL = float(os.environ.get("TRANSACTION_STATUS_TTL", "600"))  # seconds, then read from the DB
+TRANSACTION_STATUS_MAX_WAIT = float(os.environ.get("TRANSACTION_STATUS_MAX_WAIT", "30"))  # seconds, long-poll and SSE
+
+# Known-account admission: the transactions of unknown accounts are refused ("reject"), published but counted
+# and logged ("flag"), or published without checking ("off"). The worker checks the account in any case.
+ACCOUNT_ADMISSION = os.environ.get("ACCOUNT_ADMISSION", "reject")
+UNKNOWN_ACCOUNT_CACHE_SIZE = int(os.environ.get("UNKNOWN_ACCOUNT_CACHE_SIZE", "10000"))  # ids not found, remembered
+UNKNOWN_ACCOUNT_TTL = float(os.environ.get("UNKNOWN_ACCOUNT_TTL", "5"))  # seconds, then looked up in the DB again
+
+# Transactions archived out of MySQL by the worker archiver, read by the history
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
 
 # MySQL Configuration
 MYSQL_HOST = os.environ.get("MYSQL_HOST", "localhost")
 MYSQL_USER = os.environ.get("MYSQL_USER", "root")
 MYSQL_PASSWORD = os.environ.get("MYSQL_PASSWORD", "password")
 MYSQL_DATABASE = os.environ.get("MYSQL_DATABASE", "mydb")
+MYSQL_READ_HOST = os.environ.get("MYSQL_READ_HOST", "")  # Optional read replica, for the read-only endpoints
+MYSQL_POOL_SIZE = int(os.environ.get("MYSQL_POOL_SIZE", "10"))
+MYSQL_QUERY_TIMEOUT = float(os.environ.get("MYSQL_QUERY_TIMEOUT", "2"))  # seconds, per query, connection wait included
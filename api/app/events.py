@@ -0,0 +1,77 @@
+import json
+import logging
+import threading
+import pika
+
+
+log = logging.getLogger(__name__)
+
+
+class EventSubscriber:
+    """
+    Consumes the events published by the workers on a fanout exchange, in a background thread,
+    and calls the handlers registered for the event type. Each API process gets its own
+    exclusive queue, so every process sees every event. Reconnects if the connection drops.
+    """
+    def __init__(self, host, exchange, credentials=None, reconnect_delay=1.0):
+        self.exchange = exchange
+        self.reconnect_delay = reconnect_delay
+        self.parameters = pika.ConnectionParameters(host=host, credentials=credentials or pika.ConnectionParameters.DEFAULT_CREDENTIALS)
+        self.handlers = {}  # event type -> [handler(event: dict)]
+        self._connection = None
+        self._channel = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def on(self, event_type, handler):
+        self.handlers.setdefault(event_type, []).append(handler)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="rmq-events", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stopping.set()
+        connection, channel = self._connection, self._channel
+        if connection is not None and channel is not None:
+            try:
+                connection.add_callback_threadsafe(channel.stop_consuming)
+            except Exception as e:  # Connection already gone
+                log.debug(f"Event subscriber already closed: {e}")
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self._connection = pika.BlockingConnection(self.parameters)
+                self._channel = channel = self._connection.channel()
+                channel.exchange_declare(exchange=self.exchange, exchange_type="fanout")
+                queue = channel.queue_declare(queue="", exclusive=True).method.queue
+                channel.queue_bind(queue=queue, exchange=self.exchange)
+                channel.basic_consume(queue=queue, on_message_callback=self._on_message, auto_ack=True)
+                log.info(f"Subscribed to events on {self.exchange}")
+                channel.start_consuming()
+            except Exception as e:
+                if not self._stopping.is_set():
+                    log.warning(f"Event subscriber disconnected: {e}, reconnecting in {self.reconnect_delay}s")
+            finally:
+                if self._connection is not None and self._connection.is_open:
+                    self._connection.close()
+                self._connection = self._channel = None
+            self._stopping.wait(self.reconnect_delay)
+
+    def _on_message(self, ch, method, properties, body):
+        self.dispatch(body)
+
+    def dispatch(self, body):
+        """Calls the handlers of an event, also used without RabbitMQ (publisher.MemoryPublisher)."""
+        try:
+            event = json.loads(body)
+            for handler in self.handlers.get(event.get("event"), []):
+                handler(event)
+        except Exception as e:
+            log.error(f"Error handling event: {e}", exc_info=True)
@@ -1,31 +1,120 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
+import asyncio
+import collections
+import itertools
 import uuid
+import base64
 import datetime
+import json
 from decimal import Decimal
 import logging
-from typing import List
+import time
+from typing import List, Optional
+import prometheus_client
 import clients
+import config
+import metrics
+import statements
+from cache import BalanceCache, KnownAccounts
+from archive import ArchiveReader
+from status import TransactionStatusStore, FINAL_STATUSES
 
-app = FastAPI()
+balance_cache = BalanceCache(max_size=config.BALANCE_CACHE_SIZE, ttl=config.BALANCE_CACHE_TTL)
+status_store = TransactionStatusStore(max_size=config.TRANSACTION_STATUS_CACHE_SIZE, ttl=config.TRANSACTION_STATUS_TTL)
+archive = ArchiveReader(config.ARCHIVE_DIR)
+known_accounts = KnownAccounts(negative_size=config.UNKNOWN_ACCOUNT_CACHE_SIZE, negative_ttl=config.UNKNOWN_ACCOUNT_TTL)
+
+def on_balance_changed(event: dict):
+    balance_cache.put(event["account_id"], Decimal(event["balance"]), event["version"])
+
+def on_balance_invalidated(event: dict):
+    balance_cache.invalidate(event["account_id"])
+
+def on_transactions_committed(event: dict):
+    """Balance events list the transactions they committed."""
+    for transaction_id in event.get("transaction_ids", []):
+        status_store.put(transaction_id, {
+            "transaction_id": transaction_id,
+            "account_id": event["account_id"],
+            "status": "completed",
+            "updated_at": event["committed_at"],
+        })
+
+def on_transaction_status(event: dict):
+    status_store.put(event["transaction_id"], {key: value for key, value in event.items() if key != "event"})
+
+def on_account_created(event: dict):
+    known_accounts.add(event["account_id"])
+
+ACCOUNT_IDS_CHUNK = 10000  # ids added to the known accounts at a time, while loading
+
+async def load_known_accounts():
+    """Loads the ids of all the accounts, streamed. Until it is done, or if it fails, the misses are looked up in the DB."""
+    start = asyncio.get_running_loop().time()
+    try:
+        chunk = []
+        async for (account_id,) in clients.mysql_stream("SELECT account_id FROM accounts"):
+            chunk.append(account_id)
+            if len(chunk) >= ACCOUNT_IDS_CHUNK:
+                known_accounts.add(*chunk)
+                chunk = []
+        known_accounts.add(*chunk)
+        log.info(f"Loaded {len(known_accounts)} known accounts in {asyncio.get_running_loop().time() - start:.1f}s")
+    except HTTPException as e:
+        log.error(f"Known accounts not loaded: {e.detail}, unknown ids are looked up in the DB")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    clients.rmq_publisher.start()
+    clients.event_subscriber.on("balance_changed", on_balance_changed)
+    clients.event_subscriber.on("balance_invalidated", on_balance_invalidated)
+    for event_type in ("balance_changed", "balance_invalidated"):
+        clients.event_subscriber.on(event_type, on_transactions_committed)
+    clients.event_subscriber.on("transaction_status", on_transaction_status)
+    clients.event_subscriber.on("account_created", on_account_created)
+    if not clients.MEMORY_BROKER:
+        clients.event_subscriber.start()
+    await clients.mysql_connect()
+    loading = asyncio.create_task(load_known_accounts()) if config.ACCOUNT_ADMISSION != "off" else None
+    yield
+    if loading is not None:
+        loading.cancel()
+    await clients.mysql_close()
+    clients.event_subscriber.stop()
+    clients.rmq_publisher.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 log = logging.getLogger(__name__)
 
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    """Prometheus scrape endpoint."""
+    return Response(prometheus_client.generate_latest(), media_type=prometheus_client.CONTENT_TYPE_LATEST)
+
 # Data types
 class TransactionRequest(BaseModel):
     account_id: str
     transaction_type: str  # "deposit", "withdrawal", "payment"
-    amount: Decimal
+    amount: Decimal = Field(max_digits=15, decimal_places=2)  # Same as the DB column, queued exactly (minor units)
     details: str = ""
 
+class BatchTransactionItem(TransactionRequest):
+    idempotency_key: Optional[str] = None  # Per item, same role as the Idempotency-Key header
+
 class AccountResponse(BaseModel):
     account_id: str
     balance: Decimal
     transaction_count: int
+    last_activity: Optional[datetime.datetime] = None
 
 class AccountListResponse(BaseModel):
     accounts: List[AccountResponse]
+    next_after: Optional[str] = None  # Pass as `after` to get the next page, None on the last page
 
 class AccountCreateRequest(BaseModel):
     account_id: str
@@ -34,88 +123,521 @@ class AccountCreateRequest(BaseModel):
 @app.post("/accounts", status_code=201)
 async def create_account(acc: AccountCreateRequest):
     """Creates a new account."""
-    query = "INSERT INTO accounts (account_id, balance) VALUES (%s, %s)"
+    query = "INSERT INTO accounts (account_id, balance, initial_balance) VALUES (%s, %s, %s)"
     try:
-        clients.mysql_client(query, (acc.account_id, acc.initial_balance))
+        async with clients.mysql_client(query, (acc.account_id, acc.initial_balance, acc.initial_balance)):
+            pass
     except Exception as e:
         log.error(f"Error creating account with {acc.account_id}")
         raise HTTPException(status_code=500, detail=f"Error while creating account with id {acc.account_id}")
     
+    known_accounts.add(acc.account_id)
+    clients.rmq_publish_event({"event": "account_created", "account_id": acc.account_id})
     log.info(f"Created account: {acc.account_id} with initial balance: {acc.initial_balance}")
     return {"message": f"Account created with id {acc.account_id}"}
 
+# Keyset pagination on the primary key, the summary columns are maintained by the worker.
+# In ledger mode they are a snapshot, the ledger entries after it are added (none otherwise).
+ACCOUNTS_PAGE_QUERY = """
+    SELECT a.account_id, a.balance + COALESCE(SUM(e.amount), 0), a.transaction_count + COUNT(e.entry_id),
+        GREATEST(COALESCE(a.last_activity, MAX(e.timestamp)), COALESCE(MAX(e.timestamp), a.last_activity))
+    FROM (
+        SELECT account_id, balance, transaction_count, last_activity, ledger_entry_id
+        FROM accounts
+        WHERE account_id > %s
+        ORDER BY account_id
+        LIMIT %s
+    ) a
+    LEFT JOIN ledger_entries e ON e.account_id = a.account_id AND e.entry_id > a.ledger_entry_id
+    GROUP BY a.account_id, a.balance, a.transaction_count, a.last_activity
+    ORDER BY a.account_id
+"""
+
+async def get_accounts_page(after: str, limit: int):
+    async with clients.mysql_client(ACCOUNTS_PAGE_QUERY, (after, limit), readonly=True) as cursor:
+        results = await cursor.fetchall()
+
+    return [
+        AccountResponse(account_id=account_id, balance=balance, transaction_count=transaction_count, last_activity=last_activity)
+        for account_id, balance, transaction_count, last_activity in results
+    ]
+
+async def stream_accounts(after: str, page_size: int):
+    """Yields all the accounts as NDJSON, one page in memory at a time."""
+    while True:
+        page = await get_accounts_page(after, page_size)
+        for account in page:
+            yield account.model_dump_json() + "\n"
+        if len(page) < page_size:
+            return
+        after = page[-1].account_id
+
 @app.get("/accounts", response_model=AccountListResponse)
-async def get_all_accounts():
-    query = """
-        SELECT 
-            a.account_id, 
-            a.balance, 
-            COUNT(t.transaction_id) AS transaction_count
-        FROM accounts a
-        LEFT JOIN transactions t ON a.account_id = t.account_id
-        GROUP BY a.account_id, a.balance
+async def get_all_accounts(
+    after: str = "",
+    limit: int = Query(100, ge=1, le=1000),
+    stream: bool = False,
+):
+    """
+    Lists the accounts, `limit` per page, after the `after` account_id.
+    With `stream`, all the remaining accounts are streamed as NDJSON instead.
     """
+    if stream:
+        log.info("Streaming all accounts")
+        return StreamingResponse(stream_accounts(after, limit), media_type="application/x-ndjson")
 
-    with clients.mysql_client(query, None) as cursor:
-        results = cursor.fetchall()
+    account_list = await get_accounts_page(after, limit)
+    next_after = account_list[-1].account_id if len(account_list) == limit else None
 
-    account_list = []
-    for account_id, balance, transaction_count in results:
-        account_list.append(
-            AccountResponse(account_id=account_id, balance=float(balance), transaction_count=transaction_count)
-        )
+    log.info("Got accounts + balance and transactions")
+    return AccountListResponse(accounts=account_list, next_after=next_after)
 
-    log.info("Got all accounts + balance and transactions")
-    return AccountListResponse(accounts=account_list)
 
+# Namespace of the transaction ids derived from an idempotency key
+IDEMPOTENCY_NAMESPACE = uuid.UUID("3f8b6c1e-5d2a-4b7e-9c41-8a0d2e6f1b93")
+
+def new_transaction_id(account_id: str, idempotency_key: Optional[str]) -> str:
+    """
+    Random id, or derived from the client idempotency key: retries of the same request get the same id,
+    and the worker processes the transaction only once.
+    """
+    if idempotency_key:
+        return str(uuid.uuid5(IDEMPOTENCY_NAMESPACE, f"{account_id}:{idempotency_key}"))
+    return str(uuid.uuid4())
+
+async def account_exists(account_id: str) -> bool:
+    """
+    From the known accounts, else from the primary (an account just created by another API process).
+    If the DB can't tell, the account is given the benefit of the doubt: the worker checks it anyway.
+    """
+    known = known_accounts.lookup(account_id)
+    if known is not None:
+        return known
+    try:
+        async with clients.mysql_client("SELECT 1 FROM accounts WHERE account_id = %s", (account_id,)) as cursor:
+            known = await cursor.fetchone() is not None
+    except HTTPException:
+        log.warning(f"Account {account_id} could not be checked, admitted")
+        return True
+    if known:
+        known_accounts.add(account_id)
+    else:
+        known_accounts.mark_unknown(account_id)
+    return known
+
+async def admit(account_id: str) -> bool:
+    """
+    False if the transactions of the account must be refused before publishing: it doesn't exist, and
+    ACCOUNT_ADMISSION is "reject". Junk traffic never reaches the queue, nor the workers.
+    """
+    if config.ACCOUNT_ADMISSION == "off" or await account_exists(account_id):
+        return True
+    metrics.UNKNOWN_ACCOUNT.labels(config.ACCOUNT_ADMISSION).inc()
+    if config.ACCOUNT_ADMISSION == "flag":
+        log.warning(f"Transaction of unknown account {account_id}, published")
+        return True
+    log.info(f"Transaction of unknown account {account_id}, refused")
+    return False
 
 @app.post("/transactions")
-async def create_transaction(transaction_request: TransactionRequest):
-    transaction_id = str(uuid.uuid4())
-    transaction_data = {
-        "transaction_id": transaction_id,
+async def create_transaction(
+    transaction_request: TransactionRequest,
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+):
+    if not await admit(transaction_request.account_id):
+        raise HTTPException(status_code=422, detail=f"Account {transaction_request.account_id} not found")
+    transaction_data = build_transaction(transaction_request, idempotency_key)
+    await clients.rmq_publish_transaction(transaction_data)
+    mark_pending(transaction_data)
+    return {
+        "transaction_id": transaction_data["transaction_id"],
+        "timestamp": transaction_data["timestamp"].isoformat(),
+        "status": "pending",
+        "message": "Transaction published",
+    }
+
+def mark_pending(transaction_data: dict):
+    """Published, its final status comes with the worker events. See GET /transactions/{transaction_id}."""
+    status_store.put(transaction_data["transaction_id"], {
+        "transaction_id": transaction_data["transaction_id"],
+        "account_id": transaction_data["account_id"],
+        "status": "pending",
+        "updated_at": transaction_data["timestamp"].isoformat(),
+    })
+
+def build_transaction(transaction_request: TransactionRequest, idempotency_key: Optional[str]) -> dict:
+    return {
+        "transaction_id": new_transaction_id(transaction_request.account_id, idempotency_key),
         "account_id": transaction_request.account_id,
         "transaction_type": transaction_request.transaction_type,
-        "amount": float(transaction_request.amount),
+        "amount": transaction_request.amount,
         "details": transaction_request.details,
-        "timestamp": datetime.datetime.now().isoformat()
+        "timestamp": datetime.datetime.now()
     }
 
-    clients.rmq_publish_transaction(transaction_data)
-    return {"transaction_id": transaction_id, "message": "Transaction published"}
 
+async def read_batch_items(request: Request):
+    """
+    Yields the raw items of a batch: a JSON array, or NDJSON (one transaction per line) read as it arrives.
+    A line that is not valid JSON is yielded as the ValueError, and reported on its item. So is a line longer than
+    TRANSACTION_BATCH_MAX_LINE, dropped as it arrives: the buffer stays bounded.
+    """
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        too_long = ValueError(f"Line longer than {config.TRANSACTION_BATCH_MAX_LINE} bytes")
+        buffer, dropping = b"", False  # dropping: the rest of a line too long
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if dropping or len(line) > config.TRANSACTION_BATCH_MAX_LINE:
+                    dropping = False
+                    yield too_long
+                elif line.strip():
+                    yield parse_batch_line(line)
+            if len(buffer) > config.TRANSACTION_BATCH_MAX_LINE:
+                buffer, dropping = b"", True
+        if dropping:
+            yield too_long
+        elif buffer.strip():
+            yield parse_batch_line(buffer)
+        return
+
+    try:
+        items = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be a JSON array, or NDJSON")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Body must be a JSON array, or NDJSON")
+    if len(items) > config.TRANSACTION_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {config.TRANSACTION_BATCH_MAX_ITEMS} transactions per batch")
+    for item in items:
+        yield item
+
+def parse_batch_line(line: bytes):
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return e
+
+async def settle_published(result: dict, confirm):
+    """
+    Waits for the broker confirm of one item, and records a failure on its result. Without confirm in time,
+    the message may still be delivered: the item is "unknown", to resend with the same idempotency_key.
+    """
+    try:
+        await asyncio.wait_for(confirm, timeout=config.RABBITMQ_PUBLISH_TIMEOUT)
+    except asyncio.TimeoutError:
+        result.update(status="unknown", error="Timed out waiting for broker confirm, resend with the same idempotency_key")
+    except clients.PublishError as e:
+        result.update(status="failed", error=str(e))
+
+async def publish_pipelined(transaction_data: dict, result: dict, pending: collections.deque):
+    """
+    Publishes without waiting for the confirm, so the whole batch is in flight at once.
+    On backpressure, waits for the oldest message of the batch to be confirmed, then tries again.
+    """
+    deadline = asyncio.get_running_loop().time() + config.RABBITMQ_PUBLISH_TIMEOUT
+    while True:
+        try:
+            pending.append((result, clients.rmq_publish_nowait(transaction_data)))
+            return
+        except clients.PublisherBusyError as e:
+            if pending:
+                await settle_published(*pending.popleft())
+            elif asyncio.get_running_loop().time() < deadline:
+                await asyncio.sleep(0.01)  # The in-flight messages belong to other requests
+            else:
+                result.update(status="failed", error=str(e))
+                return
+        except clients.PublishError as e:
+            result.update(status="failed", error=str(e))
+            return
+
+@app.post("/transactions/batch")
+async def create_transactions_batch(request: Request):
+    """
+    Bulk ingestion: publishes a JSON array, or NDJSON stream (Content-Type: application/x-ndjson),
+    of transactions. Items are validated and published independently, the response reports each one,
+    in order: published (with its transaction_id), invalid (unknown accounts included), failed, or unknown
+    (no broker confirm in time, it may be published).
+    Items may carry an `idempotency_key`, so a batch, or its unknown items, can be resent safely.
+    """
+    results = []
+    pending = collections.deque()  # (result, confirm future) of the published items
+    published_items = []  # (result, transaction_data)
+    async for item in read_batch_items(request):
+        index = len(results)
+        if index >= config.TRANSACTION_BATCH_MAX_ITEMS:
+            results.append({"index": index, "status": "invalid", "error": f"At most {config.TRANSACTION_BATCH_MAX_ITEMS} transactions per batch"})
+            break
+        if isinstance(item, ValueError):
+            results.append({"index": index, "status": "invalid", "error": f"Invalid JSON: {item}"})
+            continue
+        try:
+            transaction_request = BatchTransactionItem.model_validate(item)
+        except ValidationError as e:
+            results.append({"index": index, "status": "invalid", "error": json.loads(e.json(include_url=False))})
+            continue
+        if not await admit(transaction_request.account_id):
+            results.append({"index": index, "status": "invalid", "error": f"Account {transaction_request.account_id} not found"})
+            continue
+
+        transaction_data = build_transaction(transaction_request, transaction_request.idempotency_key)
+        result = {"index": index, "status": "published", "transaction_id": transaction_data["transaction_id"], "timestamp": transaction_data["timestamp"].isoformat()}
+        results.append(result)
+        published_items.append((result, transaction_data))
+        await publish_pipelined(transaction_data, result, pending)
+
+    await asyncio.gather(*(settle_published(result, confirm) for result, confirm in pending))
+    for result, transaction_data in published_items:
+        if result["status"] == "published":
+            mark_pending(transaction_data)
+
+    published = sum(1 for result in results if result["status"] == "published")
+    unknown = sum(1 for result in results if result["status"] == "unknown")
+    log.info(f"Published batch: {published}/{len(results)} transactions, {unknown} unknown")
+    return {"published": published, "failed": len(results) - published - unknown, "unknown": unknown, "results": results}
+
+
+# Final status of the transactions not known by this process (older, or published by another API process).
+# Rejected transactions are not stored, only their events tell about them.
+STATUS_QUERY = "SELECT transaction_id, account_id, status, timestamp FROM transactions WHERE transaction_id = %s"
+SSE_KEEPALIVE = 15  # seconds between SSE comments, so proxies don't close an idle stream
+
+async def read_status(transaction_id: str):
+    async with clients.mysql_client(STATUS_QUERY, (transaction_id,), readonly=True) as cursor:
+        result = await cursor.fetchone()
+    if result is None:
+        return None
+    status = {"transaction_id": result[0], "account_id": result[1], "status": result[2], "updated_at": result[3].isoformat()}
+    status_store.put(transaction_id, status)
+    return status
+
+async def wait_status(transaction_id: str, status: Optional[dict], timeout: float):
+    """Waits for the final status. On timeout the DB is read once, the event may have been missed."""
+    if status is not None and status["status"] in FINAL_STATUSES:
+        return status
+    final = await status_store.wait(transaction_id, timeout)
+    if final is not None:
+        return final
+    return await read_status(transaction_id) or status
+
+def sse_event(status: dict) -> str:
+    return f"event: status\ndata: {json.dumps(status)}\n\n"
+
+async def stream_status(transaction_id: str, status: Optional[dict]):
+    """Server-Sent Events: the current status (if known), then the final one, for up to TRANSACTION_STATUS_MAX_WAIT."""
+    if status is not None:
+        yield sse_event(status)
+    deadline = asyncio.get_running_loop().time() + config.TRANSACTION_STATUS_MAX_WAIT
+    while status is None or status["status"] not in FINAL_STATUSES:
+        remaining = deadline - asyncio.get_running_loop().time()
+        if remaining <= 0:
+            return
+        final = await status_store.wait(transaction_id, min(SSE_KEEPALIVE, remaining))
+        if final is None:
+            yield ": keepalive\n\n"
+            continue
+        status = final
+        yield sse_event(status)
+
+@app.get("/transactions/{transaction_id}")
+async def get_transaction_status(
+    transaction_id: str,
+    request: Request,
+    wait: float = Query(0, ge=0, le=config.TRANSACTION_STATUS_MAX_WAIT),
+):
+    """
+    Status of a transaction: pending (published, not processed yet), completed, rejected or failed.
+    Served from the statuses the workers publish, the DB is only read for the transactions this process doesn't know.
+    With `wait` (seconds), long-polls until the transaction has a final status.
+    With `Accept: text/event-stream`, streams the status changes as Server-Sent Events until the final one.
+    Only completed transactions are stored in the DB: rejected and failed ones are known from the worker events,
+    for TRANSACTION_STATUS_TTL seconds, by the API process that received them. Then they are 404, as unknown ids.
+    """
+    status = status_store.get(transaction_id)
+    if status is None:
+        status = await read_status(transaction_id)
+
+    if "text/event-stream" in request.headers.get("accept", ""):
+        return StreamingResponse(stream_status(transaction_id, status), media_type="text/event-stream")
+    if wait:
+        status = await wait_status(transaction_id, status, wait)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Transaction not found")
+    return status
+
+
+# Balance and its version (transaction_count), including the ledger entries after the snapshot in ledger mode
+BALANCE_QUERY = """
+    SELECT a.balance + COALESCE(SUM(e.amount), 0), a.transaction_count + COUNT(e.entry_id)
+    FROM accounts a
+    LEFT JOIN ledger_entries e ON e.account_id = a.account_id AND e.entry_id > a.ledger_entry_id
+    WHERE a.account_id = %s
+    GROUP BY a.account_id, a.balance, a.transaction_count
+"""
 
 @app.get("/accounts/{account_id}/balance")
 async def get_balance(account_id: str):
-    with clients.mysql_client("SELECT balance FROM accounts WHERE account_id = %s", (account_id,)) as cursor:
-        result = cursor.fetchone()
+    balance = balance_cache.get(account_id)
+    if balance is None:
+        read_at = time.monotonic()  # Not cached if the balance is invalidated during the read
+        async with clients.mysql_client(BALANCE_QUERY, (account_id,), readonly=True) as cursor:
+            result = await cursor.fetchone()
 
-    if result is None:
-        raise HTTPException(status_code=404, detail="Account not found")
+        if result is None:
+            raise HTTPException(status_code=404, detail="Account not found")
+        balance_cache.put(account_id, result[0], result[1], read_at)
+        balance = result[0]
 
-    balance = float(result[0])
+    balance = float(balance)
     log.info(f"Retrieved balance for account: {account_id}")
     return {"account_id": account_id, "balance": balance}
 
 
+# History of an account, keyset pagination on (timestamp, transaction_id), served by idx_account_history.
+# The older transactions are in the archive segments, the ones still in MySQL while being archived are skipped.
+HISTORY_QUERY = """
+    SELECT transaction_id, amount, transaction_type, status, timestamp
+    FROM transactions
+    WHERE account_id = %s{conditions}
+    ORDER BY timestamp, transaction_id
+"""
+HISTORY_AFTER = " AND (timestamp > %s OR (timestamp = %s AND transaction_id > %s))"
+HISTORY_HOT = " AND timestamp >= %s"
+ARCHIVE_CHUNK = 500  # archived rows read per thread hop, when streaming
+
+def encode_history_cursor(timestamp: datetime.datetime, transaction_id: str) -> str:
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{transaction_id}".encode()).decode()
+
+def decode_history_cursor(cursor: Optional[str]):
+    if cursor is None:
+        return None
+    try:
+        timestamp, transaction_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.datetime.fromisoformat(timestamp), transaction_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def history_query(account_id: str, after, archived_until):
+    conditions, params = "", (account_id,)
+    if archived_until is not None:
+        conditions, params = conditions + HISTORY_HOT, params + (archived_until,)
+    if after is not None:
+        timestamp, transaction_id = after
+        conditions, params = conditions + HISTORY_AFTER, params + (timestamp, timestamp, transaction_id)
+    return HISTORY_QUERY.format(conditions=conditions), params
+
+def in_archive(after, archived_until) -> bool:
+    """True if some archived transactions are after the cursor."""
+    return archived_until is not None and (after is None or after[0] < archived_until)
+
+def history_item(row):
+    return {
+        "transaction_id": row[0],
+        "amount": float(row[1]),
+        "type": row[2],
+        "status": row[3],
+        "timestamp": row[4].isoformat(),
+    }
+
+async def stream_transactions(account_id: str, after, archived_until):
+    if in_archive(after, archived_until):
+        rows = archive.history(account_id, after)
+        while chunk := await asyncio.to_thread(list, itertools.islice(rows, ARCHIVE_CHUNK)):
+            for row in chunk:
+                yield json.dumps(history_item(row)) + "\n"
+    async for row in clients.mysql_stream(*history_query(account_id, after, archived_until)):
+        yield json.dumps(history_item(row)) + "\n"
+
 @app.get("/accounts/{account_id}/transactions")
-async def get_transactions(account_id: str):
-    with clients.mysql_client(
-        "SELECT transaction_id, amount, transaction_type, status FROM transactions WHERE account_id = %s",
-        (account_id,),
-    ) as cursor:
-        results = cursor.fetchall()
-
-    if not results:
+async def get_transactions(
+    account_id: str,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    stream: bool = False,
+):
+    """
+    Transactions of the account, oldest first, `limit` per page. The cursor of the next page is returned
+    in the X-Next-Cursor header. With `stream`, all the transactions after `cursor` are streamed as NDJSON.
+    Archived transactions are read from the archive segments, then the recent ones from MySQL.
+    """
+    after = decode_history_cursor(cursor)
+    archived_until = await asyncio.to_thread(archive.archived_until)
+    if stream:
+        log.info(f"Streaming transactions for account: {account_id}")
+        return StreamingResponse(stream_transactions(account_id, after, archived_until), media_type="application/x-ndjson")
+
+    results = []
+    if in_archive(after, archived_until):
+        results = await asyncio.to_thread(lambda: list(itertools.islice(archive.history(account_id, after), limit)))
+    if len(results) < limit:
+        query, params = history_query(account_id, after, archived_until)
+        async with clients.mysql_client(query + " LIMIT %s", params + (limit - len(results),), readonly=True) as db_cursor:
+            results += await db_cursor.fetchall()
+
+    if not results and cursor is None:
         raise HTTPException(status_code=404, detail="No transactions found")
 
-    transactions = []
-    for row in results:
-        transactions.append({
-            "transaction_id": row[0],
-            "amount": float(row[1]),
-            "type": row[2],
-            "status": row[3]
-        })
+    transactions = [history_item(row) for row in results]
+    if len(results) == limit:
+        response.headers["X-Next-Cursor"] = encode_history_cursor(results[-1][4], results[-1][0])
     log.info(f"Got transactions for account: {account_id}")
     return transactions
+
+
+def server_time(value: Optional[datetime.datetime]):
+    """
+    A query parameter in the time convention of the stored timestamps, naive local time (as datetime.now()).
+    Bounds with a timezone (Z, +02:00) are converted, naive ones are taken as local time already.
+    """
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone().replace(tzinfo=None)
+
+def statement_range(month: Optional[str], start: Optional[datetime.datetime], end: Optional[datetime.datetime]):
+    """[start, end) of a statement: a calendar month (YYYY-MM), or explicit bounds."""
+    start, end = server_time(start), server_time(end)
+    if month is not None:
+        try:
+            start = datetime.datetime.strptime(month, "%Y-%m")
+        except ValueError:
+            raise HTTPException(status_code=400, detail="month must be YYYY-MM")
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+    if start is None or end is None:
+        raise HTTPException(status_code=400, detail="Either month, or start and end are required")
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    return start, end
+
+@app.get("/statements")
+async def export_statement(
+    account_id: Optional[str] = None,
+    month: Optional[str] = None,
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    gzip: bool = False,
+    cursor: Optional[str] = None,
+):
+    """
+    Statement of an account, or of all the accounts: the transactions of a month (or [start, end)), ordered by
+    account, timestamp and transaction id, streamed as CSV or NDJSON, gzipped with `gzip`.
+    An interrupted export resumes after the last row received, with `cursor` (see statements.encode_cursor).
+    """
+    start, end = statement_range(month, start, end)
+    try:
+        after = statements.decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    formatter, media_type = statements.FORMATS[format]
+    rows = await asyncio.to_thread(statements.statement_rows, archive, start, end, account_id, after)
+    chunks = formatter(rows)
+    filename = f"statement-{account_id or 'all'}-{start.date()}.{format}"
+    if gzip:
+        chunks, media_type, filename = statements.gzip_chunks(chunks), "application/gzip", filename + ".gz"
+
+    log.info(f"Exporting statement of {account_id or 'all accounts'} from {start} to {end}")
+    return StreamingResponse(chunks, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
@@ -0,0 +1,19 @@
+"""
+Prometheus metrics of the API, served on GET /metrics.
+"""
+from prometheus_client import Counter, Histogram
+
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+
+PUBLISH_SECONDS = Histogram(
+    "api_publish_seconds", "Time from publish until the broker confirm, by outcome (confirmed, failed, timeout)",
+    ["outcome"], buckets=LATENCY_BUCKETS,
+)
+PUBLISH_BUSY = Counter("api_publish_busy_total", "Publishes refused, too many messages waiting for a broker confirm")
+DB_CONNECTION_WAIT = Histogram(
+    "api_db_connection_wait_seconds", "Time waiting for a pooled MySQL connection, by pool (primary, replica)",
+    ["pool"], buckets=LATENCY_BUCKETS,
+)
+UNKNOWN_ACCOUNT = Counter(
+    "api_unknown_account_total", "Transactions of accounts that don't exist, by admission mode (reject, flag)", ["mode"]
+)
@@ -0,0 +1,26 @@
+import zlib
+
+
+"""
+Account-affinity routing: transactions are published to a direct exchange, with the account partition
+as routing key, so all the transactions of an account land in the same partition queue.
+Must match worker/app/partitioning.py.
+"""
+
+def partition_for(account_id: str, partitions: int) -> int:
+    return zlib.crc32(account_id.encode()) % partitions
+
+def partition_queue(exchange: str, partition: int) -> str:
+    return f"{exchange}.{partition}"
+
+def topology(exchange: str, partitions: int) -> list:
+    """
+    Declarations for the partitioned exchange and queues, as (channel method, kwargs).
+    Single active consumer makes sure only one worker at a time processes a partition.
+    """
+    steps = [("exchange_declare", {"exchange": exchange, "exchange_type": "direct"})]
+    for partition in range(partitions):
+        queue = partition_queue(exchange, partition)
+        steps.append(("queue_declare", {"queue": queue, "arguments": {"x-single-active-consumer": True}}))
+        steps.append(("queue_bind", {"queue": queue, "exchange": exchange, "routing_key": str(partition)}))
+    return steps
@@ -0,0 +1,284 @@
+import collections
+import concurrent.futures
+import functools
+import logging
+import threading
+import pika
+import pika.exceptions
+import pika.spec
+
+
+log = logging.getLogger(__name__)
+
+
+class PublishError(Exception):
+    """
+    Message could not be published: nacked by the broker, or the publisher was stopped.
+    """
+    pass
+
+
+class PublisherBusyError(PublishError):
+    """
+    Too many messages are waiting for a broker confirm (backpressure), caller should retry later.
+    """
+    pass
+
+
+class _PooledChannel:
+    """
+    A confirm-enabled channel, with the messages waiting for a confirm, keyed by delivery tag.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self.delivery_tag = 0
+        self.pending = collections.OrderedDict()
+        self.ready = False
+
+
+class TransactionPublisher:
+    """
+    Long lived RabbitMQ publisher, shared by all the requests of the API process.
+
+    A background thread owns one SelectConnection with a pool of confirm-enabled channels.
+    publish() is thread safe and returns a Future, resolved when the broker confirms the message.
+    Confirms are handled asynchronously, the broker acks them in batches (multiple=True).
+
+    - Reconnect: messages not confirmed when the connection drops are published again once we
+      reconnect (at-least-once, the worker de-duplicates by transaction_id).
+    - Backpressure: at most `max_in_flight` messages can wait for a confirm, publish() refuses
+      (PublisherBusyError) or blocks, when the broker does not keep up.
+    """
+    def __init__(self, host, queue, credentials=None, topology=None, pool_size=4, max_in_flight=1000,
+                 publish_timeout=5.0, reconnect_delay=1.0):
+        self.queue = queue  # Default routing key
+        self.topology = topology or [("queue_declare", {"queue": queue})]  # (channel method, kwargs) declared on connect
+        self.pool_size = pool_size
+        self.max_in_flight = max_in_flight
+        self.publish_timeout = publish_timeout
+        self.reconnect_delay = reconnect_delay
+        self.parameters = pika.ConnectionParameters(host=host, credentials=credentials or pika.ConnectionParameters.DEFAULT_CREDENTIALS)
+
+        self._outbox = collections.deque()  # (exchange, routing_key, body, properties, future)
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._channels = []
+        self._next_channel = 0
+        self._connection = None
+        self._drain_scheduled = False
+        self._stopping = threading.Event()
+        self._thread = None
+
+    # Public API, called from any thread
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="rmq-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stopping.set()
+        connection = self._connection
+        if connection is not None:
+            try:
+                connection.ioloop.add_callback_threadsafe(self._close)
+            except Exception as e:  # ioloop already gone
+                log.debug(f"Publisher ioloop already closed: {e}")
+        if self._thread:
+            self._thread.join(timeout)
+
+        while self._outbox:
+            future = self._outbox.popleft()[-1]
+            if not future.done():
+                future.set_exception(PublishError("Publisher stopped"))
+
+    def publish(self, body, routing_key=None, exchange="", properties=None, block=True):
+        """
+        Queues the message for publishing and returns a concurrent Future, resolved on broker confirm.
+        Raises PublisherBusyError if there is no free in-flight slot (immediately, or after
+        publish_timeout if `block`).
+        """
+        if self._stopping.is_set():
+            raise PublishError("Publisher is stopped")
+        acquired = self._slots.acquire(timeout=self.publish_timeout) if block else self._slots.acquire(blocking=False)
+        if not acquired:
+            raise PublisherBusyError(f"More than {self.max_in_flight} messages waiting for broker confirm")
+
+        future = concurrent.futures.Future()
+        future.add_done_callback(lambda _: self._slots.release())
+        self._outbox.append((exchange, routing_key or self.queue, body, properties, future))
+        self._wakeup()
+        return future
+
+    def _wakeup(self):
+        connection = self._connection
+        if connection is None or self._drain_scheduled:
+            return  # Will be drained when the channels are (re)opened, or by the scheduled drain
+        self._drain_scheduled = True
+        try:
+            connection.ioloop.add_callback_threadsafe(self._drain)
+        except Exception:
+            self._drain_scheduled = False  # Connection is going away, outbox is drained on reconnect
+
+    # Everything below runs in the publisher thread
+    def _run(self):
+        while not self._stopping.is_set():
+            log.info(f"Publisher connecting to RabbitMQ at {self.parameters.host}")
+            self._connection = pika.SelectConnection(
+                self.parameters,
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_error,
+                on_close_callback=self._on_connection_closed,
+            )
+            self._connection.ioloop.start()
+
+            self._connection = None
+            for pooled in self._channels:
+                self._recycle(pooled)
+            self._channels = []
+            if not self._stopping.is_set():
+                log.warning(f"Publisher disconnected, reconnecting in {self.reconnect_delay}s")
+                self._stopping.wait(self.reconnect_delay)
+
+    def _close(self):
+        connection = self._connection
+        try:
+            connection.close()
+        except pika.exceptions.ConnectionWrongStateError:
+            connection.ioloop.stop()
+
+    def _on_connection_open(self, connection):
+        log.info(f"Publisher connected, opening {self.pool_size} channels")
+        for _ in range(self.pool_size):
+            connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_error(self, connection, error):
+        log.error(f"Publisher could not connect to RabbitMQ: {error}")
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        if not self._stopping.is_set():
+            log.warning(f"Publisher connection closed: {reason}")
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        pooled = _PooledChannel(channel)
+        self._channels.append(pooled)
+        channel.add_on_close_callback(functools.partial(self._on_channel_closed, pooled))
+        channel.confirm_delivery(
+            ack_nack_callback=functools.partial(self._on_confirm, pooled),
+            callback=lambda _: self._declare(pooled, self.topology),
+        )
+
+    def _declare(self, pooled, steps):
+        """Declares the topology, one step after the other, then marks the channel as ready."""
+        if not steps:
+            return self._on_channel_ready(pooled)
+        method, kwargs = steps[0]
+        getattr(pooled.channel, method)(callback=lambda _: self._declare(pooled, steps[1:]), **kwargs)
+
+    def _on_channel_ready(self, pooled):
+        pooled.ready = True
+        self._drain_scheduled = False
+        self._drain()
+
+    def _on_channel_closed(self, pooled, channel, reason):
+        pooled.ready = False
+        self._recycle(pooled)
+        if pooled in self._channels:
+            self._channels.remove(pooled)
+
+        connection = self._connection
+        if connection is not None and connection.is_open and not self._stopping.is_set():
+            log.warning(f"Publisher channel closed: {reason}, reopening")
+            connection.ioloop.call_later(self.reconnect_delay, self._reopen_channel)
+
+    def _reopen_channel(self):
+        connection = self._connection
+        if connection is not None and connection.is_open:
+            connection.channel(on_open_callback=self._on_channel_open)
+
+    def _recycle(self, pooled):
+        """Moves the unconfirmed messages of a channel back to the head of the outbox."""
+        self._outbox.extendleft(reversed(list(pooled.pending.values())))
+        pooled.pending.clear()
+
+    def _drain(self):
+        self._drain_scheduled = False
+        channels = [pooled for pooled in self._channels if pooled.ready]
+        if not channels:
+            return
+
+        while self._outbox:
+            message = self._outbox.popleft()
+            exchange, routing_key, body, properties, future = message
+            if future.done():  # Cancelled by the caller (timeout)
+                continue
+
+            pooled = channels[self._next_channel % len(channels)]
+            self._next_channel += 1
+            try:
+                pooled.channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+            except Exception as e:  # Channel or connection closing, retried when reopened
+                log.warning(f"Publish failed, will retry after reconnect: {e}")
+                self._outbox.appendleft(message)
+                return
+            pooled.delivery_tag += 1
+            pooled.pending[pooled.delivery_tag] = message
+
+    def _on_confirm(self, pooled, frame):
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+
+        if method.multiple:
+            confirmed = []
+            while pooled.pending and next(iter(pooled.pending)) <= method.delivery_tag:
+                confirmed.append(pooled.pending.popitem(last=False)[1])
+        else:
+            message = pooled.pending.pop(method.delivery_tag, None)
+            confirmed = [message] if message else []
+
+        for message in confirmed:
+            future = message[-1]
+            if future.done():
+                continue
+            if acked:
+                future.set_result(None)
+            else:
+                future.set_exception(PublishError("Message nacked by the broker"))
+
+
+class MemoryPublisher:
+    """
+    In-process stand-in of TransactionPublisher (RABBITMQ_BROKER=memory), to run or benchmark the API without RabbitMQ.
+
+    Messages are confirmed right away, and kept by (exchange, routing key), the last `max_messages` of each.
+    The events exchange has no queue: its messages are handed to `on_event` (the event subscriber), in the caller thread.
+    """
+    def __init__(self, queue, events_exchange=None, on_event=None, max_messages=100000):
+        self.queue = queue  # Default routing key
+        self.events_exchange = events_exchange
+        self.on_event = on_event
+        self.max_messages = max_messages
+        self.messages = {}  # (exchange, routing_key) -> deque of (body, properties)
+        self._lock = threading.Lock()
+
+    def start(self):
+        pass
+
+    def stop(self, timeout=5.0):
+        pass
+
+    def publish(self, body, routing_key=None, exchange="", properties=None, block=True):
+        """Same interface as TransactionPublisher.publish, the returned Future is already resolved."""
+        if exchange == self.events_exchange and self.on_event is not None:
+            self.on_event(body)
+        else:
+            with self._lock:
+                key = (exchange, routing_key or self.queue)
+                if key not in self.messages:
+                    self.messages[key] = collections.deque(maxlen=self.max_messages)
+                self.messages[key].append((body, properties))
+        future = concurrent.futures.Future()
+        future.set_result(None)
+        return future
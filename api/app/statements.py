@@ -0,0 +1,144 @@
+import asyncio
+import base64
+import csv
+import datetime
+import io
+import itertools
+import json
+import zlib
+import clients
+
+
+"""
+Statement export: the transactions of a date range, of one account or all of them, as CSV or NDJSON,
+optionally gzipped, streamed through a pipeline of async generators:
+
+    archive segments + MySQL pages -> merged rows -> CSV/NDJSON chunks -> gzip chunks
+
+MySQL is read in keyset pages of PAGE_SIZE rows (an unbuffered cursor each), so each query is short, and does
+not hold a snapshot for the whole export. Rows are ordered by (account_id, timestamp, transaction_id), a statement
+can be resumed after any row with its cursor (encode_cursor). The account ids are expected to sort the same
+in Python and MySQL (the archive and MySQL rows are merged), as the ids used here do.
+"""
+
+COLUMNS = ["account_id", "transaction_id", "timestamp", "type", "amount", "status", "details"]
+PAGE_SIZE = 10000  # rows per MySQL query
+ARCHIVE_CHUNK = 500  # archived rows read per thread hop
+OUTPUT_CHUNK = 64 * 1024  # bytes buffered before sending
+
+STATEMENT_QUERY = """
+    SELECT account_id, transaction_id, timestamp, transaction_type, amount, status, details
+    FROM transactions
+    WHERE timestamp >= %s AND timestamp < %s{conditions}
+    ORDER BY account_id, timestamp, transaction_id
+    LIMIT %s
+"""
+STATEMENT_ACCOUNT = " AND account_id = %s"
+STATEMENT_AFTER = " AND (account_id, timestamp, transaction_id) > (%s, %s, %s)"
+
+
+def row_key(row):
+    return row[0], row[2], row[1]
+
+def encode_cursor(row) -> str:
+    """Cursor of a statement row, the export resumes after it."""
+    account_id, timestamp, transaction_id = row_key(row)
+    return base64.urlsafe_b64encode(json.dumps([account_id, timestamp.isoformat(), transaction_id]).encode()).decode()
+
+def decode_cursor(cursor: str):
+    """Raises ValueError if the cursor is invalid."""
+    account_id, timestamp, transaction_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return account_id, datetime.datetime.fromisoformat(timestamp), transaction_id
+
+
+async def db_rows(start, end, account_id=None, after=None):
+    """Yields the MySQL rows of the statement, one keyset page (query) at a time."""
+    while True:
+        conditions, params = "", (start, end)
+        if account_id is not None:
+            conditions, params = conditions + STATEMENT_ACCOUNT, params + (account_id,)
+        if after is not None:
+            conditions, params = conditions + STATEMENT_AFTER, params + after
+        rows = 0
+        async for row in clients.mysql_stream(STATEMENT_QUERY.format(conditions=conditions), params + (PAGE_SIZE,)):
+            rows += 1
+            after = row_key(row)
+            yield row
+        if rows < PAGE_SIZE:
+            return
+
+async def archived_rows(archive, start, end, account_id=None, after=None):
+    """Yields the archived rows of the statement, read (and decompressed) in a thread."""
+    rows = archive.statement(start, end, account_id, after)
+    while chunk := await asyncio.to_thread(list, itertools.islice(rows, ARCHIVE_CHUNK)):
+        for row in chunk:
+            yield row
+
+async def merge_rows(first, second):
+    """Merges two async iterators of rows, each ordered by row_key."""
+    heads = [await anext(first, None), await anext(second, None)]
+    iterators = [first, second]
+    while heads[0] is not None or heads[1] is not None:
+        if heads[1] is None or (heads[0] is not None and row_key(heads[0]) <= row_key(heads[1])):
+            i = 0
+        else:
+            i = 1
+        yield heads[i]
+        heads[i] = await anext(iterators[i], None)
+
+def statement_rows(archive, start, end, account_id=None, after=None):
+    """
+    The rows of the statement: archived ones (before the archive horizon) and the ones still in MySQL (after it),
+    the rows of the partitions being archived are only read from the archive.
+    """
+    archived_until = archive.archived_until()
+    if archived_until is None or archived_until <= start:
+        return db_rows(start, end, account_id, after)
+    if archived_until >= end:
+        return archived_rows(archive, start, end, account_id, after)
+    return merge_rows(
+        archived_rows(archive, start, archived_until, account_id, after),
+        db_rows(archived_until, end, account_id, after),
+    )
+
+
+def values(row):
+    account_id, transaction_id, timestamp, transaction_type, amount, status, details = row
+    return [account_id, transaction_id, timestamp.isoformat(), transaction_type, str(amount), status, details or ""]
+
+async def csv_chunks(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    async for row in rows:
+        writer.writerow(values(row))
+        if buffer.tell() >= OUTPUT_CHUNK:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+async def ndjson_chunks(rows):
+    buffer = []
+    size = 0
+    async for row in rows:
+        line = json.dumps(dict(zip(COLUMNS, values(row)))) + "\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= OUTPUT_CHUNK:
+            yield "".join(buffer).encode()
+            buffer, size = [], 0
+    yield "".join(buffer).encode()
+
+async def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+FORMATS = {
+    "csv": (csv_chunks, "text/csv"),
+    "ndjson": (ndjson_chunks, "application/x-ndjson"),
+}
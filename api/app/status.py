@@ -0,0 +1,78 @@
+import asyncio
+import collections
+import threading
+import time
+
+
+FINAL_STATUSES = ("completed", "rejected", "failed")
+
+
+class TransactionStatusStore:
+    """
+    In-process LRU store of the recent transaction statuses, bounded in size, with a TTL. Published transactions
+    are "pending", the worker events set their final status: completed, rejected or failed.
+
+    Requests can wait for the final status of a transaction: events are handled in the subscriber thread,
+    and wake up the waiters in their event loop. A final status is never replaced, neither by "pending" (late publish
+    answer) nor by another final one (a late event, e.g. of a redelivery): the first final status wins.
+    """
+    def __init__(self, max_size=100000, ttl=600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # transaction_id -> (status, expires)
+        self._waiters = {}  # transaction_id -> [(loop, future)]
+        self._lock = threading.Lock()
+
+    def _get(self, transaction_id):
+        entry = self._entries.get(transaction_id)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            del self._entries[transaction_id]
+            return None
+        return entry[0]
+
+    def get(self, transaction_id):
+        with self._lock:
+            return self._get(transaction_id)
+
+    def put(self, transaction_id, status: dict):
+        final = status["status"] in FINAL_STATUSES
+        with self._lock:
+            current = self._get(transaction_id)
+            if current is not None and current["status"] in FINAL_STATUSES:
+                return  # First final status wins
+            self._entries[transaction_id] = (status, time.monotonic() + self.ttl)
+            self._entries.move_to_end(transaction_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            waiters = self._waiters.pop(transaction_id, []) if final else []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self._resolve, future, status)
+
+    @staticmethod
+    def _resolve(future, status):
+        if not future.done():
+            future.set_result(status)
+
+    async def wait(self, transaction_id, timeout):
+        """Returns the final status of the transaction, waiting up to `timeout` seconds for it. None on timeout."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        with self._lock:
+            status = self._get(transaction_id)
+            if status is not None and status["status"] in FINAL_STATUSES:
+                return status
+            self._waiters.setdefault(transaction_id, []).append(waiter)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except TimeoutError:
+            return None
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(transaction_id)
+                if waiters and waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self._waiters[transaction_id]
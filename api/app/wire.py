@@ -0,0 +1,69 @@
+"""
+Wire format of the queued transactions, version 2. The worker has the decoding side (worker/app/wire.py).
+
+Amounts are exact fixed-point integers, in minor units (cents, the DECIMAL(15, 2) of the DB), and timestamps
+are integer microseconds since the epoch. The encoding is given by the AMQP content type:
+
+- JSON_V2: a JSON object, with the `v` version field. The field names differ from the version 1 format
+  (float amount, ISO timestamp), so an old decoder fails instead of reading cents as units.
+- BINARY_V2: fixed size header (struct BINARY_HEADER), followed by the utf-8 account_id and details.
+"""
+import datetime
+import json
+import struct
+import uuid
+from decimal import Decimal
+
+VERSION = 2
+JSON_V2 = "application/vnd.transaction.v2+json"
+BINARY_V2 = "application/vnd.transaction.v2+binary"
+
+AMOUNT_SCALE = 2  # Decimal places of the amounts, the minor units
+TRANSACTION_TYPES = {"deposit": 1, "withdrawal": 2, "payment": 3}  # Binary codes, 0 is an unknown type
+
+# version, transaction type, transaction_id (uuid), amount (minor units), timestamp (epoch us),
+# account_id length, details length
+BINARY_HEADER = struct.Struct("<BB16sqqHI")
+
+
+def to_minor_units(amount: Decimal) -> int:
+    minor = amount.scaleb(AMOUNT_SCALE)
+    if minor != minor.to_integral_value():
+        raise ValueError(f"Amount {amount} has more than {AMOUNT_SCALE} decimal places")
+    return int(minor)
+
+def to_epoch_us(timestamp: datetime.datetime) -> int:
+    """Exact, the float timestamp is only used for whole seconds."""
+    return int(timestamp.replace(microsecond=0).timestamp()) * 1_000_000 + timestamp.microsecond
+
+
+def encode(transaction_data: dict, binary: bool = False):
+    """
+    Returns (body, content type) of a transaction: amount is a Decimal, timestamp a (local time) datetime.
+    The binary encoding requires a uuid transaction_id, the ones generated by the API.
+    """
+    amount = to_minor_units(transaction_data["amount"])
+    timestamp = to_epoch_us(transaction_data["timestamp"])
+    if not binary:
+        return json.dumps({
+            "v": VERSION,
+            "transaction_id": transaction_data["transaction_id"],
+            "account_id": transaction_data["account_id"],
+            "transaction_type": transaction_data["transaction_type"],
+            "amount_minor": amount,
+            "ts_us": timestamp,
+            "details": transaction_data["details"],
+        }).encode(), JSON_V2
+
+    account_id = transaction_data["account_id"].encode()
+    details = transaction_data["details"].encode()
+    header = BINARY_HEADER.pack(
+        VERSION,
+        TRANSACTION_TYPES.get(transaction_data["transaction_type"], 0),
+        uuid.UUID(transaction_data["transaction_id"]).bytes,
+        amount,
+        timestamp,
+        len(account_id),
+        len(details),
+    )
+    return header + account_id + details, BINARY_V2
@@ -0,0 +1,305 @@
+"""
+Load generator and end-to-end latency benchmark.
+
+Sends transactions to the API with an open-loop schedule (at a target rate, whether or not the previous
+requests completed), and listens to the worker events to measure when each transaction is committed.
+
+- ingest latency: from the scheduled send time until the API answers (the transaction is published),
+  measured from the schedule so a slow API is not hidden by a slower send rate (coordinated omission).
+- end-to-end latency: from the API `timestamp` of the transaction until the worker commits it
+  (`committed_at` of the balance_changed event), both taken on the server side.
+
+Writes a JSON report, that can be compared with the report of a previous run:
+    python bench_transactions.py --rate 200 --duration 30 --output run.json
+    python bench_transactions.py --rate 200 --duration 30 --compare run.json
+
+Runs against docker compose (defaults) or the API/worker started locally, see README "Debug, run locally".
+Requires: pip install aiohttp aio-pika
+"""
+import argparse
+import asyncio
+import bisect
+import datetime
+import json
+import logging
+import math
+import os
+import platform
+import random
+import string
+import time
+import aiohttp
+import aio_pika
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+log = logging.getLogger(__name__)
+
+API_URL = os.environ.get("API_URL", "http://localhost:8000")
+RABBITMQ_HOST = os.environ.get("RABBITMQ_HOST", "localhost")
+RABBITMQ_USER = os.environ.get("RABBITMQ_USER", "guest")
+RABBITMQ_PASSWORD = os.environ.get("RABBITMQ_PASSWORD", "guest")
+RABBITMQ_EVENTS_EXCHANGE = os.environ.get("RABBITMQ_EVENTS_EXCHANGE", "transaction_events")
+TRANSACTION_TYPES = ["deposit", "withdrawal", "payment"]
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+class LatencyHistogram:
+    """
+    Log-linear histogram of latencies (seconds): 16 sub-buckets per power of two, ~6% precision,
+    constant memory whatever the number of samples.
+    """
+    SUB_BUCKETS = 16
+    MIN_LATENCY = 1e-5  # Everything below is counted in the first bucket
+
+    def __init__(self):
+        self.buckets = {}  # bucket index -> count
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def bucket(self, latency):
+        return max(0, int(math.log2(max(latency, self.MIN_LATENCY) / self.MIN_LATENCY) * self.SUB_BUCKETS))
+
+    def upper_bound(self, bucket):
+        return self.MIN_LATENCY * 2 ** ((bucket + 1) / self.SUB_BUCKETS)
+
+    def record(self, latency):
+        bucket = self.bucket(latency)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def percentile(self, percentile):
+        if not self.count:
+            return None
+        rank = math.ceil(self.count * percentile / 100)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.upper_bound(bucket), self.max)
+        return self.max
+
+    def summary(self):
+        """Milliseconds, the bucket upper bounds let the histograms be re-aggregated or plotted."""
+        ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+        return {
+            "count": self.count,
+            "mean_ms": ms(self.total / self.count) if self.count else None,
+            "max_ms": ms(self.max),
+            **{f"p{percentile}_ms": ms(self.percentile(percentile)) for percentile in PERCENTILES},
+            "buckets": [[ms(self.upper_bound(bucket)), self.buckets[bucket]] for bucket in sorted(self.buckets)],
+        }
+
+
+class AccountPicker:
+    """
+    Picks accounts with a Zipf distribution: the account of rank k gets a weight 1/k^skew.
+    skew=0 is uniform, skew>=1 concentrates the load on a few hot accounts.
+    """
+    def __init__(self, account_ids, skew):
+        self.account_ids = account_ids
+        weights = [1 / (rank ** skew) for rank in range(1, len(account_ids) + 1)]
+        total = sum(weights)
+        self.cum_weights = []
+        cumulated = 0.0
+        for weight in weights:
+            cumulated += weight / total
+            self.cum_weights.append(cumulated)
+
+    def pick(self):
+        index = bisect.bisect_left(self.cum_weights, random.random())
+        return self.account_ids[min(index, len(self.account_ids) - 1)]
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.accounts = AccountPicker([f"{args.account_prefix}{i}" for i in range(args.accounts)], args.skew)
+        self.ingest = LatencyHistogram()
+        self.end_to_end = LatencyHistogram()
+        self.sent = 0
+        self.dropped = 0  # Not sent, `concurrency` requests were already outstanding
+        self.errors = {}  # HTTP status (or exception name) -> count
+        self.published = {}  # transaction_id -> API timestamp, waiting for the commit event
+        self.committed = {}  # transaction_id -> committed_at, commit event received before the API answered
+        self.in_flight = 0
+
+    async def create_accounts(self, session):
+        log.info(f"Creating {self.args.accounts} accounts")
+        for account_id in self.accounts.account_ids:
+            payload = {"account_id": account_id, "initial_balance": str(self.args.initial_balance)}
+            async with session.post(f"{self.args.api}/accounts", json=payload) as response:
+                if response.status not in (201, 500):  # 500: already exists, from a previous run
+                    log.warning(f"Creating account {account_id}: HTTP {response.status}")
+
+    def on_event(self, body):
+        event = json.loads(body)
+        if event.get("event") not in ("balance_changed", "balance_invalidated") or "committed_at" not in event:
+            return
+        committed_at = datetime.datetime.fromisoformat(event["committed_at"])
+        for transaction_id in event["transaction_ids"]:
+            timestamp = self.published.pop(transaction_id, None)
+            if timestamp is None:
+                self.committed[transaction_id] = committed_at
+            else:
+                self.end_to_end.record((committed_at - timestamp).total_seconds())
+
+    def on_published(self, transaction_id, timestamp):
+        timestamp = datetime.datetime.fromisoformat(timestamp)
+        committed_at = self.committed.pop(transaction_id, None)
+        if committed_at is None:
+            self.published[transaction_id] = timestamp
+        else:
+            self.end_to_end.record((committed_at - timestamp).total_seconds())
+
+    def new_transaction(self):
+        return {
+            "account_id": self.accounts.pick(),
+            "transaction_type": random.choice(TRANSACTION_TYPES),
+            "amount": str(random.randint(1, 1000)),
+            "details": ''.join(random.choice(string.ascii_letters) for _ in range(20)),
+        }
+
+    async def send(self, session, scheduled):
+        self.in_flight += 1
+        try:
+            async with session.post(f"{self.args.api}/transactions", json=self.new_transaction()) as response:
+                body = await response.json(content_type=None)
+                self.ingest.record(time.perf_counter() - scheduled)
+                if response.status != 200:
+                    self.errors[str(response.status)] = self.errors.get(str(response.status), 0) + 1
+                    return
+            self.on_published(body["transaction_id"], body["timestamp"])
+        except Exception as e:
+            self.errors[type(e).__name__] = self.errors.get(type(e).__name__, 0) + 1
+        finally:
+            self.in_flight -= 1
+
+    async def generate_load(self, session):
+        """Open loop: request i is scheduled at start + i/rate (or Poisson arrivals), independently of the responses."""
+        tasks = set()
+        start = time.perf_counter()
+        scheduled = start
+        while scheduled - start < self.args.duration:
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self.in_flight >= self.args.concurrency:
+                self.dropped += 1
+            else:
+                self.sent += 1
+                task = asyncio.create_task(self.send(session, scheduled))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            scheduled += random.expovariate(self.args.rate) if self.args.poisson else 1 / self.args.rate
+        if tasks:
+            await asyncio.wait(tasks)
+        return time.perf_counter() - start
+
+    async def wait_commits(self):
+        """Waits for the commit events of the published transactions, until none arrived for `drain` seconds."""
+        remaining = len(self.published)
+        while self.published:
+            await asyncio.sleep(self.args.drain)
+            if len(self.published) == remaining:
+                break
+            remaining = len(self.published)
+
+    async def run(self):
+        connection = await aio_pika.connect_robust(host=self.args.rabbitmq_host, login=RABBITMQ_USER, password=RABBITMQ_PASSWORD)
+        try:
+            channel = await connection.channel()
+            exchange = await channel.declare_exchange(RABBITMQ_EVENTS_EXCHANGE, aio_pika.ExchangeType.FANOUT)
+            queue = await channel.declare_queue(exclusive=True)
+            await queue.bind(exchange)
+            await queue.consume(lambda message: self.on_event(message.body), no_ack=True)
+
+            connector = aiohttp.TCPConnector(limit=self.args.concurrency)
+            async with aiohttp.ClientSession(connector=connector) as session:
+                if self.args.create_accounts:
+                    await self.create_accounts(session)
+                log.info(f"Sending {self.args.rate} transactions/s for {self.args.duration}s, up to {self.args.concurrency} in flight")
+                elapsed = await self.generate_load(session)
+            log.info(f"Waiting for the commit of {len(self.published)} transactions")
+            await self.wait_commits()
+        finally:
+            await connection.close()
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        return {
+            "started_at": datetime.datetime.now().isoformat(),
+            "host": platform.node(),
+            "config": {
+                "rate": self.args.rate,
+                "duration": self.args.duration,
+                "concurrency": self.args.concurrency,
+                "accounts": self.args.accounts,
+                "skew": self.args.skew,
+                "poisson": self.args.poisson,
+            },
+            "elapsed_s": round(elapsed, 3),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "achieved_rate": round(self.ingest.count / elapsed, 1) if elapsed else None,
+            "ingest": self.ingest.summary(),
+            "end_to_end": self.end_to_end.summary(),
+            "not_committed": len(self.published),  # Rejected, sent to the error queue, or still in the queues
+        }
+
+
+COMPARED_METRICS = [
+    ("achieved_rate", ("achieved_rate",)),
+    ("dropped", ("dropped",)),
+    ("not_committed", ("not_committed",)),
+    *((f"ingest p{p}_ms", ("ingest", f"p{p}_ms")) for p in PERCENTILES),
+    *((f"end_to_end p{p}_ms", ("end_to_end", f"p{p}_ms")) for p in PERCENTILES),
+]
+
+def compare(baseline, report):
+    """Logs the key metrics of both runs, with the relative change."""
+    log.info(f"{'metric':<24}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, path in COMPARED_METRICS:
+        before, after = baseline, report
+        for key in path:
+            before, after = (before or {}).get(key), (after or {}).get(key)
+        change = f"{(after - before) / before * 100:+.1f}%" if before and after is not None else ""
+        log.info(f"{name:<24}{str(before):>12}{str(after):>12}{change:>10}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--api", default=API_URL, help="API base url")
+    parser.add_argument("--rabbitmq-host", default=RABBITMQ_HOST, help="Broker of the worker events")
+    parser.add_argument("--rate", type=float, default=100, help="Target transactions per second")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of load")
+    parser.add_argument("--concurrency", type=int, default=100, help="Max outstanding requests, above it requests are dropped")
+    parser.add_argument("--poisson", action="store_true", help="Poisson arrivals instead of a constant rate")
+    parser.add_argument("--accounts", type=int, default=100, help="Number of accounts")
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent of the account popularity, 0 is uniform")
+    parser.add_argument("--account-prefix", default="bench-")
+    parser.add_argument("--initial-balance", type=int, default=1_000_000)
+    parser.add_argument("--no-create-accounts", dest="create_accounts", action="store_false")
+    parser.add_argument("--drain", type=float, default=5, help="Stop waiting for commit events after this many idle seconds")
+    parser.add_argument("--output", help="Write the JSON report to this file (default: stdout)")
+    parser.add_argument("--compare", help="JSON report of a previous run to compare with")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(Benchmark(args).run())
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        log.info(f"Report written to {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
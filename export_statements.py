@@ -0,0 +1,170 @@
+"""
+Exports statements from the API (GET /statements) to a file, as CSV or NDJSON, optionally gzipped.
+
+The export is streamed (gzipped NDJSON from the API) and written as it arrives, memory stays flat whatever its size.
+Every `--checkpoint` rows the output is flushed to disk, and the cursor of the last written row saved next to it
+(<output>.cursor): an interrupted export, or a dropped connection (retried up to `--retries` times),
+continues after the last checkpoint instead of starting over.
+
+    python export_statements.py --month 2026-09 --output statements-2026-09.csv.gz --gzip
+    python export_statements.py --month 2026-09 --account 101 --format ndjson --output 101-2026-09.ndjson
+    python export_statements.py --start 2026-01-01 --end 2026-07-01 --output h1.csv
+
+Requires only the standard library.
+"""
+import argparse
+import base64
+import csv
+import gzip
+import http.client
+import io
+import json
+import logging
+import os
+import time
+import urllib.parse
+import urllib.request
+import zlib
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+log = logging.getLogger(__name__)
+
+API_URL = os.environ.get("API_URL", "http://localhost:8000")
+COLUMNS = ["account_id", "transaction_id", "timestamp", "type", "amount", "status", "details"]  # As the API
+
+
+def row_cursor(row: dict) -> str:
+    """Same cursor as the API (statements.encode_cursor): the export resumes after this row."""
+    return base64.urlsafe_b64encode(json.dumps([row["account_id"], row["timestamp"], row["transaction_id"]]).encode()).decode()
+
+def ndjson_rows(response, chunk_size=64 * 1024):
+    """Yields the rows of a gzipped NDJSON response, decompressed as they arrive."""
+    decompressor = zlib.decompressobj(wbits=31)
+    pending = b""
+    while chunk := response.read(chunk_size):
+        *lines, pending = (pending + decompressor.decompress(chunk)).split(b"\n")
+        for line in lines:
+            yield json.loads(line)
+    pending += decompressor.flush()
+    if pending.strip():
+        yield json.loads(pending)
+
+
+class StatementExporter:
+    def __init__(self, args):
+        self.args = args
+        self.state_path = args.output + ".cursor"
+        self.rows = 0  # Checkpointed by this run
+
+    def load_state(self):
+        """(cursor, size) of the last checkpoint, (None, 0) for a new export."""
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+            return state["cursor"], state["size"]
+        except FileNotFoundError:
+            return None, 0
+
+    def save_state(self, cursor, size):
+        with open(self.state_path + ".tmp", "w") as f:
+            json.dump({"cursor": cursor, "size": size}, f)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def url(self, cursor):
+        params = {"format": "ndjson", "gzip": "true"}
+        for name in ("month", "start", "end"):
+            if getattr(self.args, name):
+                params[name] = getattr(self.args, name)
+        if self.args.account:
+            params["account_id"] = self.args.account
+        if cursor:
+            params["cursor"] = cursor
+        return f"{self.args.api}/statements?{urllib.parse.urlencode(params)}"
+
+    def export(self):
+        """
+        Runs (or resumes) the export, from the last checkpoint: the rows written after it are dropped.
+        With `--gzip`, each checkpoint ends a gzip member, so the file is a valid gzip stream at every checkpoint.
+        """
+        cursor, size = self.load_state()
+        with open(self.args.output, "r+b" if size else "wb") as output:
+            output.truncate(size)
+            output.seek(size)
+            log.info(f"Resuming {self.args.output} after {size} bytes" if cursor else f"Exporting to {self.args.output}")
+
+            with urllib.request.urlopen(self.url(cursor), timeout=self.args.timeout) as response:
+                segment = self.open_segment(output, header=not size)
+                pending = 0
+                for row in ndjson_rows(response):
+                    self.write(segment, row)
+                    cursor, pending = row_cursor(row), pending + 1
+                    if pending >= self.args.checkpoint:
+                        self.checkpoint(output, segment, cursor, pending)
+                        segment = self.open_segment(output)
+                        pending = 0
+                self.checkpoint(output, segment, cursor, pending)
+        os.remove(self.state_path)
+
+    def open_segment(self, output, header=False):
+        """(stream, text, csv writer) of the rows until the next checkpoint, a new gzip member with `--gzip`."""
+        stream = gzip.GzipFile(fileobj=output, mode="wb") if self.args.gzip else output
+        text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+        writer = csv.writer(text) if self.args.format == "csv" else None
+        if header and writer is not None:
+            writer.writerow(COLUMNS)
+        return stream, text, writer
+
+    def write(self, segment, row):
+        _, text, writer = segment
+        if writer is not None:
+            writer.writerow([row[column] for column in COLUMNS])
+        else:
+            text.write(json.dumps(row) + "\n")
+
+    def checkpoint(self, output, segment, cursor, rows):
+        """Ends the segment, and saves the cursor once it is on disk."""
+        stream, text, _ = segment
+        text.flush()
+        text.detach()  # Keeps the output open
+        if stream is not output:
+            stream.close()  # Writes the gzip trailer, the output stays open
+        output.flush()
+        os.fsync(output.fileno())
+        self.save_state(cursor, output.tell())
+        self.rows += rows
+
+    def run(self):
+        for attempt in range(self.args.retries + 1):
+            try:
+                self.export()
+                log.info(f"Exported {self.rows} rows to {self.args.output} in this run")
+                return
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                if attempt == self.args.retries:
+                    raise
+                log.warning(f"Export interrupted: {e!r}, resuming from the last checkpoint in {self.args.retry_delay}s")
+                time.sleep(self.args.retry_delay)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--api", default=API_URL, help="API base url")
+    parser.add_argument("--account", help="Account id, default all the accounts")
+    parser.add_argument("--month", help="YYYY-MM")
+    parser.add_argument("--start", help="ISO date or datetime, with --end instead of --month")
+    parser.add_argument("--end", help="ISO date or datetime, excluded")
+    parser.add_argument("--format", choices=["csv", "ndjson"], default="csv")
+    parser.add_argument("--gzip", action="store_true", help="Gzip the output file")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--checkpoint", type=int, default=10000, help="Rows between checkpoints")
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--retry-delay", type=float, default=5)
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds without data before the connection is dropped")
+    args = parser.parse_args()
+    if not args.month and not (args.start and args.end):
+        parser.error("either --month, or --start and --end are required")
+    return args
+
+
+if __name__ == "__main__":
+    StatementExporter(parse_args()).run()
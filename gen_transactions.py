@@ -29,6 +29,9 @@ def create_transaction():
     }
 
     response = requests.post(API_ENDPOINT, json=payload)
+    if response.status_code == 422:  # Unknown account (106), refused by the API
+        log.info(f"Transaction refused: {response.json()}")
+        return
     response.raise_for_status() 
     log.info(f"Transaction created: {response.json()}") 
 
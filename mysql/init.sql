@@ -3,24 +3,57 @@ USE payments;
 
 CREATE TABLE IF NOT EXISTS accounts (
     account_id VARCHAR(255) PRIMARY KEY,
-    balance DECIMAL(15, 2) NOT NULL
+    balance DECIMAL(15, 2) NOT NULL,
+    initial_balance DECIMAL(15, 2) NOT NULL DEFAULT 0,  -- Reconciliation: balance = initial + completed transactions
+    -- Summary, maintained by the worker in the same DB transaction as the balance
+    transaction_count INT NOT NULL DEFAULT 0,
+    last_activity TIMESTAMP NULL,
+    -- Ledger mode: the balance and summary are a snapshot, up to this ledger entry (folded by the compactor)
+    ledger_entry_id BIGINT NOT NULL DEFAULT 0
 );
 
+-- Partitioned by day, the archiver (worker/app/archiver.py) adds the next days out of pmax, and moves the old
+-- partitions to archive segments. Unique keys must include the partitioning column (and no foreign keys),
+-- so the idempotency of the transactions is enforced by transaction_ids instead.
 CREATE TABLE IF NOT EXISTS transactions (
-    transaction_id VARCHAR(255) PRIMARY KEY,
+    transaction_id VARCHAR(255) NOT NULL,
     account_id VARCHAR(255),
     transaction_type ENUM('deposit', 'withdrawal', 'payment') NOT NULL,
     amount DECIMAL(15, 2) NOT NULL,
     timestamp TIMESTAMP NOT NULL,
     status ENUM('pending', 'processing', 'completed', 'failed') NOT NULL,
     details TEXT,
-    FOREIGN KEY (account_id) REFERENCES accounts(account_id)
+    PRIMARY KEY (transaction_id, timestamp),
+    -- History of an account, in (timestamp, transaction_id) order, covering the history queries
+    INDEX idx_account_history (account_id, timestamp, transaction_id, transaction_type, amount, status)
+)
+PARTITION BY RANGE (UNIX_TIMESTAMP(timestamp)) (
+    PARTITION pmax VALUES LESS THAN MAXVALUE
+);
+
+-- Ids of the transactions of the hot window, inserted first by the workers: a duplicate is not applied.
+-- Purged with the archived partitions.
+CREATE TABLE IF NOT EXISTS transaction_ids (
+    transaction_id VARCHAR(255) PRIMARY KEY,
+    timestamp TIMESTAMP NOT NULL,
+    INDEX idx_transaction_ids_timestamp (timestamp)
+);
+
+-- Ledger mode: signed balance changes, appended by the workers instead of updating the account row
+CREATE TABLE IF NOT EXISTS ledger_entries (
+    entry_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    account_id VARCHAR(255) NOT NULL,
+    transaction_id VARCHAR(255) NOT NULL,
+    amount DECIMAL(15, 2) NOT NULL,
+    timestamp TIMESTAMP NOT NULL,
+    -- Entries of an account after its snapshot, covering the balance queries
+    INDEX idx_ledger_account (account_id, entry_id, amount)
 );
 
 -- Insert 5 accts for testing
-INSERT INTO accounts (account_id, balance) VALUES
-('101', 1000.00),
-('102', 1000.00),
-('103', 1000.00),
-('104', 1000.00),
-('105', 1000.00);
+INSERT INTO accounts (account_id, balance, initial_balance) VALUES
+('101', 1000.00, 1000.00),
+('102', 1000.00, 1000.00),
+('103', 1000.00, 1000.00),
+('104', 1000.00, 1000.00),
+('105', 1000.00, 1000.00);
@@ -0,0 +1,98 @@
+import datetime
+import json
+import os
+import zlib
+
+
+"""
+Archive segments of the transactions table, one per archived partition, read by the API (api/app/archive.py)
+and the reconciliation.
+
+A segment `transactions-<YYYYMMDD>.seg` holds the transactions before that day (and after the previous segment):
+the NDJSON rows of each account, oldest first, compressed in their own gzip member. Its index
+`transactions-<YYYYMMDD>.idx` maps each account to [offset, length, rows] of its member, so a reader only
+decompresses the accounts it needs. The index is written last: a segment without an index does not exist yet.
+"""
+
+SEGMENT_PREFIX = "transactions-"
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+DATE_FORMAT = "%Y%m%d"
+
+
+def segment_row(transaction_id, transaction_type, amount, timestamp, status, details) -> dict:
+    return {
+        "transaction_id": transaction_id,
+        "type": transaction_type,
+        "amount": str(amount),
+        "status": status,
+        "timestamp": timestamp.isoformat(),
+        "details": details,
+    }
+
+
+class SegmentWriter:
+    """Writes a segment, the rows must be added grouped by account. Only one account member is in memory at a time."""
+    def __init__(self, directory, before):
+        name = SEGMENT_PREFIX + before.strftime(DATE_FORMAT)
+        self.before = before
+        self.segment_path = os.path.join(directory, name + SEGMENT_SUFFIX)
+        self.index_path = os.path.join(directory, name + INDEX_SUFFIX)
+        self.file = open(self.segment_path + ".tmp", "wb")
+        self.accounts = {}  # account_id -> [offset, length, rows]
+        self.account_id = None
+        self.compressor = None
+        self.offset = 0
+        self.rows = 0
+
+    def add(self, account_id, row: dict):
+        if account_id != self.account_id:
+            self._end_account()
+            self.account_id = account_id
+            self.compressor = zlib.compressobj(wbits=31)  # gzip member
+            self.offset = self.file.tell()
+            self.rows = 0
+        self.file.write(self.compressor.compress(json.dumps(row).encode() + b"\n"))
+        self.rows += 1
+
+    def _end_account(self):
+        if self.account_id is None:
+            return
+        self.file.write(self.compressor.flush())
+        self.accounts[self.account_id] = [self.offset, self.file.tell() - self.offset, self.rows]
+
+    def close(self):
+        """Publishes the segment, then its index. Returns the number of archived rows."""
+        self._end_account()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.segment_path + ".tmp", self.segment_path)
+
+        with open(self.index_path + ".tmp", "w") as index:
+            json.dump({"before": self.before.isoformat(), "accounts": self.accounts}, index)
+            index.flush()
+            os.fsync(index.fileno())
+        os.replace(self.index_path + ".tmp", self.index_path)
+        return sum(rows for _, _, rows in self.accounts.values())
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.segment_path + ".tmp")
+
+
+def published_segments(directory):
+    """
+    (before, index path, segment path) of the segments with an index, oldest first.
+    The API reads the segments with the same function (api/app/archive.py).
+    """
+    try:
+        names = sorted(name for name in os.listdir(directory) if name.startswith(SEGMENT_PREFIX) and name.endswith(INDEX_SUFFIX))
+    except FileNotFoundError:
+        return []
+    segments = []
+    for name in names:
+        before = datetime.datetime.strptime(name[len(SEGMENT_PREFIX):-len(INDEX_SUFFIX)], DATE_FORMAT)
+        base = os.path.join(directory, name[:-len(INDEX_SUFFIX)])
+        segments.append((before, base + INDEX_SUFFIX, base + SEGMENT_SUFFIX))
+    return segments
@@ -0,0 +1,144 @@
+import argparse
+import datetime
+import os
+import time
+import config
+from db import ConnectionPool
+from logger import configure_logging, log
+from archive import SegmentWriter, segment_row, DATE_FORMAT
+
+
+"""
+Keeps the transactions table small: it is partitioned by day (see mysql/init.sql), the archiver creates the
+partitions of the next days, and moves the partitions older than TRANSACTIONS_HOT_DAYS to archive segments
+(archive.py), read by the API history. A partition is dropped only once its segment is written.
+
+The idempotency window is the same: the transaction ids of the archived partitions are forgotten. The workers send
+the transactions older than the window to the error queue (a late retry or a replay), and replay.py keeps them there:
+they could be applied twice, and the history would not show them.
+
+    python archiver.py [--once]
+"""
+
+PARTITION_PREFIX = "p"  # p<YYYYMMDD> holds the transactions before that day
+PURGE_BATCH = 10000  # transaction_ids rows deleted per DB transaction
+
+
+def partition_bound(name):
+    """Day before which the rows of the partition are, None for pmax."""
+    try:
+        return datetime.datetime.strptime(name[len(PARTITION_PREFIX):], DATE_FORMAT)
+    except ValueError:
+        return None
+
+def hot_cutoff(hot_days, today=None):
+    """Day before which the transactions are archived (or about to be), their ids forgotten."""
+    today = today or datetime.datetime.combine(datetime.date.today(), datetime.time())
+    return today - datetime.timedelta(days=hot_days)
+
+def transaction_partitions(db):
+    """Names of the partitions of the transactions table, oldest first."""
+    rows = db.fetchall(
+        "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'transactions' AND PARTITION_NAME IS NOT NULL "
+        "ORDER BY PARTITION_ORDINAL_POSITION",
+        prepared=False,
+    )
+    return [row[0] for row in rows]
+
+
+class TransactionArchiver:
+    def __init__(self, db:ConnectionPool, archive_dir, hot_days, days_ahead=3):
+        self.db = db
+        self.archive_dir = archive_dir
+        self.hot_days = hot_days
+        self.days_ahead = days_ahead  # Daily partitions created in advance, so pmax stays empty
+
+    def add_partitions(self, db, today):
+        """Splits the daily partitions up to `days_ahead` out of pmax. The first one also holds everything older."""
+        bounds = [bound for bound in map(partition_bound, transaction_partitions(db)) if bound is not None]
+        day = max(bounds) + datetime.timedelta(days=1) if bounds else today + datetime.timedelta(days=1)
+        last = today + datetime.timedelta(days=self.days_ahead)
+        new = []
+        while day <= last:
+            new.append(f"PARTITION {PARTITION_PREFIX}{day.strftime(DATE_FORMAT)} VALUES LESS THAN (UNIX_TIMESTAMP('{day.date()}'))")
+            day += datetime.timedelta(days=1)
+        if not new:
+            return
+        db.execute(
+            f"ALTER TABLE transactions REORGANIZE PARTITION pmax INTO ({', '.join(new)}, PARTITION pmax VALUES LESS THAN MAXVALUE)",
+            prepared=False,
+        )
+        log.info(f"Added {len(new)} transactions partitions, up to {last.date()}")
+
+    def archive_partition(self, db, name, before):
+        """Writes the segment of the partition, then drops it. Returns the number of archived rows."""
+        writer = SegmentWriter(self.archive_dir, before)
+        try:
+            cursor = db.cnx.cursor()  # Unbuffered, the partition is streamed
+            cursor.execute(
+                "SELECT account_id, transaction_id, transaction_type, amount, timestamp, status, details "
+                f"FROM transactions PARTITION ({name}) ORDER BY account_id, timestamp, transaction_id"
+            )
+            for rows in iter(lambda: cursor.fetchmany(1000), []):
+                for account_id, *row in rows:
+                    writer.add(account_id, segment_row(*row))
+            cursor.close()
+        except BaseException:
+            writer.abort()
+            raise
+        archived = writer.close()
+
+        db.execute(f"ALTER TABLE transactions DROP PARTITION {name}", prepared=False)
+        while db.execute("DELETE FROM transaction_ids WHERE timestamp < %s LIMIT %s", (before, PURGE_BATCH), prepared=False) == PURGE_BATCH:
+            db.commit()
+        db.commit()
+        return archived
+
+    def archive(self, today=None):
+        """Creates the next partitions, and archives the ones out of the hot window."""
+        today = today or datetime.datetime.combine(datetime.date.today(), datetime.time())
+        cutoff = hot_cutoff(self.hot_days, today)
+        with self.db.session() as db:
+            self.add_partitions(db, today)
+            for name in transaction_partitions(db):
+                before = partition_bound(name)
+                if before is None or before > cutoff:
+                    continue
+                archived = self.archive_partition(db, name, before)
+                log.info(f"Archived partition {name}: {archived} transactions before {before.date()}")
+
+    def run(self, interval):
+        log.info(f"Archiving the transactions older than {self.hot_days} days every {interval}s... To exit press CTRL+C")
+        while True:
+            try:
+                self.archive()
+            except Exception as e:
+                log.error(f"Error archiving transactions: {e}", exc_info=True)
+            time.sleep(interval)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Archives the transactions older than TRANSACTIONS_HOT_DAYS")
+    parser.add_argument("--once", action="store_true", help="Run one pass and exit")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    configure_logging(log_level=config.LOG_LEVEL)
+    args = parse_args()
+    time.sleep(config.PROCESSOR_START_DELAY)
+    os.makedirs(config.ARCHIVE_DIR, exist_ok=True)
+
+    pool = ConnectionPool(
+        size=1,
+        host=config.MYSQL_HOST,
+        user=config.MYSQL_USER,
+        password=config.MYSQL_PASSWORD,
+        database=config.MYSQL_DATABASE,
+    )
+    archiver = TransactionArchiver(pool, config.ARCHIVE_DIR, config.TRANSACTIONS_HOT_DAYS)
+    if args.once:
+        archiver.archive()
+    else:
+        archiver.run(config.ARCHIVE_INTERVAL)
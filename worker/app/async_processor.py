@@ -0,0 +1,411 @@
+import asyncio
+import datetime
+import json
+import os
+import random
+import socket
+from decimal import Decimal
+import aio_pika
+import aiomysql
+import pymysql.err
+from pymysql.constants import ER
+import config
+from logger import log
+from exceptions import ProcessingError, RetryTransactionError
+from transaction import Transaction
+import wire
+from processor import TransactionProcessor, REGISTER, INSERT_TRANSACTION, UPDATE_ACCOUNT, registration, transaction_row, account_update
+from dedup import RecentTransactionIds
+from timing import StageTimer
+import partitioning
+import metrics
+import retry
+import ledger
+import outcome
+
+CONNECTION_ERRORS = (pymysql.err.OperationalError, pymysql.err.InterfaceError)
+
+
+class AsyncTransactionProcessor:
+    """
+    Asyncio version of TransactionProcessor: processes up to `max_in_flight` messages concurrently
+    in a single process, while one of them sleeps or waits on MySQL.
+
+    In-flight messages are bounded by the channel prefetch, whatever the number of consumed queues. Transactions of the same account are chained,
+    so they are still processed (and settled) one after the other, in delivery order.
+    In partitioned mode, the worker joins the same membership as the blocking processors, and consumes its partitions only.
+    """
+    # Same authorization rules, and events, as the blocking processor
+    compute_balance = TransactionProcessor.compute_balance
+    check_hot_window = TransactionProcessor.check_hot_window
+    balance_event = TransactionProcessor.balance_event
+
+    def __init__(self, worker_id, sub_queue=None, err_queue=None, max_in_flight=None):
+        self.worker_id = worker_id
+        self.subscribe_queue = sub_queue or config.RABBITMQ_TRASACTIONS_QUEUE
+        self.error_queue = err_queue or config.RABBITMQ_ERROR_QUEUE
+        self.max_in_flight = max_in_flight or config.PROCESSOR_MAX_IN_FLIGHT
+        self.connection = None
+        self.channel = None
+        self.events_exchange = None
+        self.retry_exchanges = []  # Retry tiers, see retry.py
+        self.pool = None
+        self.account_tails = {}  # account_id -> task of the last transaction of the account
+        self.recent_ids = RecentTransactionIds(config.PROCESSOR_DEDUP_CACHE_SIZE)
+        self.ledger = config.PROCESSOR_BALANCE_MODE == "ledger"
+
+        # Account affinity, as in TransactionProcessor
+        self.partitioned = config.RABBITMQ_ROUTING == "partitioned"
+        self.member_id = f"{worker_id}@{socket.gethostname()}:{os.getpid()}"
+        self.assigner = partitioning.PartitionAssigner(self.member_id, config.RABBITMQ_PARTITIONS, 3 * config.MEMBERSHIP_HEARTBEAT)
+        self.partition_queues = {}  # partition -> queue
+        self.consumers = {}  # partition -> consumer tag
+        self.members_exchange = None
+        self.heartbeat_task = None
+        self.rebalancing = asyncio.Lock()
+        self.revoking = set()  # Partitions being handed over, their new deliveries are held
+        self.held = []  # Held deliveries, requeued for the new owner
+
+    def authorize_transaction(self, tr:Transaction):
+        # Fast path deduplication, unknown transactions are inserted idempotently by register_transaction
+        return tr.transaction_id in self.recent_ids
+
+    async def register_transaction(self, tr:Transaction, cursor):
+        """Same as TransactionProcessor.register_transaction, False if the transaction was already registered."""
+        try:
+            await cursor.execute(REGISTER, registration(tr))
+        except pymysql.err.IntegrityError as e:
+            if e.args[0] == ER.DUP_ENTRY:
+                return False
+            raise
+        return True
+
+    async def authorize_wallet(self, tr:Transaction, cursor):
+        if self.ledger:
+            return await self.authorize_ledger(tr, cursor)
+        await cursor.execute("SELECT balance FROM accounts WHERE account_id = %s", (tr.account_id,))
+        result = await cursor.fetchone()
+        if result is None:
+            log.debug(f"Account {tr.account_id} not found.")
+            raise ProcessingError(f"Account {tr.account_id} not found. FRAUD?", transaction_id=tr.transaction_id)
+        return self.compute_balance(tr, Decimal(str(result[0])))
+
+    async def authorize_ledger(self, tr:Transaction, cursor):
+        """Same as TransactionProcessor.authorize_ledger."""
+        credit = ledger.is_credit(tr)
+        await cursor.execute(ledger.LOCK_SHARED if credit else ledger.LOCK_EXCLUSIVE, (tr.account_id,))
+        result = await cursor.fetchone()
+        if result is None:
+            log.debug(f"Account {tr.account_id} not found.")
+            raise ProcessingError(f"Account {tr.account_id} not found. FRAUD?", transaction_id=tr.transaction_id)
+        if credit:
+            return None
+
+        snapshot, entry_id = result
+        await cursor.execute(ledger.DELTA, (tr.account_id, entry_id))
+        delta = (await cursor.fetchone())[0]
+        return self.compute_balance(tr, Decimal(str(snapshot)) + Decimal(str(delta)))
+
+    async def apply_transaction(self, tr:Transaction, new_balance, cursor):
+        """
+        Returns the new transaction_count of the account, the version of the balance (the ledger entry id in ledger mode).
+        The transaction is registered already (register_transaction).
+        """
+        await cursor.execute(INSERT_TRANSACTION, transaction_row(tr))
+
+        if self.ledger:
+            await cursor.execute(ledger.APPEND, ledger.entry(tr))
+            return cursor.lastrowid
+
+        await cursor.execute(UPDATE_ACCOUNT, account_update(tr.account_id, new_balance, 1, tr.timestamp))
+        return cursor.lastrowid
+
+    async def acquire(self, timer:StageTimer):
+        """A pooled connection, RetryTransactionError if none is available in time or MySQL can't be reached."""
+        with timer.stage("connect"):
+            try:
+                return await asyncio.wait_for(self.pool.acquire(), config.MYSQL_POOL_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise RetryTransactionError(f"No MySQL connection available after {config.MYSQL_POOL_TIMEOUT}s")
+            except CONNECTION_ERRORS as e:
+                raise RetryTransactionError(f"Database connection error: {e}") from e
+
+    async def process_transaction(self, tr:Transaction):
+        """
+        Same workflow, and exceptions, as TransactionProcessor.process_transaction.
+        """
+        timer = StageTimer()
+
+        # Simulate some random long work, without blocking the other messages
+        with timer.stage("work"):
+            await asyncio.sleep(random.randint(0, config.PROCESSOR_PROCESS_TIME))
+
+        with timer.stage("dedup"):
+            processed = self.authorize_transaction(tr)
+        if processed:
+            log.debug(f"Transaction {tr.transaction_id} already processed. Skipping.")
+            return
+        self.check_hot_window(tr)
+
+        conn = await self.acquire(timer)
+        try:
+            async with conn.cursor() as cursor:
+                try:
+                    with timer.stage("dedup"):
+                        registered = await self.register_transaction(tr, cursor)
+                    if not registered:
+                        await conn.rollback()
+                        self.recent_ids.add(tr.transaction_id)
+                        log.debug(f"Transaction {tr.transaction_id} already processed. Skipping.")
+                        return
+                    with timer.stage("authorize"):
+                        new_balance = await self.authorize_wallet(tr, cursor)
+                except Exception:
+                    await conn.rollback()  # Unregisters it, and doesn't leave the snapshot open on the pooled connection
+                    raise
+
+                try:
+                    with timer.stage("apply"):
+                        version = await self.apply_transaction(tr, new_balance, cursor)
+                    with timer.stage("commit"):
+                        await conn.commit()
+                    self.recent_ids.add(tr.transaction_id)
+                except Exception as e:  # Should NOT capture Exception, this is for simplicity.
+                    await conn.rollback()
+                    log.error(f"Error processing transaction {tr.transaction_id}, rolling back: {e}", exc_info=True)
+                    raise
+        except CONNECTION_ERRORS as e:
+            # Same as ConnectionPool.session: the connection is dropped, and the transaction retried
+            log.warning(f"MySQL connection error, dropping connection: {e}")
+            conn.close()
+            raise RetryTransactionError(f"Database connection error: {e}") from e
+        finally:
+            self.pool.release(conn)
+
+        await self.publish_event(self.balance_event(tr.account_id, new_balance, version, [tr.transaction_id]))
+        log.debug(f"TRANSACTION:{tr.transaction_id} timing {timer}")
+
+    async def transaction_handler(self, message:aio_pika.abc.AbstractIncomingMessage, tr:Transaction, previous):
+        """
+        Processes the transaction once the previous one of the same account is settled, then settles it:
+        ack (Success, Reject), requeue (Retry) or error queue (Error).
+        """
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        log.info(f"TRANSACTION:{tr.transaction_id} START")
+        try:
+            await self.process_transaction(tr)
+            error = None  # Success, if no exception so far
+        except Exception as e:
+            error = e
+
+        result = outcome.decide(tr, error, message.headers, len(self.retry_exchanges))
+        if result.action == outcome.REQUEUE:
+            await message.nack(requeue=True)
+            return
+        if result.action == outcome.ERROR:
+            await self.send_to_error_queue(message, error)
+        elif result.action == outcome.RETRY:
+            await self.schedule_retry(message, result.attempt, result.delay)
+        if result.event is not None:
+            await self.publish_event(result.event)
+        await message.ack()
+
+    async def dispatch(self, message:aio_pika.abc.AbstractIncomingMessage):
+        """
+        Consumer callback, schedules the message chained after the previous transaction of the same account.
+        Must not await anything, so the chains follow the delivery order.
+        """
+        try:
+            with StageTimer().stage("parse"):
+                tr = wire.decode(message.body, message.content_type, config.PROCESSOR_TRUSTED_PRODUCERS)
+        except Exception as e:
+            log.error(f"Unexpected Error: {e}", exc_info=True)
+            metrics.TRANSACTIONS.labels("error").inc()
+            asyncio.create_task(self.reject_invalid(message, e))
+            return
+        if self.revoking and partitioning.partition_for(tr.account_id, config.RABBITMQ_PARTITIONS) in self.revoking:
+            self.held.append(message)
+            return
+
+        previous = self.account_tails.get(tr.account_id)
+        task = asyncio.create_task(self.transaction_handler(message, tr, previous))
+        self.account_tails[tr.account_id] = task
+        task.add_done_callback(lambda done: self.release_account(tr.account_id, done))
+
+    def release_account(self, account_id, task):
+        if self.account_tails.get(account_id) is task:
+            del self.account_tails[account_id]
+        if not task.cancelled() and task.exception():
+            log.error(f"Error settling message: {task.exception()}", exc_info=task.exception())
+
+    async def reject_invalid(self, message:aio_pika.abc.AbstractIncomingMessage, error):
+        await self.send_to_error_queue(message, error)
+        await message.ack()
+
+    async def publish_event(self, event:dict):
+        """
+        Publishes an event for the API, after commit. Losing one only delays the API cache refresh (TTL),
+        or a transaction status (read from the DB when the wait times out).
+        """
+        try:
+            await self.events_exchange.publish(aio_pika.Message(json.dumps(event).encode()), routing_key="")
+        except Exception as e:
+            log.error(f"Error publishing {event['event']} event: {e}", exc_info=True)
+
+    async def schedule_retry(self, message:aio_pika.abc.AbstractIncomingMessage, attempt, delay):
+        """Same as TransactionProcessor.schedule_retry."""
+        headers = {key: value for key, value in (message.headers or {}).items() if key != "x-death"}
+        headers[retry.ATTEMPT_HEADER] = attempt
+        await self.retry_exchanges[retry.tier_for(attempt, len(self.retry_exchanges))].publish(
+            aio_pika.Message(
+                message.body,
+                content_type=message.content_type,
+                headers=headers,
+                expiration=delay,
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            ),
+            routing_key=message.routing_key,
+        )
+
+    async def send_to_error_queue(self, message:aio_pika.abc.AbstractIncomingMessage, error):
+        """Sends the message to the error queue along with the error message."""
+        try:
+            error_data = {
+                **wire.original_message(message.body, message.content_type),
+                "error_message": str(error),
+                "worker_id": self.worker_id,
+                "timestamp": str(datetime.datetime.now())
+            }
+            await self.channel.default_exchange.publish(
+                aio_pika.Message(json.dumps(error_data).encode(), delivery_mode=aio_pika.DeliveryMode.PERSISTENT),
+                routing_key=self.error_queue,
+            )
+            log.debug(f"Message sent to error queue: {self.error_queue}")
+        except Exception as e:
+            log.error(f"Error sending message to error queue: {e}", exc_info=True)
+
+    async def declare_retry_tiers(self, prefix, dead_letter_exchange):
+        """Same topology as retry.topology, the tier exchanges are kept to publish the retries."""
+        for tier in range(config.RABBITMQ_RETRY_TIERS):
+            name = retry.tier_exchange(prefix, tier)
+            exchange = await self.channel.declare_exchange(name, aio_pika.ExchangeType.FANOUT)
+            queue = await self.channel.declare_queue(name, arguments={"x-dead-letter-exchange": dead_letter_exchange})
+            await queue.bind(exchange)
+            self.retry_exchanges.append(exchange)
+
+    async def declare_queues(self):
+        """
+        Returns the queues to consume. In partitioned mode none: the partition queues are consumed as assigned (rebalance).
+        """
+        await self.channel.declare_queue(self.error_queue)
+        if config.RABBITMQ_ROUTING != "partitioned":
+            await self.declare_retry_tiers(self.subscribe_queue, "")
+            return [await self.channel.declare_queue(self.subscribe_queue)]
+
+        await self.declare_retry_tiers(config.RABBITMQ_PARTITION_EXCHANGE, config.RABBITMQ_PARTITION_EXCHANGE)
+        exchange = await self.channel.declare_exchange(config.RABBITMQ_PARTITION_EXCHANGE, aio_pika.ExchangeType.DIRECT)
+        for partition in range(config.RABBITMQ_PARTITIONS):
+            queue = await self.channel.declare_queue(
+                partitioning.partition_queue(config.RABBITMQ_PARTITION_EXCHANGE, partition),
+                arguments={"x-single-active-consumer": True},
+            )
+            await queue.bind(exchange, routing_key=str(partition))
+            self.partition_queues[partition] = queue
+        return []
+
+    async def start_partitioned(self):
+        """Joins the workers membership, as TransactionProcessor.start_partitioned."""
+        self.members_exchange = await self.channel.declare_exchange(config.RABBITMQ_MEMBERS_EXCHANGE, aio_pika.ExchangeType.FANOUT)
+        members_queue = await self.channel.declare_queue(exclusive=True)
+        await members_queue.bind(self.members_exchange)
+        await members_queue.consume(self.member_handler, no_ack=True)
+        self.heartbeat_task = asyncio.create_task(self.heartbeat())
+
+    async def publish_membership(self, leaving=False):
+        await self.members_exchange.publish(
+            aio_pika.Message(json.dumps({"member": self.member_id, "leaving": leaving}).encode()), routing_key=""
+        )
+
+    async def heartbeat(self):
+        while True:
+            try:
+                await self.publish_membership()
+                if self.assigner.expire():
+                    log.info("Worker(s) left without notice")
+                await self.rebalance()
+            except Exception as e:
+                log.error(f"Error in membership heartbeat: {e}", exc_info=True)
+            await asyncio.sleep(config.MEMBERSHIP_HEARTBEAT)
+
+    async def member_handler(self, message:aio_pika.abc.AbstractIncomingMessage):
+        """Heartbeats of the other workers, rebalances when a worker joins or leaves."""
+        member = json.loads(message.body)
+        if self.assigner.observe(member["member"], leaving=member.get("leaving", False)):
+            log.info(f"Worker {member['member']} {'left' if member.get('leaving') else 'joined'}")
+            # Not awaited: the rebalance waits for transactions in flight, which need the channel to deliver
+            asyncio.create_task(self.rebalance())
+
+    async def rebalance(self):
+        """
+        Same as TransactionProcessor.rebalance. The transactions in flight of a revoked partition are settled before
+        the cancel, its new deliveries meanwhile are held, and requeued for the new owner after it.
+        """
+        async with self.rebalancing:
+            owned = self.assigner.assigned()
+            revoked, acquired = set(self.consumers) - owned, owned - set(self.consumers)
+            if not revoked and not acquired:
+                return
+
+            if revoked:
+                self.revoking = revoked
+                tails = [
+                    task for account_id, task in self.account_tails.items()
+                    if partitioning.partition_for(account_id, config.RABBITMQ_PARTITIONS) in revoked
+                ]
+                if tails:
+                    await asyncio.wait(tails)
+                for partition in sorted(revoked):
+                    await self.partition_queues[partition].cancel(self.consumers.pop(partition))
+                held, self.held, self.revoking = self.held, [], set()
+                for message in held:
+                    await message.nack(requeue=True)
+            for partition in sorted(acquired):
+                self.consumers[partition] = await self.partition_queues[partition].consume(self.dispatch)
+            log.info(f"Partitions rebalanced, {len(self.assigner.members)} worker(s), owning {sorted(owned)}")
+
+    async def start_consuming(self):
+        log.info(f"Connecting to RabbitMQ at {config.RABBITMQ_HOST}, user:{config.RABBITMQ_USER}")
+        self.pool = await aiomysql.create_pool(
+            host=config.MYSQL_HOST,
+            user=config.MYSQL_USER,
+            password=config.MYSQL_PASSWORD,
+            db=config.MYSQL_DATABASE,
+            maxsize=self.max_in_flight,
+        )
+        self.connection = await aio_pika.connect_robust(
+            host=config.RABBITMQ_HOST, login=config.RABBITMQ_USER, password=config.RABBITMQ_PASS
+        )
+        try:
+            self.channel = await self.connection.channel()
+            # Shared by all the consumers of the channel (RabbitMQ's global QoS), not per partition queue
+            await self.channel.set_qos(prefetch_count=self.max_in_flight, global_=True)
+            self.events_exchange = await self.channel.declare_exchange(config.RABBITMQ_EVENTS_EXCHANGE, aio_pika.ExchangeType.FANOUT)
+
+            for queue in await self.declare_queues():
+                await queue.consume(self.dispatch)
+            if self.partitioned:
+                await self.start_partitioned()
+            log.info(f"Listening with up to {self.max_in_flight} transactions in flight... To exit press CTRL+C")
+            await asyncio.Future()  # Run forever
+        finally:
+            if self.heartbeat_task is not None:
+                self.heartbeat_task.cancel()
+                try:
+                    await self.publish_membership(leaving=True)
+                except Exception as e:
+                    log.warning(f"Could not publish leaving the membership: {e}")
+            await self.connection.close()
+            self.pool.close()
+            await self.pool.wait_closed()
@@ -0,0 +1,89 @@
+import time
+import config
+from db import ConnectionPool
+from logger import configure_logging, log
+
+
+class LedgerCompactor:
+    """
+    Ledger mode: folds the ledger entries into the account snapshots (balance, transaction_count, last_activity,
+    up to ledger_entry_id), so reading a balance only sums the entries since the last pass. See ledger.py.
+
+    Each account is folded in its own DB transaction, with the account row locked: it waits for the in-flight
+    transactions of the account, so no entry below the new ledger_entry_id can be committed later.
+    The folded entries are deleted in the same DB transaction, the transactions table keeps the history.
+    One compactor is enough, running more is safe.
+    """
+    def __init__(self, db:ConnectionPool, lookback=10000):
+        self.db = db
+        self.scan_from = 0  # Entries after this id are looked at, the first pass scans the whole ledger
+        self.lookback = lookback  # ids scanned again, for the entries committed after entries with higher ids
+
+    def pending_accounts(self, db):
+        """Accounts with entries since the last pass, and the highest entry id seen."""
+        rows = db.fetchall(
+            "SELECT account_id, MAX(entry_id) FROM ledger_entries WHERE entry_id > %s GROUP BY account_id",
+            (self.scan_from,),
+        )
+        return [account_id for account_id, _ in rows], max((entry_id for _, entry_id in rows), default=None)
+
+    def compact_account(self, account_id, db):
+        """Folds the entries of the account after its snapshot, and deletes them. Returns the number of entries folded."""
+        result = db.fetchone("SELECT ledger_entry_id FROM accounts WHERE account_id = %s FOR UPDATE", (account_id,))
+        if result is None:
+            return 0
+        # First consistent read of the DB transaction, after the lock: every entry of the account is committed
+        amount, count, last_entry_id, last_activity = db.fetchone(
+            "SELECT COALESCE(SUM(amount), 0), COUNT(*), MAX(entry_id), MAX(timestamp) FROM ledger_entries "
+            "WHERE account_id = %s AND entry_id > %s",
+            (account_id, result[0]),
+        )
+        if count:
+            db.execute(
+                "UPDATE accounts SET balance = balance + %s, transaction_count = transaction_count + %s, ledger_entry_id = %s, "
+                "last_activity = GREATEST(COALESCE(last_activity, %s), %s) WHERE account_id = %s",
+                (amount, count, last_entry_id, last_activity, last_activity, account_id),
+            )
+            # The entry ids keep growing once the table is emptied, MySQL 8 persists the AUTO_INCREMENT counter
+            db.execute("DELETE FROM ledger_entries WHERE account_id = %s AND entry_id <= %s", (account_id, last_entry_id))
+        db.commit()
+        return count
+
+    def compact(self):
+        """One pass over the accounts with new entries. Returns (accounts, entries) folded."""
+        with self.db.session() as db:
+            account_ids, max_entry_id = self.pending_accounts(db)
+            db.rollback()  # Don't keep the read view of the scan, each account is read after its lock
+            folded_accounts, folded_entries = 0, 0
+            for account_id in account_ids:
+                entries = self.compact_account(account_id, db)
+                folded_accounts += bool(entries)
+                folded_entries += entries
+        if max_entry_id is not None:
+            self.scan_from = max(self.scan_from, max_entry_id - self.lookback)
+        return folded_accounts, folded_entries
+
+    def run(self, interval):
+        log.info(f"Compacting the ledger every {interval}s... To exit press CTRL+C")
+        while True:
+            try:
+                accounts, entries = self.compact()
+                if entries:
+                    log.info(f"Folded {entries} ledger entries into {accounts} accounts")
+            except Exception as e:
+                log.error(f"Error compacting the ledger: {e}", exc_info=True)
+            time.sleep(interval)
+
+
+if __name__ == "__main__":
+    configure_logging(log_level=config.LOG_LEVEL)
+    time.sleep(config.PROCESSOR_START_DELAY)
+
+    pool = ConnectionPool(
+        size=1,
+        host=config.MYSQL_HOST,
+        user=config.MYSQL_USER,
+        password=config.MYSQL_PASSWORD,
+        database=config.MYSQL_DATABASE,
+    )
+    LedgerCompactor(pool).run(config.LEDGER_COMPACT_INTERVAL)
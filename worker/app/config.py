@@ -4,8 +4,21 @@ import os
 # TRANSACTION PROCESSOR
 PROCESSOR_START_DELAY = int(os.environ.get("START_DELAY", "5")) # seconds to wait
 WORKER_ID = os.environ.get("WORKER_ID", "0") # ID from docker env, default to "0" for local clients
-PROCESSOR_PROCESS_TIME = 3 # Artificial delay to simulate time taken by Transaction Processing
+PROCESSOR_PROCESS_TIME = int(os.environ.get("PROCESS_TIME", "3"))  # Max seconds of artificial delay to simulate Transaction Processing, 0 disables it
 LOG_LEVEL = os.environ.get("LOG_LEVEL", logging.INFO)
+PROCESSOR_BATCH_SIZE = int(os.environ.get("BATCH_SIZE", "1"))  # Max transactions per DB transaction, 1 disables batching
+PROCESSOR_BATCH_LATENCY = float(os.environ.get("BATCH_LATENCY", "0.05"))  # Max seconds to wait for a batch to fill up
+PROCESSOR_DEDUP_CACHE_SIZE = int(os.environ.get("DEDUP_CACHE_SIZE", "100000"))  # Recent transaction ids kept in memory
+PROCESSOR_ENGINE = os.environ.get("PROCESSOR_ENGINE", "blocking")  # "blocking" (pika) or "asyncio" (aio-pika, aiomysql)
+PROCESSOR_MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", "50"))  # Concurrent transactions per process, asyncio engine
+PROCESSOR_PREFETCH = int(os.environ.get("PREFETCH", str(2 * PROCESSOR_BATCH_SIZE)))  # Unacked messages delivered to the worker
+PROCESSOR_BALANCE_MODE = os.environ.get("BALANCE_MODE", "accounts")  # "accounts" (update the row) or "ledger" (append entries)
+LEDGER_COMPACT_INTERVAL = float(os.environ.get("LEDGER_COMPACT_INTERVAL", "5"))  # seconds between compactor passes
+TRANSACTIONS_HOT_DAYS = int(os.environ.get("TRANSACTIONS_HOT_DAYS", "30"))  # Days kept in MySQL (and idempotency window), older ones are archived
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")  # Archive segments, shared with the API
+ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", "3600"))  # seconds between archiver passes
+PROCESSOR_TRUSTED_PRODUCERS = os.environ.get("TRUSTED_PRODUCERS", "0") == "1"  # Skip the validation of v2 messages, only the API publishes
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))  # Prometheus /metrics, 0 disables it
 
 # RMQ
 RABBITMQ_HOST = os.environ.get("RABBITMQ_HOST", "localhost")
@@ -13,9 +26,21 @@ RABBITMQ_USER = os.environ.get("RABBITMQ_USER", "guest")
 RABBITMQ_PASS = os.environ.get("RABBITMQ_PASS", "guest")
 RABBITMQ_TRASACTIONS_QUEUE = os.environ.get("LISTEN_QUEUE", "transaction_queue")
 RABBITMQ_ERROR_QUEUE = os.environ.get("ERROR_QUEUE", "error")
+RABBITMQ_EVENTS_EXCHANGE = os.environ.get("RABBITMQ_EVENTS_EXCHANGE", "transaction_events")  # Fanout, balance changes etc.
+RABBITMQ_ROUTING = os.environ.get("RABBITMQ_ROUTING", "queue")  # "queue" or "partitioned" (account affinity)
+RABBITMQ_PARTITION_EXCHANGE = os.environ.get("RABBITMQ_PARTITION_EXCHANGE", "transaction_partitions")
+RABBITMQ_PARTITIONS = int(os.environ.get("RABBITMQ_PARTITIONS", "16"))
+RABBITMQ_RETRY_TIERS = int(os.environ.get("RABBITMQ_RETRY_TIERS", "5"))  # Delay queues, of RETRY_BASE_DELAY * 2^tier
+RETRY_BASE_DELAY = float(os.environ.get("RETRY_BASE_DELAY", "1"))  # seconds before the first retry
+RETRY_JITTER = float(os.environ.get("RETRY_JITTER", "0.2"))  # +/- ratio of the delay, spreads the retries after an outage
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", "10"))  # Then the message goes to the error queue
+RABBITMQ_MEMBERS_EXCHANGE = os.environ.get("RABBITMQ_MEMBERS_EXCHANGE", "transaction_workers")  # Worker heartbeats, for partition assignment
+MEMBERSHIP_HEARTBEAT = float(os.environ.get("MEMBERSHIP_HEARTBEAT", "5"))  # seconds, workers are gone after 3 missed heartbeats
 
 #MYSQL
 MYSQL_HOST = os.environ.get("MYSQL_HOST", "localhost")
 MYSQL_USER = os.environ.get("MYSQL_USER", "root")
 MYSQL_PASSWORD = os.environ.get("MYSQL_PASSWORD", "mysecretpassword")
 MYSQL_DATABASE = os.environ.get("MYSQL_DATABASE", "payments")
+MYSQL_POOL_SIZE = int(os.environ.get("MYSQL_POOL_SIZE", "1"))  # Persistent connections, the blocking processor uses one at a time
+MYSQL_POOL_TIMEOUT = float(os.environ.get("MYSQL_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection, then the transaction is retried
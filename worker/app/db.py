@@ -0,0 +1,185 @@
+import queue
+import threading
+import time
+from contextlib import contextmanager
+import mysql.connector
+import mysql.connector.errors
+from mysql.connector import errorcode
+from logger import log
+from exceptions import RetryTransactionError
+from timing import StageTimer
+
+
+class DBSession:
+    """
+    A pooled MySQL connection, with its server-side prepared statements.
+
+    Statements are prepared on first use and kept for the lifetime of the connection, one prepared cursor
+    per SQL string, so later executions only send the parameters.
+    """
+    def __init__(self, cnx):
+        self.cnx = cnx
+        self.statements = {}  # sql -> prepared cursor
+        self.plain = None  # Regular cursor, for dynamic statements (IN lists, multi-row inserts)
+        self.lastrowid = None
+        self.last_used = time.monotonic()
+
+    def cursor(self, sql, prepared=True):
+        if not prepared:
+            if self.plain is None:
+                self.plain = self.cnx.cursor()
+            return self.plain
+        cursor = self.statements.get(sql)
+        if cursor is None:
+            cursor = self.statements[sql] = self.cnx.cursor(prepared=True)
+        return cursor
+
+    def execute(self, sql, params=(), prepared=True):
+        """Executes a statement, returns the number of affected rows."""
+        cursor = self.cursor(sql, prepared)
+        cursor.execute(sql, params)
+        self.lastrowid = cursor.lastrowid
+        return cursor.rowcount
+
+    def executemany(self, sql, seq_params):
+        """The connector rewrites INSERT ... VALUES executemany() into a single multi-row INSERT."""
+        cursor = self.cursor(sql, prepared=False)
+        cursor.executemany(sql, seq_params)
+        return cursor.rowcount
+
+    def insert(self, sql, params=(), prepared=True):
+        """
+        Idempotent INSERT: returns False, instead of failing, if the row already exists (duplicate key).
+        Only the failed statement is rolled back, the DB transaction stays usable.
+        """
+        try:
+            self.execute(sql, params, prepared)
+        except mysql.connector.errors.IntegrityError as e:
+            if e.errno == errorcode.ER_DUP_ENTRY:
+                return False
+            raise
+        return True
+
+    def insertmany(self, sql, seq_params):
+        """Multi-row version of insert(), False if any of the rows already exists."""
+        try:
+            self.executemany(sql, seq_params)
+        except mysql.connector.errors.IntegrityError as e:
+            if e.errno == errorcode.ER_DUP_ENTRY:
+                return False
+            raise
+        return True
+
+    def fetchall(self, sql, params=(), prepared=True):
+        cursor = self.cursor(sql, prepared)
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    def fetchone(self, sql, params=(), prepared=True):
+        # Read the whole result, the connection can't run the next statement with unread rows
+        rows = self.fetchall(sql, params, prepared)
+        return rows[0] if rows else None
+
+    def commit(self):
+        self.cnx.commit()
+
+    def rollback(self):
+        self.cnx.rollback()
+
+    def reset(self):
+        """Forgets the prepared statements, after a reconnect they don't exist anymore on the server."""
+        self.statements = {}
+        self.plain = None
+
+    def close(self):
+        try:
+            self.cnx.close()
+        except mysql.connector.Error as e:
+            log.debug(f"Error closing MySQL connection: {e}")
+
+
+class ConnectionPool:
+    """
+    Connections kept for the lifetime of the worker, created on demand up to `size`.
+
+    Connections idle for more than `health_check_interval` are pinged (and reconnected) before use.
+    Connections that fail with a connection error are dropped, and the error is raised as
+    RetryTransactionError, so the message is retried on a fresh connection.
+    """
+    def __init__(self, size=1, timeout=10.0, health_check_interval=30.0, **connect_args):
+        self.size = size
+        self.timeout = timeout  # seconds to wait for a free connection
+        self.health_check_interval = health_check_interval
+        self.connect_args = connect_args
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        return DBSession(mysql.connector.connect(**self.connect_args))
+
+    def acquire(self):
+        try:
+            session = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            try:
+                session = self._idle.get(timeout=self.timeout)
+            except queue.Empty:
+                raise RetryTransactionError(f"No MySQL connection available after {self.timeout}s")
+
+        if time.monotonic() - session.last_used > self.health_check_interval and not session.cnx.is_connected():
+            log.info("MySQL connection lost, reconnecting")
+            session.cnx.reconnect(attempts=3, delay=1)
+            session.reset()
+        return session
+
+    def release(self, session):
+        session.last_used = time.monotonic()
+        self._idle.put(session)
+
+    def discard(self, session):
+        session.close()
+        with self._lock:
+            self._created -= 1
+
+    @contextmanager
+    def session(self, timer=None):
+        """
+        Yields a session, always returned without an open DB transaction: a transaction left open would keep
+        its (REPEATABLE READ) snapshot, and the next message would read stale balances.
+        The time spent waiting for the connection is recorded as the "connect" stage of `timer` (StageTimer).
+        """
+        with (timer or StageTimer()).stage("connect"):
+            session = self.acquire()
+        try:
+            yield session
+        except (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError) as e:
+            log.warning(f"MySQL connection error, dropping connection: {e}")
+            self.discard(session)
+            raise RetryTransactionError(f"Database connection error: {e}") from e
+        except BaseException:
+            self._end_transaction(session)
+            raise
+        else:
+            self._end_transaction(session)
+
+    def _end_transaction(self, session):
+        try:
+            if session.cnx.in_transaction:
+                session.rollback()
+        except mysql.connector.Error as e:
+            log.warning(f"MySQL connection error, dropping connection: {e}")
+            self.discard(session)
+            return
+        self.release(session)
@@ -0,0 +1,33 @@
+import collections
+
+
+class RecentTransactionIds:
+    """
+    Bounded LRU set of the transaction ids recently seen by this worker.
+
+    A hit is a definite duplicate, skipped without a DB round trip. A miss proves nothing (the id might be
+    older, or processed by another worker): correctness rests on the idempotent insert of the transaction.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._ids = collections.OrderedDict()
+
+    def __contains__(self, transaction_id):
+        if transaction_id not in self._ids:
+            return False
+        self._ids.move_to_end(transaction_id)
+        return True
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, transaction_id):
+        self._ids[transaction_id] = None
+        self._ids.move_to_end(transaction_id)
+        while len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+    def warm(self, transaction_ids):
+        """Adds ids, oldest first."""
+        for transaction_id in transaction_ids:
+            self.add(transaction_id)
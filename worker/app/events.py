@@ -0,0 +1,43 @@
+"""
+Events published by the workers on the events fanout exchange (RABBITMQ_EVENTS_EXCHANGE), after commit.
+The API consumes them to keep its caches up to date.
+"""
+import datetime
+
+
+def balance_changed(account_id: str, balance, version: int, transaction_ids=()) -> dict:
+    """
+    `version` is the account transaction_count after the change, newer balances have higher versions.
+    `transaction_ids` are the transactions committed by the change, at `committed_at` (same clock as the API timestamps).
+    """
+    return {
+        "event": "balance_changed",
+        "account_id": account_id,
+        "balance": str(balance),
+        "version": version,
+        "transaction_ids": list(transaction_ids),
+        "committed_at": datetime.datetime.now().isoformat(),
+    }
+
+def balance_invalidated(account_id: str, transaction_ids=()) -> dict:
+    """The balance changed, but the new value is not known (ledger mode), the API reads it again when needed."""
+    return {
+        "event": "balance_invalidated",
+        "account_id": account_id,
+        "transaction_ids": list(transaction_ids),
+        "committed_at": datetime.datetime.now().isoformat(),
+    }
+
+def transaction_status(transaction_id: str, account_id: str, status: str, reason: str = None) -> dict:
+    """
+    Final status of a transaction that was not committed: "rejected" or "failed" (error queue).
+    Committed transactions are listed in the balance events instead.
+    """
+    return {
+        "event": "transaction_status",
+        "transaction_id": transaction_id,
+        "account_id": account_id,
+        "status": status,
+        "reason": reason,
+        "updated_at": datetime.datetime.now().isoformat(),
+    }
@@ -0,0 +1,30 @@
+"""
+Ledger mode (BALANCE_MODE=ledger): transactions append signed entries to ledger_entries instead of updating
+the account row, and the balance is the snapshot in accounts (balance, up to accounts.ledger_entry_id) plus the
+entries after it. The compactor (compactor.py) periodically folds the entries into the snapshot.
+
+The account row is still the lock of the account, but credits only take a shared lock: they don't need the balance,
+and run concurrently on a hot account. Debits take the exclusive lock, so the balance they check includes every
+entry (in-flight credits hold the shared lock until they commit), and so does the compactor. The entries committed
+after a compaction always get higher ids than the folded ones: their writers wait for the compaction lock,
+and only then allocate the entry id.
+"""
+from decimal import Decimal
+
+CREDIT_TYPES = ("deposit",)
+
+LOCK_SHARED = "SELECT balance, ledger_entry_id FROM accounts WHERE account_id = %s FOR SHARE"
+LOCK_EXCLUSIVE = "SELECT balance, ledger_entry_id FROM accounts WHERE account_id = %s FOR UPDATE"
+DELTA = "SELECT COALESCE(SUM(amount), 0) FROM ledger_entries WHERE account_id = %s AND entry_id > %s"
+APPEND = "INSERT INTO ledger_entries (account_id, transaction_id, amount, timestamp) VALUES (%s, %s, %s, %s)"
+
+
+def is_credit(tr) -> bool:
+    return tr.transaction_type in CREDIT_TYPES
+
+def signed_amount(tr) -> Decimal:
+    return tr.amount if is_credit(tr) else -tr.amount
+
+def entry(tr) -> tuple:
+    """APPEND parameters of a transaction."""
+    return (tr.account_id, tr.transaction_id, signed_amount(tr), tr.timestamp)
@@ -1,6 +1,7 @@
 import time
 from processor import TransactionProcessor
 import config
+import metrics
 from logger import configure_logging, log
 
 
@@ -13,7 +14,16 @@ if __name__ == "__main__":
     time.sleep(config.PROCESSOR_START_DELAY)
 
     try:
-        worker = TransactionProcessor(worker_id)
-        worker.start_consuming()
+        metrics.start(config.METRICS_PORT)
+        if config.PROCESSOR_BALANCE_MODE == "ledger" and config.RABBITMQ_ROUTING == "partitioned":
+            log.warning("BALANCE_MODE=ledger with RABBITMQ_ROUTING=partitioned: each account is processed by a single worker, "
+                        "the ledger doesn't spread the load of hot accounts. It is meant for RABBITMQ_ROUTING=queue")
+        if config.PROCESSOR_ENGINE == "asyncio":
+            import asyncio
+            from async_processor import AsyncTransactionProcessor
+            asyncio.run(AsyncTransactionProcessor(worker_id).start_consuming())
+        else:
+            worker = TransactionProcessor(worker_id)
+            worker.start_consuming()
     except Exception as e:
         log.error(f"Processor failed to start: {e}", exc_info=True)
@@ -0,0 +1,201 @@
+import collections
+import heapq
+import itertools
+import time
+
+
+"""
+In-process stand-in of RabbitMQ, for local runs and the benchmarks (worker/benchmarks): exchanges (default, direct
+and fanout), queues, consumers with prefetch and acks, behind the subset of pika's BlockingConnection and
+BlockingChannel the processor uses.
+
+    broker = MemoryBroker()
+    TransactionProcessor(worker_id, db=store, connect=broker.connect).start_consuming()
+
+Unlike pika, start_consuming() returns once the work is done: nothing left to deliver, and no unacked message
+(the timers, like the batch latency, still fire on time meanwhile). Queue arguments are accepted and ignored:
+no message expiration, so no dead-lettering (retry tiers keep their messages), no single active consumer.
+"""
+
+
+class Properties:
+    """Properties of a message published without any, as pika.BasicProperties()."""
+    content_type = None
+    headers = None
+
+
+class Delivery:
+    """The `method` of a delivery."""
+    def __init__(self, delivery_tag, exchange, routing_key, redelivered=False):
+        self.delivery_tag = delivery_tag
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.redelivered = redelivered
+
+
+class DeclareResult:
+    """Result of queue_declare, the (generated) name is in .method.queue."""
+    def __init__(self, queue):
+        self.method = self
+        self.queue = queue
+
+
+class MemoryBroker:
+    def __init__(self):
+        self.exchanges = {"": "direct"}  # name -> type
+        self.bindings = collections.defaultdict(set)  # exchange -> {(queue, routing_key)}
+        self.queues = {}  # name -> deque of (exchange, routing_key, properties, body, redelivered)
+        self._names = itertools.count(1)
+
+    def connect(self):
+        return MemoryConnection(self)
+
+    def declare_queue(self, queue=""):
+        queue = queue or f"amq.gen-{next(self._names)}"
+        self.queues.setdefault(queue, collections.deque())
+        return queue
+
+    def route(self, exchange, routing_key, properties, body):
+        """Enqueues the message on the queues it routes to, unroutable messages are dropped."""
+        if exchange not in self.exchanges:
+            raise ValueError(f"NOT_FOUND - no exchange '{exchange}'")
+        if exchange == "":
+            queues = [routing_key] if routing_key in self.queues else []
+        elif self.exchanges[exchange] == "fanout":
+            queues = {queue for queue, _ in self.bindings[exchange]}
+        else:
+            queues = {queue for queue, key in self.bindings[exchange] if key == routing_key}
+        for queue in queues:
+            self.queues[queue].append((exchange, routing_key, properties or Properties(), body, False))
+
+    def publish(self, routing_key, body, exchange="", properties=None):
+        """Publishes from outside of a connection, e.g. to load the messages of a benchmark."""
+        self.route(exchange, routing_key, properties, body)
+
+
+class MemoryConnection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self.channels = []
+        self._timers = []  # heap of (deadline, sequence, callback)
+        self._sequence = itertools.count()
+
+    def channel(self):
+        channel = MemoryChannel(self)
+        self.channels.append(channel)
+        return channel
+
+    def call_later(self, delay, callback):
+        timer = [time.monotonic() + delay, next(self._sequence), callback]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def remove_timeout(self, timer):
+        timer[2] = None  # Skipped when due
+
+    def run_timers(self, wait=False):
+        """Runs the due timers, after waiting for the next one if `wait`. Returns True if any ran."""
+        while self._timers and self._timers[0][2] is None:
+            heapq.heappop(self._timers)
+        if not self._timers:
+            return False
+        if wait:
+            time.sleep(max(0.0, self._timers[0][0] - time.monotonic()))
+        ran = False
+        while self._timers and self._timers[0][0] <= time.monotonic():
+            _, _, callback = heapq.heappop(self._timers)
+            if callback is not None:
+                callback()
+                ran = True
+        return ran
+
+    def close(self):
+        for channel in self.channels:
+            channel.requeue_unacked()
+        self.is_open = False
+
+
+class MemoryChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.prefetch_count = 0  # unlimited
+        self.consumers = {}  # consumer tag -> (queue, callback, auto_ack)
+        self.unacked = collections.OrderedDict()  # delivery tag -> (queue, message)
+        self._delivery_tags = itertools.count(1)
+        self._consumer_tags = itertools.count(1)
+        self._consuming = False
+
+    def basic_qos(self, prefetch_count=0):
+        self.prefetch_count = prefetch_count
+
+    def exchange_declare(self, exchange, exchange_type="direct", **kwargs):
+        self.broker.exchanges.setdefault(exchange, exchange_type)
+
+    def queue_declare(self, queue="", **kwargs):
+        return DeclareResult(self.broker.declare_queue(queue))
+
+    def queue_bind(self, queue, exchange, routing_key=None):
+        self.broker.bindings[exchange].add((queue, routing_key if routing_key is not None else queue))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.broker.route(exchange, routing_key, properties, body.encode() if isinstance(body, str) else body)
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False):
+        consumer_tag = f"ctag-{next(self._consumer_tags)}"
+        self.consumers[consumer_tag] = (queue, on_message_callback, auto_ack)
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag):
+        self.consumers.pop(consumer_tag, None)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        for tag in self._settled(delivery_tag, multiple):
+            del self.unacked[tag]
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        for tag in reversed(self._settled(delivery_tag, multiple)):
+            queue, (exchange, routing_key, properties, body, _) = self.unacked.pop(tag)
+            if requeue:
+                self.broker.queues[queue].appendleft((exchange, routing_key, properties, body, True))
+
+    def _settled(self, delivery_tag, multiple):
+        if not multiple:
+            return [delivery_tag] if delivery_tag in self.unacked else []
+        return [tag for tag in self.unacked if tag <= delivery_tag]
+
+    def requeue_unacked(self):
+        if self.unacked:
+            self.basic_nack(max(self.unacked), multiple=True)
+
+    def deliver(self):
+        """Delivers one message to a consumer with prefetch room, returns False if there was none."""
+        if self.prefetch_count and len(self.unacked) >= self.prefetch_count:
+            return False
+        for queue, callback, auto_ack in list(self.consumers.values()):
+            messages = self.broker.queues.get(queue)
+            if not messages:
+                continue
+            message = messages.popleft()
+            exchange, routing_key, properties, body, redelivered = message
+            delivery_tag = next(self._delivery_tags)
+            if not auto_ack:
+                self.unacked[delivery_tag] = (queue, message)
+            callback(self, Delivery(delivery_tag, exchange, routing_key, redelivered), properties, body)
+            return True
+        return False
+
+    def start_consuming(self):
+        """Delivers the messages, and runs the timers, until the work is done or stop_consuming() is called."""
+        self._consuming = True
+        while self._consuming:
+            if self.deliver() or self.connection.run_timers():
+                continue
+            # Waiting for a timer (e.g. a batch to flush) only makes sense while messages are in progress
+            if not self.unacked or not self.connection.run_timers(wait=True):
+                break
+        self._consuming = False
+
+    def stop_consuming(self):
+        self._consuming = False
@@ -0,0 +1,22 @@
+"""
+Prometheus metrics of the worker, served on METRICS_PORT.
+"""
+from prometheus_client import Counter, Histogram, start_http_server
+
+STAGE_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+TRANSACTIONS = Counter(
+    "worker_transactions_total", "Settled transactions, by outcome (success, reject, error, retry)", ["outcome"],
+)
+# Stages: parse, work (simulated), connect (waiting for a DB connection), dedup, authorize, apply, commit.
+# In batch mode, the stages after parse are observed once per batch.
+STAGE_SECONDS = Histogram(
+    "worker_stage_seconds", "Duration of the processing stages of a transaction (or batch)", ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+
+
+def start(port):
+    """Serves /metrics in a background thread, port 0 disables it."""
+    if port:
+        start_http_server(port)
@@ -0,0 +1,58 @@
+import collections
+from logger import log
+from exceptions import ProcessingError, RejectTransactionError, RetryTransactionError
+from transaction import Transaction
+import config
+import events
+import metrics
+import retry
+
+
+"""
+Outcome of a processed transaction, decided in one place for both engines (processor.py, async_processor.py),
+with its log, metric and status event. The engines only carry out the action on the broker.
+"""
+
+ACK = "ack"  # Success or Reject
+REQUEUE = "requeue"  # Retry without retry tiers: nack, requeued
+RETRY = "retry"  # Retry: published to the retry tier of `attempt`, due after `delay`, then acked
+ERROR = "error"  # Error: sent to the error queue, then acked
+
+Outcome = collections.namedtuple("Outcome", ["action", "event", "attempt", "delay"], defaults=[None, None, None])
+
+
+def decide(tr: Transaction, error, headers, retry_tiers: int) -> Outcome:
+    """
+    `error` is the exception raised by process_transaction, None on success. `event` is the status event to publish
+    after the action, if any.
+    """
+    if error is None:
+        log.info(f"TRANSACTION:{tr.transaction_id} SUCCESS")
+        metrics.TRANSACTIONS.labels("success").inc()
+        return Outcome(ACK)
+    if isinstance(error, ProcessingError):
+        log.warning(f"TRANSACTION:{tr.transaction_id}, ERROR {error}")
+        return failed(tr, error.message)
+    if isinstance(error, RejectTransactionError):
+        log.warning(f"TRANSACTION:{tr.transaction_id}, REJECT reason {error.message}")
+        metrics.TRANSACTIONS.labels("reject").inc()
+        return Outcome(ACK, events.transaction_status(tr.transaction_id, tr.account_id, "rejected", error.message))
+    if isinstance(error, RetryTransactionError):
+        if not retry_tiers:
+            log.warning(f"TRANSACTION:{tr.transaction_id} RETRY (requeue).")
+            metrics.TRANSACTIONS.labels("retry").inc()
+            return Outcome(REQUEUE)
+        attempt = retry.attempts(headers) + 1
+        if attempt > config.RETRY_MAX_ATTEMPTS:
+            log.warning(f"TRANSACTION:{tr.transaction_id}, ERROR after {attempt - 1} retries: {error}")
+            return failed(tr, error.message)
+        delay = retry.backoff(attempt, retry_tiers, config.RETRY_BASE_DELAY, config.RETRY_JITTER)
+        log.warning(f"TRANSACTION:{tr.transaction_id} RETRY {attempt} in {delay:.1f}s.")
+        metrics.TRANSACTIONS.labels("retry").inc()
+        return Outcome(RETRY, attempt=attempt, delay=delay)
+    log.error(f"Unexpected Error: {error}", exc_info=error)
+    return failed(tr, str(error))
+
+def failed(tr: Transaction, reason: str) -> Outcome:
+    metrics.TRANSACTIONS.labels("error").inc()
+    return Outcome(ERROR, events.transaction_status(tr.transaction_id, tr.account_id, "failed", reason))
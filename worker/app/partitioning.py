@@ -0,0 +1,67 @@
+import hashlib
+import time
+import zlib
+
+
+"""
+Account-affinity routing: the API publishes transactions to a direct exchange, with the account partition
+as routing key. Each worker owns a set of partitions, so an account is processed by a single worker.
+partition_for / topology must match api/app/partitioning.py.
+"""
+
+def partition_for(account_id: str, partitions: int) -> int:
+    return zlib.crc32(account_id.encode()) % partitions
+
+def partition_queue(exchange: str, partition: int) -> str:
+    return f"{exchange}.{partition}"
+
+def topology(exchange: str, partitions: int) -> list:
+    """
+    Declarations for the partitioned exchange and queues, as (channel method, kwargs).
+    Single active consumer makes sure only one worker at a time processes a partition,
+    even while the workers don't agree yet on the assignment.
+    """
+    steps = [("exchange_declare", {"exchange": exchange, "exchange_type": "direct"})]
+    for partition in range(partitions):
+        queue = partition_queue(exchange, partition)
+        steps.append(("queue_declare", {"queue": queue, "arguments": {"x-single-active-consumer": True}}))
+        steps.append(("queue_bind", {"queue": queue, "exchange": exchange, "routing_key": str(partition)}))
+    return steps
+
+
+class PartitionAssigner:
+    """
+    Tracks the live workers, from their heartbeats, and assigns the partitions with rendezvous hashing:
+    a worker joining or leaving only moves the partitions it gains or loses.
+    """
+    def __init__(self, member_id, partitions, expiry):
+        self.member_id = member_id
+        self.partitions = partitions
+        self.expiry = expiry  # seconds without heartbeat, before a member is considered gone
+        self.members = {member_id: time.monotonic()}
+
+    def observe(self, member_id, leaving=False):
+        """Registers a heartbeat. Returns True if the membership changed."""
+        if leaving:
+            return member_id != self.member_id and self.members.pop(member_id, None) is not None
+        joined = member_id not in self.members
+        self.members[member_id] = time.monotonic()
+        return joined
+
+    def expire(self):
+        """Removes the members without recent heartbeat. Returns True if the membership changed."""
+        deadline = time.monotonic() - self.expiry
+        expired = [member for member, seen in self.members.items() if seen < deadline and member != self.member_id]
+        for member in expired:
+            del self.members[member]
+        return bool(expired)
+
+    def owner(self, partition):
+        return max(self.members, key=lambda member: self._weight(member, partition))
+
+    def assigned(self):
+        return {partition for partition in range(self.partitions) if self.owner(partition) == self.member_id}
+
+    @staticmethod
+    def _weight(member, partition):
+        return int.from_bytes(hashlib.md5(f"{member}:{partition}".encode()).digest()[:8], "big")
@@ -3,41 +3,176 @@ import random
 import pika
 from pika.adapters.blocking_connection import BlockingChannel
 import json
-import mysql.connector
+import os
+import socket
 import time
 from decimal import Decimal
 import config
 from logger import log
-from exceptions import ProcessingError, RejectTransactionError, RetryTransactionError, WalletAuthorizationError
+from exceptions import TransactionError, ProcessingError, RetryTransactionError, WalletAuthorizationError
 from transaction import Transaction
+import wire
+from db import ConnectionPool
+from dedup import RecentTransactionIds
+from timing import StageTimer
+import partitioning
+import events
+import metrics
+import retry
+import ledger
+import archiver
+import outcome
+
+# Statements of both engines (async_processor.py)
+REGISTER = "INSERT INTO transaction_ids (transaction_id, timestamp) VALUES (%s, %s)"
+INSERT_TRANSACTION = (
+    "INSERT INTO transactions (transaction_id, account_id, transaction_type, amount, timestamp, status, details) "
+    "VALUES (%s, %s, %s, %s, %s, %s, %s)"
+)
+# Balance and account summary of n transactions. LAST_INSERT_ID(expr) returns the new count without another query
+UPDATE_ACCOUNT = (
+    "UPDATE accounts SET balance = %s, transaction_count = LAST_INSERT_ID(transaction_count + %s), "
+    "last_activity = GREATEST(COALESCE(last_activity, %s), %s) WHERE account_id = %s"
+)
+
+
+def registration(tr:Transaction) -> tuple:
+    """REGISTER parameters of a transaction."""
+    return (tr.transaction_id, tr.timestamp)
+
+def transaction_row(tr:Transaction) -> tuple:
+    """INSERT_TRANSACTION parameters of a completed transaction."""
+    return (tr.transaction_id, tr.account_id, tr.transaction_type, tr.amount, tr.timestamp, "completed", tr.details)
+
+def account_update(account_id, balance, count, last_activity) -> tuple:
+    """UPDATE_ACCOUNT parameters."""
+    return (balance, count, last_activity, last_activity, account_id)
 
 
 class TransactionProcessor:
-    def __init__(self, worker_id, sub_queue=None, err_queue=None):
+    """
+    The broker and the store are pluggable, RabbitMQ and MySQL by default:
+    `connect` returns a connection with the interface of pika's BlockingConnection (memory_broker.MemoryBroker.connect),
+    `db` is a pool with the session() interface of db.ConnectionPool (sqlite_store.SQLiteStore).
+    """
+    def __init__(self, worker_id, sub_queue=None, err_queue=None, db=None, connect=None):
         self.worker_id = worker_id
         self.connection = None
         self.channel = None
+        self.connect = connect or (lambda: pika.BlockingConnection(pika.ConnectionParameters(host=config.RABBITMQ_HOST)))
         self.subscribe_queue = sub_queue or config.RABBITMQ_TRASACTIONS_QUEUE
         self.error_queue = err_queue or config.RABBITMQ_ERROR_QUEUE
+        self.db = db or ConnectionPool(
+            size=config.MYSQL_POOL_SIZE,
+            timeout=config.MYSQL_POOL_TIMEOUT,
+            host=config.MYSQL_HOST,
+            user=config.MYSQL_USER,
+            password=config.MYSQL_PASSWORD,
+            database=config.MYSQL_DATABASE,
+        )
+        self.recent_ids = RecentTransactionIds(config.PROCESSOR_DEDUP_CACHE_SIZE)
+        self.trusted = config.PROCESSOR_TRUSTED_PRODUCERS
+        self.batch_size = config.PROCESSOR_BATCH_SIZE
+        self.prefetch = config.PROCESSOR_PREFETCH
+        self.batch = []  # Pending deliveries (method, properties, body), in batch mode
+        self.batch_timer = None
 
-    def authorize_transaction(self, tr:Transaction, cursor):
-        # Check if the transaction already registered (deduplication)
-        cursor.execute("SELECT transaction_id FROM transactions WHERE transaction_id = %s", (tr.transaction_id,))
-        return cursor.fetchone()
+        # Account affinity: this worker owns a set of partitions, and is the only writer for their accounts
+        self.partitioned = config.RABBITMQ_ROUTING == "partitioned"
+        self.member_id = f"{worker_id}@{socket.gethostname()}:{os.getpid()}"
+        self.assigner = partitioning.PartitionAssigner(self.member_id, config.RABBITMQ_PARTITIONS, 3 * config.MEMBERSHIP_HEARTBEAT)
+        self.consumers = {}  # partition -> consumer tag
+        self.message_handler = None
+        self.heartbeat_timer = None
+        self.balances = {}  # Committed balances of the owned accounts, only in partitioned mode
 
-    def authorize_wallet(self, tr:Transaction, cursor):
+        # Ledger mode, see ledger.py. The balances of the owned accounts are not known after a credit
+        self.ledger = config.PROCESSOR_BALANCE_MODE == "ledger"
+        self.cache_balances = self.partitioned and not self.ledger
+
+        # Delayed retries, dead-lettered back to the exchange the transactions come from
+        self.retry_prefix = config.RABBITMQ_PARTITION_EXCHANGE if self.partitioned else self.subscribe_queue
+        self.retry_exchange = config.RABBITMQ_PARTITION_EXCHANGE if self.partitioned else ""
+
+    def authorize_transaction(self, tr:Transaction):
+        """
+        Fast path deduplication, True if the transaction is a known duplicate. Unknown transactions are not looked up
+        in the DB, register_transaction inserts them idempotently instead.
+        """
+        return tr.transaction_id in self.recent_ids
+
+    def check_hot_window(self, tr:Transaction):
+        """
+        Raises ProcessingError (error queue) if the transaction is older than the hot window (TRANSACTIONS_HOT_DAYS):
+        its partition may be archived, with its id, so it could be applied twice, in a partition the history skips.
+        """
+        if tr.timestamp < archiver.hot_cutoff(config.TRANSACTIONS_HOT_DAYS):
+            raise ProcessingError(
+                f"Older than the {config.TRANSACTIONS_HOT_DAYS} days hot window, can't be processed", transaction_id=tr.transaction_id
+            )
+
+    def register_transaction(self, tr:Transaction, db):
+        """
+        Registers the transaction id, before the authorization and in the same DB transaction: its primary key makes
+        the transaction idempotent, and a redelivered one is skipped instead of being authorized again against
+        a balance that already includes it. A concurrent duplicate waits on the id until the first one ends.
+        Returns False if the transaction was already registered.
+        """
+        return db.insert(REGISTER, registration(tr))
+
+    def warm_recent_ids(self):
+        """Loads the most recent transaction ids, so redeliveries after a restart are caught by the fast path."""
+        try:
+            with self.db.session() as db:
+                rows = db.fetchall(
+                    "SELECT transaction_id FROM transaction_ids ORDER BY timestamp DESC LIMIT %s",
+                    (self.recent_ids.max_size,),
+                    prepared=False,
+                )
+            self.recent_ids.warm(row[0] for row in reversed(rows))
+            log.info(f"Loaded {len(self.recent_ids)} recent transaction ids")
+        except Exception as e:
+            log.warning(f"Could not load recent transaction ids: {e}")
+
+    def authorize_wallet(self, tr:Transaction, db):
         """
         Checks banalnce and "simulates" the transaction, returning the resulting balance
         """
+        if self.ledger:
+            return self.authorize_ledger(tr, db)
 
-        # Get current account balance
-        cursor.execute("SELECT balance FROM accounts WHERE account_id = %s", (tr.account_id,))
-        result = cursor.fetchone()
+        # Get current account balance, we don't need to read it if we own the account
+        if tr.account_id in self.balances:
+            return self.compute_balance(tr, self.balances[tr.account_id])
+
+        result = db.fetchone("SELECT balance FROM accounts WHERE account_id = %s", (tr.account_id,))
         if result is None:
             log.debug(f"Account {tr.account_id} not found.")
             raise ProcessingError(f"Account {tr.account_id} not found. FRAUD?", transaction_id=tr.transaction_id)
         current_balance = Decimal(str(result[0])) 
-    
+        return self.compute_balance(tr, current_balance)
+
+    def authorize_ledger(self, tr:Transaction, db):
+        """
+        Ledger mode version of authorize_wallet. Credits only lock the account in share mode, and return None:
+        the resulting balance is not known, other credits might be committing at the same time.
+        """
+        credit = ledger.is_credit(tr)
+        result = db.fetchone(ledger.LOCK_SHARED if credit else ledger.LOCK_EXCLUSIVE, (tr.account_id,))
+        if result is None:
+            log.debug(f"Account {tr.account_id} not found.")
+            raise ProcessingError(f"Account {tr.account_id} not found. FRAUD?", transaction_id=tr.transaction_id)
+        if credit:
+            return None
+
+        snapshot, entry_id = result
+        delta = db.fetchone(ledger.DELTA, (tr.account_id, entry_id))[0]
+        return self.compute_balance(tr, Decimal(str(snapshot)) + Decimal(str(delta)))
+
+    def compute_balance(self, tr:Transaction, current_balance:Decimal):
+        """
+        Applies the transaction on the given balance, raises if it's not authorized.
+        """
         # Update account balance depending on transaction
         if tr.transaction_type == "deposit":
             new_balance = current_balance + tr.amount
@@ -56,51 +191,223 @@ class TransactionProcessor:
             raise ProcessingError(f"Invalid transaction type: {tr.transaction_type}", transaction_id=tr.transaction_id)
         return new_balance
 
-    def apply_transaction(self, tr:Transaction, new_balance, cursor):
-        # Update balance
-        cursor.execute("UPDATE accounts SET balance = %s WHERE account_id = %s", (new_balance, tr.account_id))
+    def apply_transaction(self, tr:Transaction, new_balance, db):
+        """
+        Returns the new transaction_count of the account, the version of the balance (the ledger entry id in ledger mode).
+        The transaction is registered already (register_transaction).
+        """
+        db.execute(INSERT_TRANSACTION, transaction_row(tr))
 
-        # Add transaction
-        sql = "INSERT INTO transactions (transaction_id, account_id, transaction_type, amount, timestamp, status, details) VALUES (%s, %s, %s, %s, %s, %s, %s)"
-        val = (tr.transaction_id, tr.account_id, tr.transaction_type, tr.amount, tr.timestamp, "completed", tr.details)
-        cursor.execute(sql, val)
+        if self.ledger:
+            db.execute(ledger.APPEND, ledger.entry(tr))
+            return db.lastrowid
+
+        db.execute(UPDATE_ACCOUNT, account_update(tr.account_id, new_balance, 1, tr.timestamp))
+        return db.lastrowid
+
+    def read_balances(self, account_ids:list, db):
+        """
+        Reads the balances of the given accounts. Without account affinity, other workers might update them,
+        so the rows are locked, in a fixed order to avoid deadlocks between workers.
+        In ledger mode the rows are always locked, for the compactor, and the balances include the ledger entries.
+        """
+        balances = {account_id: self.balances[account_id] for account_id in account_ids if account_id in self.balances}
+        missing = sorted(set(account_ids) - set(balances))
+        if not missing:
+            return balances
+
+        placeholders = ", ".join(["%s"] * len(missing))
+        lock = " FOR UPDATE" if self.ledger or not self.partitioned else ""
+        rows = db.fetchall(
+            f"SELECT account_id, balance FROM accounts WHERE account_id IN ({placeholders}) ORDER BY account_id{lock}",
+            tuple(missing),
+            prepared=False,
+        )
+        balances.update({account_id: Decimal(str(balance)) for account_id, balance in rows})
+
+        if self.ledger and rows:
+            deltas = db.fetchall(
+                "SELECT e.account_id, SUM(e.amount) FROM ledger_entries e JOIN accounts a ON a.account_id = e.account_id "
+                f"WHERE e.account_id IN ({placeholders}) AND e.entry_id > a.ledger_entry_id GROUP BY e.account_id",
+                tuple(missing),
+                prepared=False,
+            )
+            for account_id, delta in deltas:
+                balances[account_id] += Decimal(str(delta))
+        return balances
 
-    def process_transaction(self, tr:Transaction):
+    def apply_batch(self, transactions:list, balances:dict, db):
+        """
+        Returns the new transaction_count of each account, the versions of the balances (None in ledger mode).
+        The transactions are registered already (process_batch).
+        """
+        if transactions:
+            db.executemany(INSERT_TRANSACTION, [transaction_row(tr) for tr in transactions])
+
+        if self.ledger:
+            if transactions:
+                db.executemany(ledger.APPEND, [ledger.entry(tr) for tr in transactions])
+            return {account_id: None for account_id in balances}
+
+        # One update per account, with the final balance and summary
+        counts, last_activity = {}, {}
+        for tr in transactions:
+            counts[tr.account_id] = counts.get(tr.account_id, 0) + 1
+            last_activity[tr.account_id] = max(last_activity.get(tr.account_id, tr.timestamp), tr.timestamp)
+        versions = {}
+        for account_id, balance in balances.items():
+            db.execute(UPDATE_ACCOUNT, account_update(account_id, balance, counts[account_id], last_activity[account_id]))
+            versions[account_id] = db.lastrowid
+        return versions
+
+    def process_batch(self, transactions:list):
+        """
+        Executes the Processing workflow for a batch of transactions, in a single DB transaction.
+
+        Returns a list aligned with `transactions`, with None for successful (or duplicate) transactions,
+        or the TransactionError that process_transaction would have raised.
+        Returns None if the batch could not be committed, so the caller can fall back to one by one processing.
+        That's also the case if the batch contains a duplicate not caught by the fast path.
+        """
+        results = [None] * len(transactions)
+        timer = StageTimer()
+
+        # Simulate some random long work, once per batch
+        with timer.stage("work"):
+            time.sleep(random.randint(0, config.PROCESSOR_PROCESS_TIME))
+
+        with self.db.session(timer) as db:
+            try:
+                with timer.stage("dedup"):
+                    processed = {tr.transaction_id for tr in transactions if self.authorize_transaction(tr)}
+                    for i, tr in enumerate(transactions):
+                        if tr.transaction_id not in processed:
+                            try:
+                                self.check_hot_window(tr)
+                            except ProcessingError as e:
+                                results[i] = e
+                    out_of_window = {i for i, result in enumerate(results) if result is not None}
+                    # Registered before the authorization, as in register_transaction. The multi-row INSERT fails
+                    # as a whole on a duplicate, they are rare (redeliveries): the batch is processed one by one
+                    ids = [
+                        registration(tr) for i, tr in enumerate(transactions)
+                        if tr.transaction_id not in processed and i not in out_of_window
+                    ]
+                    if ids and not db.insertmany(REGISTER, ids):
+                        db.rollback()
+                        log.info(f"Batch of {len(transactions)} contains already processed transactions, processing one by one")
+                        return None
+                with timer.stage("authorize"):
+                    balances = self.read_balances(list({tr.account_id for tr in transactions}), db)
+
+                    # Transactions are authorized in delivery order, against the running balance of each account
+                    accepted, new_balances = [], {}
+                    for i, tr in enumerate(transactions):
+                        if tr.transaction_id in processed:
+                            log.debug(f"Transaction {tr.transaction_id} already processed. Skipping.")
+                            continue
+                        if i in out_of_window:
+                            continue
+                        if tr.account_id not in balances:
+                            log.debug(f"Account {tr.account_id} not found.")
+                            results[i] = ProcessingError(f"Account {tr.account_id} not found. FRAUD?", transaction_id=tr.transaction_id)
+                            continue
+                        try:
+                            balances[tr.account_id] = self.compute_balance(tr, balances[tr.account_id])
+                        except TransactionError as e:
+                            results[i] = e
+                            continue
+                        new_balances[tr.account_id] = balances[tr.account_id]
+                        processed.add(tr.transaction_id)
+                        accepted.append(tr)
+
+                    # The transactions that were not accepted are not registered, a redelivery is processed again
+                    unregistered = [
+                        tr.transaction_id for i, tr in enumerate(transactions) if results[i] is not None and i not in out_of_window
+                    ]
+                    if unregistered:
+                        db.execute(
+                            f"DELETE FROM transaction_ids WHERE transaction_id IN ({', '.join(['%s'] * len(unregistered))})",
+                            tuple(unregistered),
+                            prepared=False,
+                        )
+
+                with timer.stage("apply"):
+                    versions = self.apply_batch(accepted, new_balances, db)
+                with timer.stage("commit"):
+                    db.commit()
+                for tr in accepted:
+                    self.recent_ids.add(tr.transaction_id)
+                if self.cache_balances:
+                    self.balances.update(new_balances)
+            except Exception as e:  # Should NOT capture Exception, this is for simplicity.
+                db.rollback()
+                log.error(f"Error processing batch of {len(transactions)} transactions, rolling back: {e}", exc_info=True)
+                return None
+
+        committed = {}
+        for tr in accepted:
+            committed.setdefault(tr.account_id, []).append(tr.transaction_id)
+        for account_id, balance in new_balances.items():
+            self.publish_event(self.balance_event(account_id, balance, versions[account_id], committed[account_id]))
+        log.debug(f"BATCH of {len(transactions)} timing {timer}")
+        return results
+
+    def process_transaction(self, tr:Transaction, timer:StageTimer=None):
         """
         Executes the transaction Processing workflow. Should only return normally if the transaction is successful.
         Otherwise it will raise a TransactionError exception (child):
 
         ProcessingError - if an error occurred during processing.
         WalletAuthorizationError - Error with balance, or authorization
+        RetryTransactionError - Database connection lost, or no connection available
         ... etc
         """
+        timer = timer or StageTimer()
 
-        with mysql.connector.connect(
-            host=config.MYSQL_HOST,
-            user=config.MYSQL_USER,
-            password=config.MYSQL_PASSWORD,
-            database=config.MYSQL_DATABASE
-        ) as mydb:
-            with mydb.cursor() as mycursor:
-                # Simulate some random long work
-                time.sleep(random.randint(0, config.PROCESSOR_PROCESS_TIME))
+        # Simulate some random long work
+        with timer.stage("work"):
+            time.sleep(random.randint(0, config.PROCESSOR_PROCESS_TIME))
 
-                # Authorization
-                if self.authorize_transaction(tr, mycursor):
-                    log.debug(f"Transaction {tr.transaction_id} already processed. Skipping.")
-                    return
+        # Authorization
+        with timer.stage("dedup"):
+            processed = self.authorize_transaction(tr)
+        if processed:
+            log.debug(f"Transaction {tr.transaction_id} already processed. Skipping.")
+            return
+        self.check_hot_window(tr)
 
-                new_balance = self.authorize_wallet(tr, mycursor)
+        with self.db.session(timer) as db:
+            # Errors roll back the registration too (session), a redelivery is processed again
+            with timer.stage("dedup"):
+                registered = self.register_transaction(tr, db)
+            if not registered:
+                db.rollback()
+                self.recent_ids.add(tr.transaction_id)
+                # Committed while this worker saw an error: the cached balance doesn't include it
+                self.forget_balances([tr.account_id])
+                log.debug(f"Transaction {tr.transaction_id} already processed. Skipping.")
+                return
+            with timer.stage("authorize"):
+                new_balance = self.authorize_wallet(tr, db)
 
-                # This part at least, should allow rollback in case of error
-                try: 
-                    self.apply_transaction(tr, new_balance, mycursor)
-                    mydb.commit()
-                except Exception as e:  # Should NOT capture Exception, this is for simplicity.
-                    mydb.rollback()  # Rollback in case of any error
-                    log.error(f"Error processing transaction {tr.transaction_id}, rolling back: {e}", exc_info=True)
-                    raise
+            # This part at least, should allow rollback in case of error
+            try: 
+                with timer.stage("apply"):
+                    version = self.apply_transaction(tr, new_balance, db)
+                with timer.stage("commit"):
+                    db.commit()
+                self.recent_ids.add(tr.transaction_id)
+                if self.cache_balances:
+                    self.balances[tr.account_id] = new_balance
+            except Exception as e:  # Should NOT capture Exception, this is for simplicity.
+                db.rollback()  # Rollback in case of any error
+                self.forget_balances([tr.account_id])  # The commit may have reached MySQL all the same
+                log.error(f"Error processing transaction {tr.transaction_id}, rolling back: {e}", exc_info=True)
+                raise
 
+        self.publish_event(self.balance_event(tr.account_id, new_balance, version, [tr.transaction_id]))
+        log.debug(f"TRANSACTION:{tr.transaction_id} timing {timer}")
 
     def transaction_handler(self, ch:BlockingChannel, method, properties, body):
         """
@@ -108,48 +415,168 @@ class TransactionProcessor:
 
         Depending on the result of process_transaction, either:
             ack's the message (Reject)
-            re-enqueues (Retry)
+            schedules a delayed retry (Retry)
             or sends it to the error queue (Error).
         """
+        timer = StageTimer()
         try:
-            tr = Transaction.from_dict(json.loads(body))
+            with timer.stage("parse"):
+                tr = wire.decode(body, properties.content_type, self.trusted)
             # TODO: Check format of transaction data
-            log.info(f"TRANSACTION:{tr.transaction_id} START")
+        except Exception as e:
+            log.error(f"Unexpected Error: {e}", exc_info=True)
+            metrics.TRANSACTIONS.labels("error").inc()
+            self.send_to_error_queue(ch, method, properties, body, e)
+            ch.basic_ack(method.delivery_tag)
+            return
 
-            self.process_transaction(tr)
+        log.info(f"TRANSACTION:{tr.transaction_id} START")
+        try:
+            self.process_transaction(tr, timer)
+            error = None  # Success, if no exception so far
+        except Exception as e:
+            error = e
 
-            # Success, if no exception so far
+        if self.settle(ch, method, properties, body, tr, error):
             ch.basic_ack(delivery_tag=method.delivery_tag)
-            log.info(f"TRANSACTION:{tr.transaction_id} SUCCESS")
 
-        except ProcessingError as e: 
-            log.warning(f"TRANSACTION:{tr.transaction_id}, ERROR {e}")
-            self.send_to_error_queue(ch, method, body, e)
-            ch.basic_ack(method.delivery_tag)
-        except RejectTransactionError as e: 
-            log.warning(f"TRANSACTION:{tr.transaction_id}, REJECT reason {e.message}")
-            ch.basic_ack(method.delivery_tag)
-        except RetryTransactionError as e: 
-            log.warning(f"TRANSACTION:{tr.transaction_id} RETRY (requeue).")
+    def settle(self, ch:BlockingChannel, method, properties, body, tr:Transaction, error):
+        """
+        Handles the outcome of a transaction. Returns True if the message has to be acked,
+        False if it was already re-enqueued (Retry, without retry tiers).
+        """
+        result = outcome.decide(tr, error, properties.headers, config.RABBITMQ_RETRY_TIERS)
+        if result.action == outcome.REQUEUE:
             ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            return False
+        if result.action == outcome.ERROR:
+            self.send_to_error_queue(ch, method, properties, body, error)
+        elif result.action == outcome.RETRY:
+            self.schedule_retry(ch, method, properties, body, result.attempt, result.delay)
+        if result.event is not None:
+            self.publish_event(result.event)
+        return True
+
+    def batch_handler(self, ch:BlockingChannel, method, properties, body):
+        """
+        Message handler in batch mode. Collects deliveries until the batch is full, or the latency window expires.
+        """
+        self.batch.append((method, properties, body))
+        if len(self.batch) >= self.batch_size:
+            self.flush_batch()
+        elif self.batch_timer is None:
+            self.batch_timer = self.connection.call_later(config.PROCESSOR_BATCH_LATENCY, self.flush_batch)
+
+    def flush_batch(self):
+        """
+        Processes the pending batch, then acks all the settled messages at once (multiple=True).
+        Requeued messages (no retry tiers) are nacked one by one before that, so the multiple ack does not cover them.
+        """
+        if self.batch_timer is not None:
+            self.connection.remove_timeout(self.batch_timer)
+            self.batch_timer = None
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
+
+        ch = self.channel
+        ack_tag = None
+        parsed = []
+        timer = StageTimer()
+        for method, properties, body in batch:
+            try:
+                with timer.stage("parse"):
+                    tr = wire.decode(body, properties.content_type, self.trusted)
+            except Exception as e:
+                log.error(f"Unexpected Error: {e}", exc_info=True)
+                metrics.TRANSACTIONS.labels("error").inc()
+                self.send_to_error_queue(ch, method, properties, body, e)
+                ack_tag = method.delivery_tag
+                continue
+            log.info(f"TRANSACTION:{tr.transaction_id} START")
+            parsed.append((method, properties, body, tr))
+
+        try:
+            errors = self.process_batch([tr for *_, tr in parsed]) if parsed else []
+        except Exception as e:  # Connection errors, etc.
+            log.error(f"Error processing batch: {e}", exc_info=True)
+            errors = None
+        if errors is None:
+            self.forget_balances([tr.account_id for *_, tr in parsed])
+            errors = [self.try_process_transaction(tr) for *_, tr in parsed]
+
+        for (method, properties, body, tr), error in zip(parsed, errors):
+            if self.settle(ch, method, properties, body, tr, error):
+                ack_tag = max(ack_tag or 0, method.delivery_tag)
+
+        if ack_tag is not None:
+            ch.basic_ack(delivery_tag=ack_tag, multiple=True)
+        log.info(f"BATCH of {len(batch)} messages done")
+
+    def forget_balances(self, account_ids):
+        """
+        Drops cached balances that may be stale, they are read again from the DB. After a failed commit, the commit
+        may still have reached MySQL: the redelivery is then skipped as a duplicate, and never updates the cache.
+        """
+        for account_id in account_ids:
+            self.balances.pop(account_id, None)
+
+    def try_process_transaction(self, tr:Transaction):
+        """Runs process_transaction, returning the raised error instead (None on success)."""
+        try:
+            self.process_transaction(tr)
         except Exception as e:
-            log.error(f"Unexpected Error: {e}", exc_info=True)
-            self.send_to_error_queue(ch, method, body, e)
-            ch.basic_ack(method.delivery_tag)
+            return e
+        return None
+
+    def balance_event(self, account_id, balance, version, transaction_ids):
+        """In ledger mode, the balance and its version are not known after commit: the API reads them again."""
+        if self.ledger:
+            return events.balance_invalidated(account_id, transaction_ids)
+        return events.balance_changed(account_id, balance, version, transaction_ids)
+
+    def publish_event(self, event:dict):
+        """
+        Publishes an event for the API, after commit. Losing one only delays the API cache refresh (TTL),
+        or a transaction status (read from the DB when the wait times out).
+        """
+        try:
+            self.channel.basic_publish(exchange=config.RABBITMQ_EVENTS_EXCHANGE, routing_key="", body=json.dumps(event))
+        except Exception as e:
+            log.error(f"Error publishing {event['event']} event: {e}", exc_info=True)
+
+    def schedule_retry(self, ch:BlockingChannel, method, properties, body, attempt, delay):
+        """
+        Publishes the message to the retry tier of the attempt, it comes back after the backoff `delay` (seconds),
+        with its original routing key.
+        """
+        # x-death is added by the broker on each dead-lettering, don't let it grow with the attempts
+        headers = {key: value for key, value in (properties.headers or {}).items() if key != "x-death"}
+        headers[retry.ATTEMPT_HEADER] = attempt
+        ch.basic_publish(
+            exchange=retry.tier_exchange(self.retry_prefix, retry.tier_for(attempt, config.RABBITMQ_RETRY_TIERS)),
+            routing_key=method.routing_key,
+            body=body,
+            properties=pika.BasicProperties(
+                content_type=properties.content_type,
+                headers=headers,
+                expiration=str(int(delay * 1000)),
+                delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE,
+            ),
+        )
 
-    def send_to_error_queue(self, ch:BlockingChannel, method, body, error: ProcessingError):
+    def send_to_error_queue(self, ch:BlockingChannel, method, properties, body, error: ProcessingError):
         """Sends the message to the error queue along with the error message."""
         try:
             # Add the error message to the message body
             error_message = str(error)
             error_data = {
-                "original_message": json.loads(body),
+                **wire.original_message(body, properties.content_type),
                 "error_message": error_message,
                 "worker_id": self.worker_id,
                 "timestamp": str(datetime.datetime.now())
             }
 
-            ch.queue_declare(queue=self.error_queue)
             ch.basic_publish(
                 exchange='',
                 routing_key=self.error_queue,
@@ -163,18 +590,89 @@ class TransactionProcessor:
         except Exception as e:
             log.error(f"Error sending message to error queue: {e}", exc_info=True)
 
+    def start_partitioned(self):
+        """
+        Declares the partitioned topology, joins the workers membership, and consumes the owned partitions.
+        """
+        for method, kwargs in partitioning.topology(config.RABBITMQ_PARTITION_EXCHANGE, config.RABBITMQ_PARTITIONS):
+            getattr(self.channel, method)(**kwargs)
+
+        self.channel.exchange_declare(exchange=config.RABBITMQ_MEMBERS_EXCHANGE, exchange_type="fanout")
+        members_queue = self.channel.queue_declare(queue="", exclusive=True).method.queue
+        self.channel.queue_bind(queue=members_queue, exchange=config.RABBITMQ_MEMBERS_EXCHANGE)
+        self.channel.basic_consume(queue=members_queue, on_message_callback=self.member_handler, auto_ack=True)
+        self.heartbeat()
+
+    def publish_membership(self, leaving=False):
+        self.channel.basic_publish(
+            exchange=config.RABBITMQ_MEMBERS_EXCHANGE,
+            routing_key="",
+            body=json.dumps({"member": self.member_id, "leaving": leaving}),
+        )
+
+    def heartbeat(self):
+        self.publish_membership()
+        if self.assigner.expire():
+            log.info("Worker(s) left without notice")
+        self.rebalance()
+        self.heartbeat_timer = self.connection.call_later(config.MEMBERSHIP_HEARTBEAT, self.heartbeat)
+
+    def member_handler(self, ch:BlockingChannel, method, properties, body):
+        """Heartbeats of the other workers, rebalances when a worker joins or leaves."""
+        message = json.loads(body)
+        if self.assigner.observe(message["member"], leaving=message.get("leaving", False)):
+            log.info(f"Worker {message['member']} {'left' if message.get('leaving') else 'joined'}")
+            self.rebalance()
+
+    def rebalance(self):
+        """
+        Consumes the partitions assigned to this worker, and cancels the revoked ones.
+        A revoked partition keeps being processed here until the cancel, single active consumer
+        hands it over to the new owner only then.
+        """
+        owned = self.assigner.assigned()
+        revoked, acquired = set(self.consumers) - owned, owned - set(self.consumers)
+        if not revoked and not acquired:
+            return
+
+        if revoked and self.batch:
+            self.flush_batch()
+        for partition in sorted(revoked):
+            # Undispatched deliveries are nacked (requeued) by pika for the new owner
+            self.channel.basic_cancel(self.consumers.pop(partition))
+            self.balances = {
+                account_id: balance for account_id, balance in self.balances.items()
+                if partitioning.partition_for(account_id, config.RABBITMQ_PARTITIONS) != partition
+            }
+        for partition in sorted(acquired):
+            queue = partitioning.partition_queue(config.RABBITMQ_PARTITION_EXCHANGE, partition)
+            self.consumers[partition] = self.channel.basic_consume(queue=queue, on_message_callback=self.message_handler)
+        log.info(f"Partitions rebalanced, {len(self.assigner.members)} worker(s), owning {sorted(owned)}")
+
     def start_consuming(self):
         log.info(f"Connecting to RabbitMQ at {config.RABBITMQ_HOST}, user:{config.RABBITMQ_USER}")
         try:
-            self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=config.RABBITMQ_HOST))
+            self.connection = self.connect()
             self.channel = self.connection.channel()
-            self.channel.queue_declare(queue=config.RABBITMQ_TRASACTIONS_QUEUE)
-            self.channel.basic_consume(queue=config.RABBITMQ_TRASACTIONS_QUEUE, on_message_callback=self.transaction_handler)
-            log.info(f"Listening to {self.subscribe_queue}... To exit press CTRL+C")
+            self.channel.basic_qos(prefetch_count=self.prefetch)
+            self.channel.exchange_declare(exchange=config.RABBITMQ_EVENTS_EXCHANGE, exchange_type="fanout")
+            self.channel.queue_declare(queue=self.error_queue)
+            for method, kwargs in retry.topology(self.retry_prefix, config.RABBITMQ_RETRY_TIERS, self.retry_exchange):
+                getattr(self.channel, method)(**kwargs)
+            self.message_handler = self.batch_handler if self.batch_size > 1 else self.transaction_handler
+            self.warm_recent_ids()
+            if self.partitioned:
+                self.start_partitioned()
+                log.info(f"Listening to {config.RABBITMQ_PARTITION_EXCHANGE} partitions... To exit press CTRL+C")
+            else:
+                self.channel.queue_declare(queue=self.subscribe_queue)
+                self.channel.basic_consume(queue=self.subscribe_queue, on_message_callback=self.message_handler)
+                log.info(f"Listening to {self.subscribe_queue}... To exit press CTRL+C")
             self.channel.start_consuming()
         except Exception as e:
             log.error(f"Error connecting to RabbitMQ or consuming messages: {e}", exc_info=True)
         finally:
             if self.connection and self.connection.is_open:
+                if self.partitioned:
+                    self.publish_membership(leaving=True)
                 self.connection.close()
-
@@ -0,0 +1,237 @@
+import argparse
+import concurrent.futures
+import datetime
+import json
+import mmap
+import os
+import sys
+import time
+import zlib
+from decimal import Decimal
+import numpy as np
+import config
+import archive
+from archiver import transaction_partitions, partition_bound
+from db import ConnectionPool
+from logger import configure_logging, log
+
+
+"""
+Reconciliation: checks that the balance of each account is its initial balance plus its completed deposits,
+minus its completed withdrawals and payments, over the whole history (archive segments and MySQL).
+
+The history is loaded in chunks into NumPy arrays of exact integer cents (signed in SQL), and summed per account
+with grouped reductions, one partition or archive segment per process. The totals are taken while the workers
+run, so the accounts that drift are checked again one by one, within a single consistent snapshot.
+
+    python reconcile.py [--processes 4] [--output report.json]
+    docker compose run --rm worker python reconcile.py
+
+Exits with status 1 if any account drifts.
+"""
+
+CHUNK_ROWS = 100000  # rows per fetch, one NumPy chunk
+HOT_QUERY = (
+    "SELECT account_id, IF(transaction_type = 'deposit', 1, -1) * CAST(ROUND(amount * 100) AS SIGNED) "
+    "FROM transactions{partition} WHERE status = 'completed' AND account_id IS NOT NULL"
+)
+# Current balances, the ledger entries after the snapshot included (ledger mode)
+BALANCES_QUERY = """
+    SELECT a.account_id, CAST(ROUND(a.initial_balance * 100) AS SIGNED),
+        CAST(ROUND((a.balance + COALESCE(SUM(e.amount), 0)) * 100) AS SIGNED)
+    FROM accounts a
+    LEFT JOIN ledger_entries e ON e.account_id = a.account_id AND e.entry_id > a.ledger_entry_id
+    {where}
+    GROUP BY a.account_id, a.initial_balance, a.balance
+"""
+ACCOUNT_HOT_QUERY = (
+    "SELECT COALESCE(SUM(IF(transaction_type = 'deposit', 1, -1) * CAST(ROUND(amount * 100) AS SIGNED)), 0) "
+    "FROM transactions WHERE account_id = %s AND status = 'completed'"
+)
+
+
+def connection_pool():
+    return ConnectionPool(
+        size=1,
+        host=config.MYSQL_HOST,
+        user=config.MYSQL_USER,
+        password=config.MYSQL_PASSWORD,
+        database=config.MYSQL_DATABASE,
+    )
+
+def sum_by_account(account_ids, cents):
+    """
+    Exact grouped sum: (sorted unique account ids, int64 totals). The ids are fixed width unicode arrays,
+    sorted in C, not Python objects.
+    """
+    if not len(cents):
+        return np.array([], dtype=str), np.array([], dtype=np.int64)
+    accounts, codes = np.unique(account_ids, return_inverse=True)
+    totals = np.zeros(len(accounts), dtype=np.int64)
+    np.add.at(totals, codes, cents)
+    return accounts, totals
+
+def combine(partials):
+    """Sums the (accounts, totals) of several chunks."""
+    if not partials:
+        return sum_by_account([], [])
+    return sum_by_account(np.concatenate([p[0] for p in partials]), np.concatenate([p[1] for p in partials]))
+
+def to_amount(cents) -> str:
+    return str(Decimal(int(cents)).scaleb(-2))
+
+
+def load_partition(name):
+    """Totals of the completed transactions of a partition (the whole table if None), streamed in chunks."""
+    partials, rows = [], 0
+    with connection_pool().session() as db:
+        cursor = db.cnx.cursor()  # Unbuffered
+        cursor.execute(HOT_QUERY.format(partition=f" PARTITION ({name})" if name else ""))
+        while chunk := cursor.fetchmany(CHUNK_ROWS):
+            account_ids, cents = zip(*chunk)
+            partials.append(sum_by_account(np.array(account_ids, dtype=str), np.array(cents, dtype=np.int64)))
+            rows += len(chunk)
+        cursor.close()
+    return (*combine(partials), rows)
+
+def load_segment(index_path, segment_path):
+    """Totals of the completed transactions of an archive segment, one account (gzip member) at a time."""
+    if not os.path.getsize(segment_path):  # A day without transactions, can't be memory-mapped
+        return (*sum_by_account([], []), 0)
+    with open(index_path) as f:
+        accounts = json.load(f)["accounts"]
+    account_ids, totals, rows = [], [], 0
+    with open(segment_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for account_id, (offset, length, _) in accounts.items():
+            lines = zlib.decompress(data[offset:offset + length], wbits=31).rstrip(b"\n")
+            records = json.loads(b"[" + lines.replace(b"\n", b",") + b"]")
+            completed = np.array([record["status"] == "completed" for record in records])
+            signs = np.where(np.array([record["type"] for record in records]) == "deposit", 1, -1)
+            # DECIMAL(15, 2): the float conversion is exact once rounded to cents
+            cents = np.rint(np.array([record["amount"] for record in records]).astype(np.float64) * 100).astype(np.int64)
+            account_ids.append(account_id)
+            totals.append(int((signs * cents)[completed].sum()))
+            rows += len(records)
+    return (*sum_by_account(np.array(account_ids, dtype=str), np.array(totals, dtype=np.int64)), rows)
+
+def load_balances(db, account_ids=None):
+    """(accounts, initial cents, current cents) arrays, of all the accounts or the given ones."""
+    where, params = "", ()
+    if account_ids is not None:
+        where, params = f"WHERE a.account_id IN ({', '.join(['%s'] * len(account_ids))})", tuple(account_ids)
+    cursor = db.cnx.cursor()
+    cursor.execute(BALANCES_QUERY.format(where=where), params)
+    accounts, initial, current = [], [], []
+    while chunk := cursor.fetchmany(CHUNK_ROWS):
+        for account_id, initial_cents, current_cents in chunk:
+            accounts.append(account_id)
+            initial.append(initial_cents)
+            current.append(current_cents)
+    cursor.close()
+    return np.array(accounts, dtype=str), np.array(initial, dtype=np.int64), np.array(current, dtype=np.int64)
+
+def lookup(accounts, keys, values):
+    """values of `keys` (sorted unique) for each of `accounts`, 0 when missing."""
+    if not len(keys):
+        return np.zeros(len(accounts), dtype=np.int64)
+    positions = np.minimum(np.searchsorted(keys, accounts), len(keys) - 1)
+    return np.where(keys[positions] == accounts, values[positions], 0)
+
+
+class Reconciler:
+    def __init__(self, archive_dir, processes):
+        self.archive_dir = archive_dir
+        self.processes = processes
+
+    def load_history(self):
+        """Totals per account of the archived, and the hot (MySQL) transactions, and the number of rows read."""
+        segments = archive.published_segments(self.archive_dir)
+        archived_until = segments[-1][0] if segments else None
+        with connection_pool().session() as db:
+            partitions = transaction_partitions(db) or [None]
+        # Partitions being archived are counted from their segment
+        partitions = [
+            name for name in partitions
+            if name is None or archived_until is None or (partition_bound(name) or datetime.datetime.max) > archived_until
+        ]
+
+        with concurrent.futures.ProcessPoolExecutor(self.processes) as pool:
+            archived = [pool.submit(load_segment, index_path, segment_path) for _, index_path, segment_path in segments]
+            hot = [pool.submit(load_partition, name) for name in partitions]
+            archived = [future.result() for future in archived]
+            hot = [future.result() for future in hot]
+        rows = sum(result[2] for result in archived + hot)
+        return combine([result[:2] for result in archived]), combine([result[:2] for result in hot]), archived_until, rows
+
+    def recheck(self, account_ids, archived_totals, archived_until):
+        """
+        Expected and current balances of the given accounts, read again within one consistent snapshot,
+        so the transactions committed during the bulk load don't show as drift.
+        """
+        archived_cents = dict(zip(account_ids, lookup(np.array(account_ids, dtype=str), *archived_totals)))
+        query = ACCOUNT_HOT_QUERY + (" AND timestamp >= %s" if archived_until else "")
+        results = {}
+        with connection_pool().session() as db:
+            db.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT", prepared=False)
+            accounts, initial, current = load_balances(db, account_ids)
+            for account_id, initial_cents, current_cents in zip(accounts.tolist(), initial, current):
+                params = (account_id, archived_until) if archived_until else (account_id,)
+                hot_cents = int(db.fetchone(query, params)[0])
+                results[account_id] = (int(initial_cents) + int(archived_cents[account_id]) + hot_cents, int(current_cents))
+            db.rollback()
+        return results
+
+    def run(self, recheck_limit):
+        start = time.perf_counter()
+        archived_totals, hot_totals, archived_until, rows = self.load_history()
+        with connection_pool().session() as db:
+            accounts, initial, current = load_balances(db)
+
+        expected = initial + lookup(accounts, *archived_totals) + lookup(accounts, *hot_totals)
+        drifting = accounts[expected != current]
+        known = set(accounts)
+        orphans = sorted(str(account_id) for account_id in set(archived_totals[0]).union(hot_totals[0]) - known)
+        log.info(f"Loaded {rows} transactions of {len(accounts)} accounts in {time.perf_counter() - start:.1f}s, {len(drifting)} candidates")
+
+        drifted = []
+        if len(drifting):
+            candidates = [str(account_id) for account_id in drifting[:recheck_limit]]
+            for account_id, (expected_cents, current_cents) in self.recheck(candidates, archived_totals, archived_until).items():
+                if expected_cents != current_cents:
+                    drifted.append({
+                        "account_id": account_id,
+                        "expected": to_amount(expected_cents),
+                        "balance": to_amount(current_cents),
+                        "drift": to_amount(current_cents - expected_cents),
+                    })
+        return {
+            "reconciled_at": datetime.datetime.now().isoformat(),
+            "elapsed_s": round(time.perf_counter() - start, 3),
+            "accounts": len(accounts),
+            "transactions": rows,
+            "drifted": sorted(drifted, key=lambda entry: entry["account_id"]),
+            "not_rechecked": max(0, len(drifting) - recheck_limit),
+            "unknown_accounts": orphans,  # Transactions of accounts that don't exist
+        }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Checks the account balances against their transactions")
+    parser.add_argument("--processes", type=int, default=None, help="Loading processes, default one per CPU")
+    parser.add_argument("--recheck-limit", type=int, default=1000, help="Max drifting accounts checked again")
+    parser.add_argument("--output", help="Write the JSON report to this file (default: stdout)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    configure_logging(log_level=config.LOG_LEVEL)
+    args = parse_args()
+    report = Reconciler(config.ARCHIVE_DIR, args.processes).run(args.recheck_limit)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if report["drifted"] or report["not_rechecked"]:
+        log.warning(f"{len(report['drifted'])} accounts drift, {report['not_rechecked']} more candidates were not checked again")
+        sys.exit(1)
@@ -0,0 +1,140 @@
+import argparse
+import base64
+import json
+import time
+import pika
+import config
+from logger import configure_logging, log
+import partitioning
+import wire
+from archiver import hot_cutoff
+
+
+"""
+Replays the messages of the error queue: each original transaction is published again to the transactions
+queue (or its account partition), at most `--rate` messages per second, as a fresh message (no retry attempts).
+
+Messages are only acked once the broker confirmed the replayed transaction, the workers de-duplicate
+transactions that were committed already. Messages without an original transaction to replay
+(invalid, filtered out, or older than the TRANSACTIONS_HOT_DAYS hot window) are moved to the back of the error
+queue, and stay there.
+
+    python replay.py --rate 50 --limit 1000
+    docker compose run --rm worker python replay.py --rate 50
+"""
+
+
+def original_transaction(error_data: dict):
+    """Returns (body, content type) of the failed transaction, or None if there is nothing to replay."""
+    if "original_body" in error_data:
+        return base64.b64decode(error_data["original_body"]), error_data.get("content_type")
+    message = error_data.get("original_message")
+    if not isinstance(message, dict):
+        return None
+    return json.dumps(message).encode(), wire.JSON_V2 if "v" in message else None
+
+
+class ErrorQueueReplayer:
+    def __init__(self, channel, error_queue, rate, match=None):
+        self.channel = channel
+        self.error_queue = error_queue
+        self.interval = 1 / rate if rate else 0
+        self.match = match  # Only replay the errors with this text in their error message
+        self.partitioned = config.RABBITMQ_ROUTING == "partitioned"
+        self.replayed = 0
+        self.kept = 0
+
+    def route(self, transaction):
+        """Returns (exchange, routing_key) of the transaction, same routing as the API."""
+        if self.partitioned:
+            partition = partitioning.partition_for(transaction.account_id, config.RABBITMQ_PARTITIONS)
+            return config.RABBITMQ_PARTITION_EXCHANGE, str(partition)
+        return "", config.RABBITMQ_TRASACTIONS_QUEUE
+
+    def replay(self, error_data):
+        """Publishes the original transaction again, returns False if the message can't be replayed."""
+        if self.match and self.match not in error_data.get("error_message", ""):
+            return False
+        original = original_transaction(error_data)
+        if original is None:
+            return False
+        body, content_type = original
+        try:
+            transaction = wire.decode(body, content_type)
+        except ValueError as e:
+            log.warning(f"Not replaying invalid transaction: {e}")
+            return False
+        if transaction.timestamp < hot_cutoff(config.TRANSACTIONS_HOT_DAYS):
+            # Its id may be archived already, it could be applied twice. Workers would refuse it anyway
+            log.warning(f"Not replaying transaction {transaction.transaction_id}, older than the {config.TRANSACTIONS_HOT_DAYS} days hot window")
+            return False
+
+        exchange, routing_key = self.route(transaction)
+        self.channel.basic_publish(
+            exchange=exchange,
+            routing_key=routing_key,
+            body=body,
+            properties=pika.BasicProperties(content_type=content_type),
+        )
+        log.info(f"TRANSACTION:{transaction.transaction_id} REPLAYED")
+        return True
+
+    def keep(self, body, properties):
+        """Moves the message to the back of the error queue."""
+        self.channel.basic_publish(exchange="", routing_key=self.error_queue, body=body, properties=properties)
+
+    def run(self, limit=None):
+        """Replays the messages in the error queue when starting, or `limit` of them."""
+        pending = self.channel.queue_declare(queue=self.error_queue, passive=True).method.message_count
+        if limit is not None:
+            pending = min(pending, limit)
+        log.info(f"Replaying {pending} messages from {self.error_queue}")
+
+        next_publish = time.monotonic()
+        for _ in range(pending):
+            method, properties, body = self.channel.basic_get(queue=self.error_queue)
+            if method is None:
+                break
+            try:
+                replayed = self.replay(json.loads(body))
+            except ValueError:
+                replayed = False
+            if replayed:
+                self.replayed += 1
+            else:
+                self.keep(body, properties)
+                self.kept += 1
+            self.channel.basic_ack(method.delivery_tag)
+
+            # Rate limit, on a fixed schedule so a slow publish does not lower the rate
+            next_publish += self.interval
+            delay = next_publish - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_publish = time.monotonic()
+        log.info(f"Replayed {self.replayed} messages, {self.kept} kept in {self.error_queue}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replays the transactions of the error queue")
+    parser.add_argument("--rate", type=float, default=10, help="Max replayed messages per second, 0 for no limit")
+    parser.add_argument("--limit", type=int, help="Max messages to replay, default all")
+    parser.add_argument("--match", help="Only replay the errors with this text in their error message")
+    parser.add_argument("--queue", default=config.RABBITMQ_ERROR_QUEUE, help="Error queue")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    configure_logging(log_level=config.LOG_LEVEL)
+    args = parse_args()
+    connection = pika.BlockingConnection(pika.ConnectionParameters(
+        host=config.RABBITMQ_HOST,
+        credentials=pika.PlainCredentials(config.RABBITMQ_USER, config.RABBITMQ_PASS),
+    ))
+    try:
+        channel = connection.channel()
+        channel.confirm_delivery()  # basic_publish waits for the broker confirm, before the ack of the error message
+        ErrorQueueReplayer(channel, args.queue, args.rate, args.match).run(args.limit)
+    finally:
+        connection.close()
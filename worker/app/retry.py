@@ -0,0 +1,43 @@
+import random
+
+
+"""
+Delayed retries: a message to retry is published to a retry tier, a queue without consumers whose messages
+expire after the retry delay, and are dead-lettered back to the exchange the transactions come from,
+with their original routing key (account partition, or transactions queue).
+
+Tier n holds the delays around RETRY_BASE_DELAY * 2^n. Each message has its own expiration (backoff with jitter),
+as a queue only expires its head messages, the delays within a tier are kept close to each other.
+The attempt count travels in the ATTEMPT_HEADER header, after RETRY_MAX_ATTEMPTS the message goes to the error queue.
+"""
+
+ATTEMPT_HEADER = "x-attempt"
+
+
+def tier_exchange(prefix: str, tier: int) -> str:
+    return f"{prefix}.retry.{tier}"
+
+def topology(prefix: str, tiers: int, dead_letter_exchange: str) -> list:
+    """
+    Declarations of the retry tiers, as (channel method, kwargs): a fanout exchange per tier, so the published
+    routing key is kept for the dead-lettering, bound to a queue of the same name.
+    """
+    steps = []
+    for tier in range(tiers):
+        name = tier_exchange(prefix, tier)
+        steps.append(("exchange_declare", {"exchange": name, "exchange_type": "fanout"}))
+        steps.append(("queue_declare", {"queue": name, "arguments": {"x-dead-letter-exchange": dead_letter_exchange}}))
+        steps.append(("queue_bind", {"queue": name, "exchange": name}))
+    return steps
+
+def attempts(headers) -> int:
+    """Number of times the message was already retried."""
+    return int((headers or {}).get(ATTEMPT_HEADER, 0))
+
+def tier_for(attempt: int, tiers: int) -> int:
+    """Tier of a retry attempt (1 for the first retry), the attempts after the last tier stay in it."""
+    return min(attempt, tiers) - 1
+
+def backoff(attempt: int, tiers: int, base_delay: float, jitter: float) -> float:
+    """Delay in seconds before a retry attempt: exponential up to the last tier, with a +/- `jitter` ratio."""
+    return base_delay * 2 ** tier_for(attempt, tiers) * random.uniform(1 - jitter, 1 + jitter)
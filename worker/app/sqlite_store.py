@@ -0,0 +1,153 @@
+import datetime
+import sqlite3
+from contextlib import contextmanager
+from decimal import Decimal
+from timing import StageTimer
+
+
+"""
+SQLite stand-in of the MySQL ConnectionPool (db.py), for local runs and the benchmarks (worker/benchmarks):
+the same session() interface, over one connection, on a file or in memory.
+
+Only the statements of the processor are supported, translated on the fly: %s placeholders, row locks (FOR UPDATE,
+FOR SHARE) dropped as SQLite locks the whole database, LAST_INSERT_ID(expr) and GREATEST as functions.
+Amounts are stored as text, so the balances stay exact; sums computed in SQL (ledger mode) are floating point.
+"""
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS accounts (
+        account_id TEXT PRIMARY KEY,
+        balance TEXT NOT NULL DEFAULT '0.00',
+        initial_balance TEXT NOT NULL DEFAULT '0.00',
+        transaction_count INTEGER NOT NULL DEFAULT 0,
+        last_activity TEXT,
+        ledger_entry_id INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS transaction_ids (
+        transaction_id TEXT PRIMARY KEY,
+        timestamp TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS transactions (
+        transaction_id TEXT NOT NULL,
+        account_id TEXT,
+        transaction_type TEXT NOT NULL,
+        amount TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        status TEXT NOT NULL,
+        details TEXT,
+        PRIMARY KEY (transaction_id, timestamp)
+    );
+    CREATE TABLE IF NOT EXISTS ledger_entries (
+        entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        account_id TEXT NOT NULL,
+        transaction_id TEXT NOT NULL,
+        amount TEXT NOT NULL,
+        timestamp TEXT NOT NULL
+    );
+"""
+ROW_LOCKS = (" FOR UPDATE", " FOR SHARE")
+
+sqlite3.register_adapter(Decimal, str)
+sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(" "))
+
+
+def translate(sql: str) -> str:
+    for lock in ROW_LOCKS:
+        sql = sql.replace(lock, "")
+    return sql.replace("%s", "?")
+
+
+class SQLiteSession:
+    """Same interface as db.DBSession. Statements are translated once, sqlite3 caches the prepared ones."""
+    def __init__(self, cnx, store):
+        self.cnx = cnx
+        self.store = store
+        self.statements = {}  # MySQL sql -> SQLite sql
+        self.lastrowid = None
+        self._last_insert_id = None
+        cnx.create_function("LAST_INSERT_ID", 1, self._set_last_insert_id)
+        cnx.create_function("GREATEST", -1, lambda *values: max(values))
+
+    def _set_last_insert_id(self, value):
+        self._last_insert_id = value
+        return value
+
+    def _sql(self, sql):
+        translated = self.statements.get(sql)
+        if translated is None:
+            translated = self.statements[sql] = translate(sql)
+        return translated
+
+    def execute(self, sql, params=(), prepared=True):
+        """Executes a statement, returns the number of affected rows."""
+        self._last_insert_id = None
+        cursor = self.cnx.execute(self._sql(sql), params)
+        self.lastrowid = self._last_insert_id if self._last_insert_id is not None else cursor.lastrowid
+        return cursor.rowcount
+
+    def executemany(self, sql, seq_params):
+        return self.cnx.executemany(self._sql(sql), seq_params).rowcount
+
+    def insert(self, sql, params=(), prepared=True):
+        """Idempotent INSERT, False if the row already exists."""
+        try:
+            self.execute(sql, params, prepared)
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def insertmany(self, sql, seq_params):
+        """Multi-row version of insert(), False if any of the rows already exists (the others may be inserted)."""
+        try:
+            self.executemany(sql, seq_params)
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def fetchall(self, sql, params=(), prepared=True):
+        return self.cnx.execute(self._sql(sql), params).fetchall()
+
+    def fetchone(self, sql, params=(), prepared=True):
+        rows = self.fetchall(sql, params, prepared)
+        return rows[0] if rows else None
+
+    def commit(self):
+        self.cnx.commit()
+        self.store.commits += 1
+
+    def rollback(self):
+        self.cnx.rollback()
+
+
+class SQLiteStore:
+    """
+    Same session() interface as db.ConnectionPool, with a single connection: the blocking processor uses one at a time.
+    `commits` counts the committed DB transactions, e.g. to measure the batching.
+    """
+    def __init__(self, path=":memory:"):
+        cnx = sqlite3.connect(path, check_same_thread=False)
+        cnx.executescript(SCHEMA)
+        self.commits = 0
+        self._session = SQLiteSession(cnx, self)
+
+    def create_accounts(self, balances: dict):
+        """Creates (or resets) accounts, account_id -> initial balance."""
+        self._session.executemany(
+            "INSERT OR REPLACE INTO accounts (account_id, balance, initial_balance) VALUES (%s, %s, %s)",
+            [(account_id, balance, balance) for account_id, balance in balances.items()],
+        )
+        self._session.cnx.commit()
+
+    @contextmanager
+    def session(self, timer=None):
+        """Yields the session, always returned without an open DB transaction, as ConnectionPool.session."""
+        with (timer or StageTimer()).stage("connect"):
+            session = self._session
+        try:
+            yield session
+        finally:
+            if session.cnx.in_transaction:
+                session.rollback()
+
+    def close(self):
+        self._session.cnx.close()
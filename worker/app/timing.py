@@ -0,0 +1,25 @@
+import time
+from contextlib import contextmanager
+import metrics
+
+
+class StageTimer:
+    """
+    Measures the duration of the processing stages of a transaction (or batch).
+    Each stage is also observed in the worker_stage_seconds histogram.
+    """
+    def __init__(self):
+        self.stages = {}  # stage -> seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed
+            metrics.STAGE_SECONDS.labels(name).observe(elapsed)
+
+    def __str__(self):
+        return " ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in self.stages.items())
@@ -36,3 +36,19 @@ class Transaction(BaseModel):
             "timestamp": self.timestamp.isoformat()
         }
 
+
+class TransactionRecord:
+    """
+    Same attributes as Transaction, without the validation: decoded from trusted producers, see wire.decode.
+    """
+    __slots__ = ("transaction_id", "account_id", "transaction_type", "amount", "details", "timestamp")
+
+    def __init__(self, transaction_id, account_id, transaction_type, amount, details, timestamp):
+        self.transaction_id = transaction_id
+        self.account_id = account_id
+        self.transaction_type = transaction_type
+        self.amount = amount
+        self.details = details
+        self.timestamp = timestamp
+
+    to_dict = Transaction.to_dict
@@ -0,0 +1,101 @@
+"""
+Decoding of the queued transactions, see api/app/wire.py for the version 2 format.
+
+Messages without a version 2 content type are version 1 JSON (float amount, ISO timestamp),
+still accepted while they are in the queues.
+"""
+import base64
+import datetime
+import json
+import struct
+from decimal import Decimal
+from transaction import Transaction, TransactionRecord
+
+VERSION = 2
+JSON_V2 = "application/vnd.transaction.v2+json"
+BINARY_V2 = "application/vnd.transaction.v2+binary"
+
+AMOUNT_SCALE = 2
+TRANSACTION_TYPES = {1: "deposit", 2: "withdrawal", 3: "payment"}
+BINARY_HEADER = struct.Struct("<BB16sqqHI")
+
+
+def from_minor_units(amount: int) -> Decimal:
+    return Decimal(amount).scaleb(-AMOUNT_SCALE)
+
+def from_epoch_us(timestamp: int) -> datetime.datetime:
+    """Local time, like the rest of the timestamps. Exact, no float conversion."""
+    seconds, microseconds = divmod(timestamp, 1_000_000)
+    return datetime.datetime.fromtimestamp(seconds).replace(microsecond=microseconds)
+
+
+def format_uuid(raw: bytes) -> str:
+    """Same as str(uuid.UUID(bytes=raw)), without building the UUID object."""
+    h = raw.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+def decode(body: bytes, content_type: str = None, trusted: bool = False):
+    """
+    Returns the transaction of a message. Raises ValueError if it can't be decoded.
+
+    Messages from `trusted` producers (the API validated them already) are decoded into a TransactionRecord,
+    without the pydantic validation. Otherwise, a validated Transaction.
+    """
+    try:
+        if content_type == BINARY_V2:
+            fields = decode_binary(body)
+        elif content_type == JSON_V2:
+            data = json.loads(body)
+            if data["v"] != VERSION:
+                raise ValueError(f"Unsupported version {data['v']}")
+            fields = (
+                data["transaction_id"],
+                data["account_id"],
+                data["transaction_type"],
+                from_minor_units(data["amount_minor"]),
+                data["details"],
+                from_epoch_us(data["ts_us"]),
+            )
+        else:
+            return Transaction.from_dict(json.loads(body))
+    except (KeyError, TypeError, struct.error, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid data: {e!r}")
+
+    if trusted:
+        if fields[2] not in TRANSACTION_TYPES.values():
+            raise ValueError(f"Invalid transaction type {fields[2]}")
+        return TransactionRecord(*fields)
+    return Transaction(**dict(zip(TransactionRecord.__slots__, fields)))
+
+def decode_binary(body: bytes):
+    version, type_code, transaction_id, amount, timestamp, account_length, details_length = BINARY_HEADER.unpack_from(body)
+    if version != VERSION:
+        raise ValueError(f"Unsupported version {version}")
+    if type_code not in TRANSACTION_TYPES:
+        raise ValueError(f"Invalid transaction type code {type_code}")
+    if len(body) != BINARY_HEADER.size + account_length + details_length:
+        raise ValueError(f"Invalid message length {len(body)}")
+    account_start = BINARY_HEADER.size
+    details_start = account_start + account_length
+    return (
+        format_uuid(transaction_id),
+        body[account_start:details_start].decode(),
+        TRANSACTION_TYPES[type_code],
+        from_minor_units(amount),
+        body[details_start:].decode(),
+        from_epoch_us(timestamp),
+    )
+
+
+def original_message(body: bytes, content_type: str = None) -> dict:
+    """
+    The message as kept in the error queue: the JSON object if the body is JSON,
+    otherwise the body in base64, with its content type.
+    """
+    if content_type != BINARY_V2:
+        try:
+            return {"original_message": json.loads(body)}
+        except ValueError:  # UnicodeDecodeError included
+            pass
+    return {"original_body": base64.b64encode(body).decode(), "content_type": content_type}
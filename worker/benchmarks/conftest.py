@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The benchmarks need neither RabbitMQ nor MySQL (memory_broker, sqlite_store), nor the simulated work
+os.environ.setdefault("PROCESS_TIME", "0")
+os.environ.setdefault("METRICS_PORT", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "app"))
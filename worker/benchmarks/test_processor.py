@@ -0,0 +1,113 @@
+import datetime
+import json
+import random
+import uuid
+import pika
+import pytest
+import config
+import wire
+from memory_broker import Delivery, MemoryBroker
+from processor import TransactionProcessor
+from sqlite_store import SQLiteStore
+
+
+"""
+Throughput benchmarks of the blocking TransactionProcessor, on the in-memory broker and an in-memory SQLite store,
+so they run anywhere, without the docker-compose services:
+
+    cd worker
+    pip install -r benchmarks/requirements.txt
+    python -m pytest benchmarks --benchmark-autosave
+    python -m pytest benchmarks --benchmark-compare --benchmark-compare-fail=mean:15%  # fails on a regression
+    python -m pytest benchmarks --benchmark-disable  # each benchmark runs once, as a smoke test
+
+The figures measure the processor code (decoding, dedup, authorization, SQL round trips, acks, events),
+SQLite being much faster than a MySQL round trip they are not the production throughput.
+"""
+
+MESSAGES = 2000
+ACCOUNTS = [str(account_id) for account_id in range(101, 121)]
+INITIAL_BALANCE = "1000000.00"  # No transaction is rejected for insufficient funds
+PROPERTIES = pika.BasicProperties(content_type=wire.JSON_V2)
+
+
+def message(rng: random.Random) -> bytes:
+    """A transaction as published by the API (version 2 JSON, see api/app/wire.py)."""
+    return json.dumps({
+        "v": wire.VERSION,
+        "transaction_id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+        "account_id": rng.choice(ACCOUNTS),
+        "transaction_type": rng.choice(["deposit", "withdrawal", "payment"]),
+        "amount_minor": rng.randint(100, 10000),
+        "ts_us": int(datetime.datetime.now().timestamp() * 1_000_000),
+        "details": "benchmark",
+    }).encode()
+
+def new_store() -> SQLiteStore:
+    store = SQLiteStore()
+    store.create_accounts({account_id: INITIAL_BALANCE for account_id in ACCOUNTS})
+    return store
+
+def new_processor(store, broker, batch_size=1, trusted=False) -> TransactionProcessor:
+    processor = TransactionProcessor("bench", db=store, connect=broker.connect)
+    processor.batch_size = batch_size
+    processor.prefetch = 2 * batch_size
+    processor.trusted = trusted
+    return processor
+
+def queued_run(batch_size, seed=0):
+    """Setup of a benchmark round: a fresh processor, with MESSAGES transactions waiting in its queue."""
+    rng = random.Random(seed)
+    broker, store = MemoryBroker(), new_store()
+    broker.declare_queue(config.RABBITMQ_TRASACTIONS_QUEUE)
+    for _ in range(MESSAGES):
+        broker.publish(config.RABBITMQ_TRASACTIONS_QUEUE, message(rng), properties=PROPERTIES)
+    return (new_processor(store, broker, batch_size), store, broker), {}
+
+def consume(processor, store, broker):
+    processor.start_consuming()
+    return store, broker
+
+def check_consumed(store, broker):
+    assert not broker.queues[config.RABBITMQ_TRASACTIONS_QUEUE]
+    assert not broker.queues[config.RABBITMQ_ERROR_QUEUE], "transactions sent to the error queue"
+    with store.session() as db:
+        assert db.fetchone("SELECT COUNT(*) FROM transactions")[0] == MESSAGES
+
+
+def test_throughput(benchmark):
+    """Messages per second, one DB transaction per message."""
+    store, broker = benchmark.pedantic(consume, setup=lambda: queued_run(batch_size=1), rounds=5)
+    check_consumed(store, broker)
+    if benchmark.stats:  # None with --benchmark-disable, the run is only checked
+        benchmark.extra_info["messages_per_second"] = round(MESSAGES / benchmark.stats.stats.mean)
+
+
+@pytest.mark.parametrize("batch_size", [1, 10, 50, 200])
+def test_batch_efficiency(benchmark, batch_size):
+    """Messages per second, and DB transactions (commits) per message, by batch size."""
+    store, broker = benchmark.pedantic(consume, setup=lambda: queued_run(batch_size), rounds=5)
+    check_consumed(store, broker)
+    if benchmark.stats:  # None with --benchmark-disable, the run is only checked
+        benchmark.extra_info["messages_per_second"] = round(MESSAGES / benchmark.stats.stats.mean)
+        benchmark.extra_info["commits_per_message"] = store.commits / MESSAGES
+
+
+@pytest.mark.parametrize("trusted", [False, True], ids=["validated", "trusted"])
+def test_handler_latency(benchmark, trusted):
+    """Latency of transaction_handler, one message from delivery to ack (events published)."""
+    rng = random.Random(1)
+    broker, store = MemoryBroker(), new_store()
+    processor = new_processor(store, broker, trusted=trusted)
+    processor.connection = broker.connect()
+    processor.channel = channel = processor.connection.channel()
+    channel.exchange_declare(exchange=config.RABBITMQ_EVENTS_EXCHANGE, exchange_type="fanout")
+    channel.queue_declare(queue=processor.error_queue)
+    tags = iter(range(1, 1_000_000))
+
+    def delivery():
+        method = Delivery(next(tags), "", config.RABBITMQ_TRASACTIONS_QUEUE)
+        return (channel, method, PROPERTIES, message(rng)), {}
+
+    benchmark.pedantic(processor.transaction_handler, setup=delivery, rounds=2000, warmup_rounds=100)
+    assert not broker.queues[processor.error_queue], "transactions sent to the error queue"